@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""
+micro-benchmarks for the floe backends.
+
+runs each operation against each backend over a range of value sizes, batch
+sizes and thread counts, and reports throughput and latency percentiles as
+json. pass --baseline to compare against an earlier run and exit non-zero
+on a regression, and --save to write this run out as the next baseline.
+
+    ./bench.py --backends file,sqlite,http --seconds 1 --save baseline.json
+    ./bench.py --baseline baseline.json
+
+the file, filelog, sqlite and http backends run against temp directories and
+an in-process floe_server. mysql uses FLOE_URL_BENCH_MYSQL, or a local server
+as root, and is skipped when it can't connect.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from socketserver import ThreadingMixIn
+from uuid import uuid4
+from wsgiref.simple_server import make_server, WSGIServer, \
+    WSGIRequestHandler
+
+import floe
+
+OPS = ['get', 'set', 'get_multi', 'set_multi', 'delete', 'delete_multi',
+       'ids', 'flush']
+MULTI_OPS = ['get_multi', 'set_multi', 'delete_multi']
+# ops that work on a whole domain rather than a batch of keys
+DOMAIN_OPS = ['ids', 'flush']
+
+# keys written up front for the read ops to hit, and per ids/flush call
+KEYSPACE = 1000
+
+
+def xid():
+    return uuid4().hex
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections from a 10 thread client
+    # pool, and the retried SYN costs a whole second
+    request_queue_size = 128
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    server = make_server('127.0.0.1', 0, floe.floe_server(),
+                         server_class=ThreadingWSGIServer,
+                         handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def mysql_available():
+    if os.getenv('FLOE_URL_BENCH_MYSQL'):
+        return True
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        return sock.connect_ex(('127.0.0.1', 3306)) == 0
+    finally:
+        sock.close()
+
+
+def configure(backends, workdir):
+    """
+    point a FLOE_URL_BENCH_* domain at each backend, leaving any already set
+    alone. returns the domain names of the backends that can run, and the
+    http server when one was started.
+    """
+    defaults = {
+        'file': 'file://%s/file' % workdir,
+        'filelog': 'filelog://%s/filelog' % workdir,
+        'sqlite': 'sqlite://%s/bench.db?table=bench' % workdir,
+        'mysql': 'mysql://root@127.0.0.1:3306/test?table=floe_bench',
+    }
+    domains, server = {}, None
+    for backend in backends:
+        if backend == 'mysql' and not mysql_available():
+            sys.stderr.write('skipping mysql: no server\n')
+            continue
+        if backend == 'http':
+            server = server or start_server()
+            os.environ.setdefault('FLOE_URL_BENCH_HTTP_FILE',
+                                  'file://%s/http' % workdir)
+            os.environ.setdefault(
+                'FLOE_URL_BENCH_HTTP', 'http://127.0.0.1:%s/bench_http_file'
+                % server.server_address[1])
+        elif backend in defaults:
+            os.environ.setdefault('FLOE_URL_BENCH_%s' % backend.upper(),
+                                  defaults[backend])
+        else:
+            raise SystemExit('unknown backend %s' % backend)
+        domains[backend] = 'bench_%s' % backend
+    return domains, server
+
+
+def percentile(latencies, p):
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+def run_case(conn, op, value_size, batch_size, threads, seconds):
+    """
+    call op from `threads` threads for about `seconds` and return the
+    latency of every call. setup for a call, such as writing the keys a
+    delete removes, is not timed.
+    """
+    value = os.urandom(value_size)
+    conn.flush()
+    keys = [xid() for _ in range(KEYSPACE)]
+    if op in ('get', 'get_multi'):
+        conn.set_multi({key: value for key in keys})
+
+    deadline = time.monotonic() + seconds
+    results = []
+    lock = threading.Lock()
+
+    def worker(n):
+        latencies = []
+        i = n * batch_size
+        while True:
+            batch = [keys[(i + j) % KEYSPACE] for j in range(batch_size)]
+            i += batch_size * threads
+            if op in ('delete', 'delete_multi'):
+                conn.set_multi({key: value for key in batch})
+            elif op in DOMAIN_OPS:
+                conn.set_multi({key: value for key in keys})
+
+            start = time.perf_counter()
+            if op == 'get':
+                conn.get(batch[0])
+            elif op == 'set':
+                conn.set(batch[0], value)
+            elif op == 'delete':
+                conn.delete(batch[0])
+            elif op == 'get_multi':
+                conn.get_multi(batch)
+            elif op == 'set_multi':
+                conn.set_multi({key: value for key in batch})
+            elif op == 'delete_multi':
+                conn.delete_multi(batch)
+            elif op == 'ids':
+                for _ in conn.ids():
+                    pass
+            elif op == 'flush':
+                conn.flush()
+            latencies.append(time.perf_counter() - start)
+            if time.monotonic() >= deadline:
+                break
+        with lock:
+            results.extend(latencies)
+
+    workers = [threading.Thread(target=worker, args=(n,))
+               for n in range(threads)]
+    started = time.monotonic()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return results, time.monotonic() - started
+
+
+def summarize(latencies, elapsed, keys_per_call, threads):
+    latencies.sort()
+    keys = len(latencies) * keys_per_call
+    # throughput over the time the threads spent inside timed calls, so the
+    # untimed setup some ops need doesn't count against the backend
+    busy = sum(latencies) / threads
+    return {
+        'calls': len(latencies),
+        'keys': keys,
+        'seconds': elapsed,
+        'keys_per_second': keys / busy if busy else 0,
+        'p50': percentile(latencies, 0.50),
+        'p99': percentile(latencies, 0.99),
+        'p999': percentile(latencies, 0.999),
+    }
+
+
+def cases(args):
+    for op in args.ops:
+        for value_size in args.value_sizes:
+            batch_sizes = args.batch_sizes if op in MULTI_OPS else [1]
+            thread_counts = [1] if op in DOMAIN_OPS else args.threads
+            for batch_size in batch_sizes:
+                for threads in thread_counts:
+                    yield op, value_size, batch_size, threads
+
+
+def case_key(result):
+    return '%(backend)s %(op)s size=%(value_size)s batch=%(batch_size)s ' \
+           'threads=%(threads)s' % result
+
+
+def compare(results, baseline, tolerance):
+    """
+    the cases whose throughput dropped, or whose p99 grew, by more than
+    tolerance compared to the baseline.
+    """
+    previous = {case_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get(case_key(result))
+        if not before:
+            continue
+        if result['keys_per_second'] < \
+                before['keys_per_second'] * (1 - tolerance):
+            regressions.append((case_key(result), 'keys_per_second',
+                                before['keys_per_second'],
+                                result['keys_per_second']))
+        if before['p99'] and result['p99'] > before['p99'] * (1 + tolerance):
+            regressions.append((case_key(result), 'p99', before['p99'],
+                                result['p99']))
+    return regressions
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark floe backends')
+    parser.add_argument('--backends', default='file,filelog,sqlite,mysql,http',
+                        type=lambda v: v.split(','))
+    parser.add_argument('--ops', default=','.join(OPS),
+                        type=lambda v: v.split(','))
+    parser.add_argument('--value-sizes', default='100,4096,65536',
+                        type=int_list)
+    parser.add_argument('--batch-sizes', default='10,100', type=int_list)
+    parser.add_argument('--threads', default='1,4', type=int_list)
+    parser.add_argument('--seconds', default=1.0, type=float,
+                        help='time spent on each case')
+    parser.add_argument('--output', help='write the results here, not stdout')
+    parser.add_argument('--save', help='also write the results as a baseline')
+    parser.add_argument('--baseline', help='compare against these results')
+    parser.add_argument('--tolerance', default=0.2, type=float,
+                        help='fraction a case may get worse by')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='floe-bench-')
+    try:
+        domains, server = configure(args.backends, workdir)
+        results = []
+        for backend, domain in domains.items():
+            conn = floe.connect(domain)
+            for op, value_size, batch_size, threads in cases(args):
+                latencies, elapsed = run_case(conn, op, value_size,
+                                              batch_size, threads,
+                                              args.seconds)
+                keys_per_call = KEYSPACE if op in DOMAIN_OPS else batch_size
+                result = {'backend': backend, 'op': op,
+                          'value_size': value_size, 'batch_size': batch_size,
+                          'threads': threads}
+                result.update(summarize(
+                    latencies, elapsed, keys_per_call, threads))
+                results.append(result)
+                sys.stderr.write('%-60s %12.0f keys/s  p99 %.6fs\n' % (
+                    case_key(result), result['keys_per_second'],
+                    result['p99']))
+            conn.flush()
+        if server:
+            server.shutdown()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {'floe': floe.__version__,
+                 'python': platform.python_version(),
+                 'platform': platform.platform(),
+                 'time': time.time(),
+                 'seconds': args.seconds},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+    if args.save:
+        with open(args.save, 'w') as f:
+            f.write(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for key, metric, before, after in regressions:
+            sys.stderr.write('REGRESSION %s %s: %s -> %s\n' %
+                             (key, metric, before, after))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+import threading
+from collections import OrderedDict
+from .helpers import sanitize_key, current_time, parse_size
+
+# rough bytes of bookkeeping per entry, so the budget also bounds the
+# number of small and negative entries
+ENTRY_OVERHEAD = 64
+
+# invalidations are counted in this many stripes of keys, so a write only
+# holds back the reads in flight for keys that share its stripe
+VERSION_STRIPES = 1024
+
+
+class CacheFloe(object):
+    """
+    Wraps a floe with a read-through LRU cache held in memory and bounded by
+    the total bytes of the cached values. Misses are cached too, for a
+    shorter time, so lookups of absent keys don't keep reaching the backend.
+    Writes, deletes and flushes made through the cache invalidate it; writes
+    made by other processes show up once the entry expires.
+    """
+
+    def __init__(self, backend, max_bytes=64 << 20, ttl=30,
+                 negative_ttl=5):
+        """
+        :param backend: the floe to read through to
+        :param max_bytes: budget for the cached values, as bytes or a size
+            such as 256MB
+        :param ttl: seconds a value is served from the cache, 0 for no limit
+        :param negative_ttl: seconds a miss is remembered, 0 to not cache
+            misses
+        """
+        self.backend = backend
+        self.max_bytes = parse_size(max_bytes)
+        self.ttl = float(ttl)
+        self.negative_ttl = float(negative_ttl)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # a stripe's version is bumped when one of its keys is invalidated.
+        # a read only caches a key whose stripe didn't change while it was at
+        # the backend, so it can't put back a value a concurrent write just
+        # replaced.
+        self._versions = [0] * VERSION_STRIPES
+        self._stats = {'hits': 0, 'negative_hits': 0, 'misses': 0,
+                       'evictions': 0, 'expirations': 0}
+
+    def stats(self):
+        """
+        hit, miss and eviction counters plus the current size of the cache.
+        negative_hits counts lookups answered by a cached miss.
+        :return: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        return stats
+
+    def _lookup(self, keys, now):
+        """
+        split keys into cached results and the keys to fetch.
+        """
+        found, missing = {}, []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] and entry[1] <= now:
+                    self._evict(key)
+                    self._stats['expirations'] += 1
+                    entry = None
+                if entry is None:
+                    missing.append(key)
+                    self._stats['misses'] += 1
+                    continue
+                self._entries.move_to_end(key)
+                if entry[0] is None:
+                    self._stats['negative_hits'] += 1
+                else:
+                    self._stats['hits'] += 1
+                found[key] = entry[0]
+            versions = {key: self._version(key) for key in missing}
+            return found, missing, versions
+
+    def _version(self, key):
+        return self._versions[hash(key) % VERSION_STRIPES]
+
+    def _fill(self, keys, values, versions, now):
+        with self._lock:
+            for key in keys:
+                if self._version(key) != versions[key]:
+                    continue
+                value = values.get(key)
+                if value is None:
+                    if not self.negative_ttl:
+                        continue
+                    expires = now + self.negative_ttl
+                else:
+                    expires = now + self.ttl if self.ttl else 0
+                size = ENTRY_OVERHEAD + len(key) + \
+                    (len(value) if value is not None else 0)
+                if size > self.max_bytes:
+                    continue
+                self._evict(key)
+                self._entries[key] = (value, expires, size)
+                self._bytes += size
+            while self._bytes > self.max_bytes:
+                key = next(iter(self._entries))
+                self._evict(key)
+                self._stats['evictions'] += 1
+
+    def _evict(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def invalidate(self, keys):
+        """
+        drop keys from the cache.
+        :param keys:
+        :return:
+        """
+        with self._lock:
+            for key in keys:
+                self._versions[hash(key) % VERSION_STRIPES] += 1
+                self._evict(key)
+
+    def get(self, key):
+        return self.get_multi([key]).get(sanitize_key(key))
+
+    def get_multi(self, keys):
+        keys = [sanitize_key(key) for key in keys]
+        now = current_time()
+        found, missing, versions = self._lookup(keys, now)
+        if missing:
+            values = self.backend.get_multi(missing) \
+                if len(missing) > 1 else \
+                {missing[0]: self.backend.get(missing[0])}
+            self._fill(missing, values, versions, now)
+            found.update(values)
+        return {key: value for key, value in found.items()
+                if value is not None}
+
+    def set(self, key, bin_data):
+        key = sanitize_key(key)
+        try:
+            return self.backend.set(key, bin_data)
+        finally:
+            self.invalidate([key])
+
+    def set_multi(self, mapping):
+        mapping = {sanitize_key(key): value for key, value in mapping.items()}
+        try:
+            return self.backend.set_multi(mapping)
+        finally:
+            self.invalidate(mapping.keys())
+
+    def delete(self, key):
+        key = sanitize_key(key)
+        try:
+            return self.backend.delete(key)
+        finally:
+            self.invalidate([key])
+
+    def delete_multi(self, keys):
+        keys = [sanitize_key(key) for key in keys]
+        try:
+            return self.backend.delete_multi(keys)
+        finally:
+            self.invalidate(keys)
+
+    def ids(self, *args, **kwargs):
+        return self.backend.ids(*args, **kwargs)
+
+    def flush(self):
+        try:
+            return self.backend.flush()
+        finally:
+            with self._lock:
+                self._versions = [version + 1 for version in self._versions]
+                self._entries.clear()
+                self._bytes = 0
@@ -0,0 +1,152 @@
+import bz2
+import lzma
+import threading
+import time
+import zlib
+from .helpers import sanitize_key
+from .exceptions import FloeConfigurationException, FloeReadException
+
+# every encoded value starts with MAGIC and a codec id byte. anything else
+# is a raw value, so values written before the codec was turned on still
+# read back unchanged.
+MAGIC = b'\xfe\xf1\x0e'
+
+# a raw value that happens to start with MAGIC is stored behind this id so
+# it can't be mistaken for a compressed one.
+RAW = 0
+
+CODECS = {
+    'zlib': (1, lambda data, level: zlib.compress(data, level),
+             zlib.decompress, 6),
+    'lzma': (2, lambda data, level: lzma.compress(data, preset=level),
+             lzma.decompress, 6),
+    'bz2': (3, lambda data, level: bz2.compress(data, level),
+            bz2.decompress, 9),
+}
+
+DECOMPRESSORS = {codec_id: (name, decompress)
+                 for name, (codec_id, _, decompress, _) in CODECS.items()}
+
+
+class CodecFloe(object):
+    """
+    Wraps any floe and compresses values of at least min_size bytes on the
+    way in. Compressed values carry a small header naming the codec, so a
+    domain can switch codecs, or turn compression off, and still read
+    everything already stored.
+    """
+
+    def __init__(self, backend, codec='zlib', min_size=512, level=None):
+        """
+        :param backend: the floe to store the encoded values in
+        :param codec: zlib, lzma or bz2
+        :param min_size: values smaller than this are stored raw
+        :param level: compression level, defaults to the codec's own
+        """
+        if codec not in CODECS:
+            raise FloeConfigurationException('invalid codec %s' % codec)
+
+        self.backend = backend
+        self.codec = codec
+        self.min_size = int(min_size)
+        self.codec_id, self._compress, _, default_level = CODECS[codec]
+        self.level = default_level if level is None else int(level)
+        self._header = MAGIC + bytes([self.codec_id])
+        self._raw_header = MAGIC + bytes([RAW])
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, codec, **counters):
+        with self._stats_lock:
+            stats = self._stats.setdefault(codec, {
+                'compressed': 0, 'skipped': 0, 'decompressed': 0,
+                'bytes_in': 0, 'bytes_out': 0,
+                'compress_seconds': 0.0, 'decompress_seconds': 0.0})
+            for counter, value in counters.items():
+                stats[counter] += value
+
+    def stats(self):
+        """
+        per codec counters. bytes_in and bytes_out cover the values that
+        were compressed, the seconds are cpu time spent in the codec, and
+        skipped counts values left raw because they were too small or
+        didn't shrink.
+        :return: dict of codec name to counters
+        """
+        with self._stats_lock:
+            stats = {codec: dict(counters)
+                     for codec, counters in self._stats.items()}
+        for counters in stats.values():
+            counters['ratio'] = counters['bytes_out'] / counters['bytes_in'] \
+                if counters['bytes_in'] else 1.0
+        return stats
+
+    def encode(self, value):
+        if value is None or len(value) < self.min_size:
+            if value is not None and bytes(value[:len(MAGIC)]) == MAGIC:
+                return self._raw_header + bytes(value)
+            return value
+
+        started = time.thread_time()
+        compressed = self._compress(value, self.level)
+        elapsed = time.thread_time() - started
+
+        if len(compressed) + len(self._header) >= len(value):
+            self._count(self.codec, skipped=1, compress_seconds=elapsed)
+            if bytes(value[:len(MAGIC)]) == MAGIC:
+                return self._raw_header + bytes(value)
+            return value
+
+        self._count(self.codec, compressed=1, bytes_in=len(value),
+                    bytes_out=len(compressed), compress_seconds=elapsed)
+        return self._header + compressed
+
+    def decode(self, value):
+        if value is None or bytes(value[:len(MAGIC)]) != MAGIC:
+            return value
+
+        codec_id = value[len(MAGIC)]
+        data = value[len(MAGIC) + 1:]
+        if codec_id == RAW:
+            return bytes(data)
+
+        try:
+            codec, decompress = DECOMPRESSORS[codec_id]
+        except KeyError:
+            raise FloeReadException('unknown codec id %s' % codec_id)
+
+        started = time.thread_time()
+        try:
+            result = decompress(data)
+        except (zlib.error, lzma.LZMAError, OSError, ValueError) as e:
+            raise FloeReadException(e)
+        self._count(codec, decompressed=1,
+                    decompress_seconds=time.thread_time() - started)
+        return result
+
+    def get(self, key):
+        return self.decode(self.backend.get(key))
+
+    def get_multi(self, keys):
+        return {key: self.decode(value)
+                for key, value in self.backend.get_multi(keys).items()}
+
+    def set(self, key, bin_data):
+        return self.backend.set(sanitize_key(key), self.encode(bin_data))
+
+    def set_multi(self, mapping):
+        return self.backend.set_multi(
+            {sanitize_key(key): self.encode(value)
+             for key, value in mapping.items()})
+
+    def delete(self, key):
+        return self.backend.delete(key)
+
+    def delete_multi(self, keys):
+        return self.backend.delete_multi(keys)
+
+    def ids(self, *args, **kwargs):
+        return self.backend.ids(*args, **kwargs)
+
+    def flush(self):
+        return self.backend.flush()
@@ -0,0 +1,233 @@
+"""
+copy every key of one floe domain to another.
+
+    floe-copy SRC DST [--workers 4] [--batch-size 500] [--rate 0]
+                      [--checkpoint copy.json] [--verify]
+
+SRC and DST are domain names, configured with FLOE_URL_* like any other
+connection.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from .connector import connect
+from .helpers import chunks, pipeline
+from .exceptions import FloeConfigurationException
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_INTERVAL = 5
+
+
+def _paced(batches, rate):
+    """
+    hold back batches so no more than rate keys a second go through.
+    """
+    next_time = time.monotonic()
+    for batch in batches:
+        delay = next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        yield batch
+        next_time = max(next_time, time.monotonic() - 1) + len(batch) / rate
+
+
+def _ids(floe, after):
+    """
+    the ids of a floe after a key, or None if it can't resume from one.
+    """
+    try:
+        return floe.ids(after=after)
+    except (TypeError, FloeConfigurationException):
+        return None
+
+
+class Checkpoint(object):
+    """
+    the progress of a copy, saved to a json file. after is the last key of
+    the run of batches, in id order, that have all been written, so only
+    backends whose ids come back ordered and take an after key can resume
+    from it.
+    """
+
+    def __init__(self, path, src, dst):
+        self.path = path
+        self.after = None
+        self.copied = 0
+        self.saved = 0
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            # floes passed in as objects have no name to check
+            if None not in (src, dst, state['src'], state['dst']) and \
+                    (state['src'], state['dst']) != (src, dst):
+                raise FloeConfigurationException(
+                    'checkpoint %s is for %s to %s' %
+                    (path, state['src'], state['dst']))
+            self.after = state['after']
+            self.copied = state['copied']
+        self.src = src
+        self.dst = dst
+
+    def save(self, force=False):
+        if not self.path:
+            return
+        now = time.monotonic()
+        if not force and now - self.saved < CHECKPOINT_INTERVAL:
+            return
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as f:
+            json.dump({'src': self.src, 'dst': self.dst,
+                       'after': self.after, 'copied': self.copied}, f)
+        os.replace(tmp_path, self.path)
+        self.saved = now
+
+
+def _name(floe):
+    return floe if isinstance(floe, str) else None
+
+
+def copy(src, dst, batch_size=500, workers=4, rate=0, checkpoint=None,
+         verify=False):
+    """
+    copy every key from src to dst with get_multi and set_multi, a batch
+    per worker at a time.
+    :param src: domain name or floe to copy from
+    :param dst: domain name or floe to copy to
+    :param batch_size: keys per get_multi and set_multi
+    :param workers: batches copied at once
+    :param rate: most keys copied per second, 0 for no limit
+    :param checkpoint: path of a file to record progress in. a copy started
+        with the same file picks up where the last one stopped.
+    :param verify: compare digests of every value afterwards
+    :return: dict of keys and bytes copied, seconds taken and, with verify,
+        the verify results
+    """
+    state = Checkpoint(checkpoint, _name(src), _name(dst))
+    src = connect(src) if isinstance(src, str) else src
+    dst = connect(dst) if isinstance(dst, str) else dst
+
+    ids = None
+    if state.after is not None:
+        ids = _ids(src, state.after)
+        if ids is None:
+            logger.warning('source cannot resume from a key, copying it '
+                           'all again')
+            state.after, state.copied = None, 0
+        else:
+            logger.info('resuming after %s', state.after)
+    if ids is None:
+        ids = src.ids()
+
+    batches = chunks(ids, batch_size)
+    if rate:
+        batches = _paced(batches, float(rate))
+
+    lock = threading.Lock()
+    finished = {}
+    progress = {'next': 0, 'bytes': 0}
+    started = time.monotonic()
+
+    def copy_batch(keys):
+        values = src.get_multi(keys)
+        if values:
+            dst.set_multi(values)
+        return sum(len(value) for value in values.values())
+
+    def done(seq, keys, size):
+        with lock:
+            finished[seq] = (keys[-1], len(keys))
+            progress['bytes'] += size
+            while progress['next'] in finished:
+                state.after, count = finished.pop(progress['next'])
+                state.copied += count
+                progress['next'] += 1
+            state.save()
+
+    try:
+        pipeline(batches, copy_batch, int(workers), done)
+    finally:
+        with lock:
+            state.save(force=True)
+
+    result = {'keys': state.copied, 'bytes': progress['bytes'],
+              'seconds': time.monotonic() - started}
+    logger.info('copied %(keys)s keys, %(bytes)s bytes in %(seconds).1fs',
+                result)
+    if verify:
+        result['verify'] = verify_copy(src, dst, batch_size, workers)
+    return result
+
+
+def _digest(value):
+    return hashlib.blake2b(value, digest_size=16).digest()
+
+
+def verify_copy(src, dst, batch_size=500, workers=4):
+    """
+    check every key in src has the same value in dst, comparing digests.
+    :return: dict of keys checked, missing from dst and with a different
+        value, with up to 100 of the bad keys
+    """
+    src = connect(src) if isinstance(src, str) else src
+    dst = connect(dst) if isinstance(dst, str) else dst
+    lock = threading.Lock()
+    result = {'checked': 0, 'missing': 0, 'different': 0, 'bad_keys': []}
+
+    def check_batch(keys):
+        expected = {key: _digest(value)
+                    for key, value in src.get_multi(keys).items()}
+        actual = {key: _digest(value)
+                  for key, value in dst.get_multi(keys).items()}
+        missing = [key for key in expected if key not in actual]
+        different = [key for key in expected
+                     if key in actual and actual[key] != expected[key]]
+        return len(expected), missing, different
+
+    def done(seq, keys, counts):
+        checked, missing, different = counts
+        with lock:
+            result['checked'] += checked
+            result['missing'] += len(missing)
+            result['different'] += len(different)
+            room = 100 - len(result['bad_keys'])
+            result['bad_keys'].extend((missing + different)[:room])
+
+    pipeline(chunks(src.ids(), batch_size), check_batch, int(workers), done)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='floe-copy', description='copy one floe domain to another')
+    parser.add_argument('src', help='domain to copy from')
+    parser.add_argument('dst', help='domain to copy to')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='most keys per second, 0 for no limit')
+    parser.add_argument('--checkpoint',
+                        help='file to record progress in and resume from')
+    parser.add_argument('--verify', action='store_true',
+                        help='compare every value once copied')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    result = copy(args.src, args.dst, batch_size=args.batch_size,
+                  workers=args.workers, rate=args.rate,
+                  checkpoint=args.checkpoint, verify=args.verify)
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    if args.verify and (result['verify']['missing'] or
+                        result['verify']['different']):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
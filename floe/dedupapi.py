@@ -0,0 +1,218 @@
+import base64
+import hashlib
+import struct
+import threading
+from .helpers import sanitize_key, chunks, current_time
+from .exceptions import FloeReadException
+
+# values stored in the wrapped floe start with MAGIC and a type byte. a REF
+# is followed by the digest of a blob, an INLINE by the raw value. values
+# without the prefix are raw values stored before dedup was turned on.
+MAGIC = b'\xfe\xf1\x0d'
+REF = b'R'
+INLINE = b'I'
+
+# every blob starts with the time it was last written, in milliseconds
+BLOB_HEADER = struct.Struct('>Q')
+
+DIGEST_SIZE = 24
+
+# forget the known digests once there are this many, so the cache is bounded
+KNOWN_DIGESTS_PRUNE_SIZE = 100000
+
+GC_BATCH_SIZE = 1000
+
+
+def digest(value):
+    """
+    the blob key for a value: a 24 byte blake2b hash as 32 characters of
+    unpadded base64url, which is a valid floe key.
+    """
+    h = hashlib.blake2b(value, digest_size=DIGEST_SIZE).digest()
+    return base64.urlsafe_b64encode(h).decode('ascii')
+
+
+class DedupFloe(object):
+    """
+    Wraps a floe so identical values are stored once. Each value is kept in
+    a separate blob floe under its content hash, and the wrapped floe only
+    holds a short reference per key. Orphaned blobs are removed by
+    collect_garbage().
+    """
+
+    def __init__(self, backend, blobs, min_size=128, grace=3600):
+        """
+        :param backend: the floe holding the references
+        :param blobs: the floe holding the blobs. it should not be shared
+            with another dedup domain, since flush and collect_garbage only
+            know about the references in this one.
+        :param min_size: values smaller than this are stored inline
+        :param grace: seconds a blob is kept after it was last written
+            even when nothing references it, so a set racing with
+            collect_garbage never loses its blob
+        """
+        self.backend = backend
+        self.blobs = blobs
+        self.min_size = int(min_size)
+        self.grace = float(grace)
+        self._known = {}
+        self._lock = threading.Lock()
+        self._stats = {'blobs_written': 0, 'blobs_skipped': 0,
+                       'bytes_skipped': 0, 'inline': 0}
+
+    def _count(self, **counters):
+        with self._lock:
+            for counter, value in counters.items():
+                self._stats[counter] += value
+
+    def stats(self):
+        """
+        how many blobs were written, how many writes were skipped because
+        the blob was already stored, the bytes those skips saved, and how
+        many values were small enough to store inline.
+        :return: dict
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _is_known(self, key, now):
+        # a blob this process wrote less than grace/2 ago is still safe from
+        # collect_garbage, so it doesn't need writing again. after that it
+        # is rewritten to refresh its timestamp.
+        with self._lock:
+            written = self._known.get(key)
+            return written is not None and now - written < self.grace / 2
+
+    def _remember(self, keys, now):
+        with self._lock:
+            if len(self._known) > KNOWN_DIGESTS_PRUNE_SIZE:
+                self._known.clear()
+            for key in keys:
+                self._known[key] = now
+
+    def _encode(self, mapping):
+        """
+        turn a mapping of values into the references to store and the blobs
+        that need writing.
+        """
+        now = current_time()
+        refs, blobs = {}, {}
+        header = BLOB_HEADER.pack(int(now * 1000))
+        for key, value in mapping.items():
+            key = sanitize_key(key)
+            if len(value) < self.min_size:
+                if bytes(value[:len(MAGIC)]) == MAGIC:
+                    value = MAGIC + INLINE + bytes(value)
+                refs[key] = value
+                self._count(inline=1)
+                continue
+
+            blob_key = digest(value)
+            refs[key] = MAGIC + REF + blob_key.encode('ascii')
+            if blob_key in blobs:
+                self._count(blobs_skipped=1, bytes_skipped=len(value))
+            elif self._is_known(blob_key, now):
+                self._count(blobs_skipped=1, bytes_skipped=len(value))
+            else:
+                blobs[blob_key] = header + value
+        return refs, blobs
+
+    def _blob_key(self, value):
+        if value is None or bytes(value[:len(MAGIC)]) != MAGIC:
+            return None
+        if bytes(value[len(MAGIC):len(MAGIC) + 1]) == REF:
+            return bytes(value[len(MAGIC) + 1:]).decode('ascii')
+        return None
+
+    def _decode(self, value, blobs):
+        if value is None or bytes(value[:len(MAGIC)]) != MAGIC:
+            return value
+        kind = bytes(value[len(MAGIC):len(MAGIC) + 1])
+        if kind == INLINE:
+            return bytes(value[len(MAGIC) + 1:])
+        if kind != REF:
+            raise FloeReadException('invalid dedup record')
+        blob = blobs.get(bytes(value[len(MAGIC) + 1:]).decode('ascii'))
+        if blob is None:
+            raise FloeReadException('missing blob')
+        return blob[BLOB_HEADER.size:]
+
+    def get(self, key):
+        value = self.backend.get(key)
+        blob_key = self._blob_key(value)
+        blobs = {}
+        if blob_key is not None:
+            blobs = {blob_key: self.blobs.get(blob_key)}
+        return self._decode(value, blobs)
+
+    def get_multi(self, keys):
+        values = self.backend.get_multi(keys)
+        blob_keys = {self._blob_key(value) for value in values.values()}
+        blob_keys.discard(None)
+        blobs = self.blobs.get_multi(list(blob_keys)) if blob_keys else {}
+        return {key: self._decode(value, blobs)
+                for key, value in values.items()}
+
+    def set(self, key, bin_data):
+        return self.set_multi({key: bin_data})
+
+    def set_multi(self, mapping):
+        """
+        write any blobs that aren't already known to be stored, then the
+        references to them.
+        :param mapping:
+        :return:
+        """
+        refs, blobs = self._encode(mapping)
+        if blobs:
+            now = current_time()
+            self.blobs.set_multi(blobs)
+            self._remember(blobs.keys(), now)
+            self._count(blobs_written=len(blobs))
+        if refs:
+            self.backend.set_multi(refs)
+
+    def delete(self, key):
+        return self.backend.delete(key)
+
+    def delete_multi(self, keys):
+        return self.backend.delete_multi(keys)
+
+    def ids(self, *args, **kwargs):
+        return self.backend.ids(*args, **kwargs)
+
+    def flush(self):
+        self.backend.flush()
+        self.blobs.flush()
+        with self._lock:
+            self._known.clear()
+
+    def collect_garbage(self):
+        """
+        mark every blob referenced by a key, then delete the blobs nothing
+        references that were last written more than grace seconds before
+        the mark started.
+        :return: number of blobs deleted
+        """
+        mark_start = current_time()
+        marked = set()
+        for batch in chunks(self.backend.ids(), GC_BATCH_SIZE):
+            for value in self.backend.get_multi(batch).values():
+                blob_key = self._blob_key(value)
+                if blob_key is not None:
+                    marked.add(blob_key)
+
+        cutoff = int((mark_start - self.grace) * 1000)
+        deleted = 0
+        for batch in chunks(self.blobs.ids(), GC_BATCH_SIZE):
+            candidates = [key for key in batch if key not in marked]
+            if not candidates:
+                continue
+            expired = [
+                key for key, blob in self.blobs.get_multi(candidates).items()
+                if BLOB_HEADER.unpack(bytes(blob[:BLOB_HEADER.size]))[0]
+                < cutoff]
+            if expired:
+                self.blobs.delete_multi(expired)
+                deleted += len(expired)
+        return deleted
@@ -1,38 +1,233 @@
 import os
 import errno
-import shutil
 import re
-from .exceptions import FloeWriteException
-from .helpers import sanitize_key
+import uuid
+import logging
+import mmap
+import json
+import time
+import hashlib
+import queue
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .exceptions import FloeWriteException, FloeReadException, \
+    FloeDeleteException, FloeConfigurationException
+from .helpers import sanitize_key, chunks, to_bool
+from .otel_instrumentation import instrument_backend, propagate_context
+from .sqliteapi import SQLiteFloe
 
+logger = logging.getLogger(__name__)
 
+LAYOUT_FILE = '.layout'
+MANIFEST_FILE = '.manifest.db'
+TRASH_DIR = '.trash'
+DATA_DIR_PREFIX = '.data-'
+PREFIX_LAYOUT = {'layout': 'prefix'}
+FILE_PATTERN = re.compile(r'^([A-Za-z0-9_\-\.]+)\.bin$')
+HEX_CHARS = frozenset('0123456789abcdef')
+
+
+def make_layout(layout='prefix', depth=2, width=2):
+    """
+    build the description of a directory layout for FileFloe.
+    the prefix layout nests files under the first 2, 4 and 6 characters of
+    the key. the hash layout nests them `depth` directories deep, each
+    named with the next `width` hex digits of the md5 of the key.
+    """
+    if layout == 'prefix':
+        return dict(PREFIX_LAYOUT)
+
+    if layout != 'hash':
+        raise FloeConfigurationException('invalid layout %s' % layout)
+
+    depth, width = int(depth), int(width)
+    if depth < 1 or width < 1 or depth * width > 32:
+        raise FloeConfigurationException(
+            'invalid hash layout depth=%s width=%s' % (depth, width))
+    return {'layout': 'hash', 'depth': depth, 'width': width}
+
+
+@instrument_backend('file')
 class FileFloe(object):
     """
     An implementation of cold storage for hbom.
     """
 
-    def __init__(self, directory):
+    def __init__(self, directory, pool_size=0, mmap_threshold=0,
+                 layout=None, depth=2, width=2, manifest=False,
+                 scan_threads=8, reap_rate=2000, durable=False):
         """
-        specify the directory of where the data is stored
+        specify the directory of where the data is stored.
+        when pool_size is more than 1, the multi operations spread their
+        keys over a pool of that many threads so the file i/o overlaps.
+        when mmap_threshold is set, get returns a read-only memoryview over
+        an mmap of the file for values of at least that many bytes instead
+        of copying them into memory.
+        the directory layout is read from the layout file in the directory.
+        a new directory uses the layout passed in, see make_layout, and
+        without one it falls back to the original prefix layout.
+        with manifest on, every key is also recorded in a sqlite database
+        in the directory, and ids() reads it in key order instead of
+        crawling the tree. otherwise ids() crawls the top level directories
+        on scan_threads threads at once.
+        flush points the layout file at a new empty data directory and
+        moves the old one into a trash directory, where a background thread
+        deletes it at no more than reap_rate files per second (0 for no
+        limit), picking up where it left off if the process restarted.
+        with durable on, values are written to a synced temp file and
+        renamed into place, so a crash or a concurrent reader never sees a
+        partial value.
         """
         self.dir = directory
+        self.pool_size = int(pool_size)
+        self.mmap_threshold = int(mmap_threshold)
+        self.durable = to_bool(durable)
+        self._pool = None
 
-    def _resolve_path(self, key):
-        parts = [self.dir]
-        length = len(key)
-        if length > 2:
-            parts.append(key[0:2])
+        self._layout = PREFIX_LAYOUT
+        self._previous_layout = None
+        self._layout_version = None
+        # the directory the keys live under. a store that was never flushed
+        # keeps them directly in self.dir
+        self._root_name = None
+        self._root = self.dir
+        self._load_layout()
+
+        if layout:
+            layout = make_layout(layout, depth, width)
+            if layout != self._layout:
+                if self._layout_version is not None or self._has_data():
+                    raise FloeConfigurationException(
+                        '%s uses the %s layout, use migrate_layout to '
+                        'change it' % (self.dir, self._layout['layout']))
+                self._write_layout(layout)
+
+        self.scan_threads = int(scan_threads)
+        self.reap_rate = int(reap_rate)
+        self._reaper = None
+        self._reaper_lock = threading.Lock()
+        self._reap_again = False
+        self._manifest = None
+        if to_bool(manifest):
+            path = os.path.join(self.dir, MANIFEST_FILE)
+            rebuild = not os.path.exists(path) and self._has_data()
+            self._mkdirs(self.dir)
+            self._manifest = SQLiteFloe(path, table='manifest')
+            if rebuild:
+                self.rebuild_manifest()
+
+        try:
+            if os.listdir(os.path.join(self.dir, TRASH_DIR)):
+                self._start_reaper()
+        except OSError:
+            pass
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.pool_size)
+        return self._pool
 
-        if length > 4:
-            parts.append(key[2:4])
+    def _map(self, func, items):
+        if self.pool_size > 1 and len(items) > 1:
+            return list(self.pool.map(propagate_context(func), items))
+        return [func(item) for item in items]
 
-        if length > 6:
-            parts.append(key[4:6])
+    def _layout_path(self, layout, key):
+        parts = [self._root]
+        if layout['layout'] == 'hash':
+            digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+            width = layout['width']
+            for i in range(0, layout['depth']):
+                parts.append(digest[i * width:(i + 1) * width])
+        else:
+            length = len(key)
+            if length > 2:
+                parts.append(key[0:2])
+
+            if length > 4:
+                parts.append(key[2:4])
+
+            if length > 6:
+                parts.append(key[4:6])
 
         parts.append("%s.bin" % key)
 
         return os.path.join(*parts)
 
+    def _resolve_path(self, key):
+        return self._layout_path(self._layout, key)
+
+    def _read_paths(self, key):
+        path = self._resolve_path(key)
+        if self._previous_layout is None:
+            return [path]
+
+        # while a migration runs the file may be in either place. look in
+        # the new place a second time in case it moved while we looked.
+        return [path, self._layout_path(self._previous_layout, key), path]
+
+    def _has_data(self):
+        try:
+            return any(not name.startswith('.')
+                       for name in os.listdir(self._root))
+        except OSError:
+            return False
+
+    def _load_layout(self):
+        """
+        re-read the layout file if it changed since we last looked.
+        returns True when the layout changed.
+        """
+        path = os.path.join(self.dir, LAYOUT_FILE)
+        try:
+            stat = os.stat(path)
+            version = (stat.st_ino, stat.st_mtime_ns)
+        except OSError:
+            version = None
+
+        if version == self._layout_version:
+            return False
+
+        if version is None:
+            self._layout, self._previous_layout = PREFIX_LAYOUT, None
+            root = None
+        else:
+            try:
+                with open(path, 'r') as fp:
+                    config = json.load(fp)
+            except (OSError, IOError, ValueError):
+                return False
+            previous = config.pop('previous', None)
+            root = config.pop('root', None)
+            self._layout = make_layout(**config)
+            self._previous_layout = make_layout(**previous) \
+                if previous else None
+
+        self._root_name = root
+        self._root = os.path.join(self.dir, root) if root else self.dir
+
+        self._layout_version = version
+        return True
+
+    def _write_layout(self, layout, previous=None, root=None):
+        """
+        replace the layout file. root defaults to the current data dir.
+        """
+        config = dict(layout)
+        if previous is not None:
+            config['previous'] = previous
+        root = root or self._root_name
+        if root:
+            config['root'] = root
+        self._mkdirs(self.dir)
+        # a temp file of its own, as flushes in other processes may be
+        # writing the layout at the same time
+        self._replace(os.path.join(self.dir, LAYOUT_FILE),
+                      json.dumps(config).encode('utf-8'))
+        self._load_layout()
+
     @classmethod
     def _mkdirs(cls, dir_name):
         # there's a race condition where the directory doesn't exist
@@ -54,12 +249,61 @@ class FileFloe(object):
         :return:
         """
         key = sanitize_key(key)
+        fp = self._open_value(key, 'rb+')
+        if fp is None:
+            return None
         try:
-            with open(self._resolve_path(key), 'rb+') as fp:
+            with fp:
+                if self.mmap_threshold and \
+                        os.fstat(fp.fileno()).st_size >= self.mmap_threshold:
+                    return memoryview(mmap.mmap(fp.fileno(), 0,
+                                                access=mmap.ACCESS_READ))
                 return fp.read()
         except (OSError, IOError):
             return None
 
+    def _open_value(self, key, mode, buffering=-1):
+        for _ in range(0, 2):
+            for path in self._read_paths(key):
+                try:
+                    return open(path, mode, buffering=buffering)
+                except (OSError, IOError):
+                    continue
+            # another process may have switched the layout under us
+            if not self._load_layout():
+                break
+        return None
+
+    def get_into(self, key, buffer):
+        """
+        read the value of a given key into a writable buffer such as a
+        bytearray or memoryview, without allocating a copy of it.
+        :param key:
+        :param buffer:
+        :return: the number of bytes read, or None if the key is missing
+        """
+        key = sanitize_key(key)
+        view = memoryview(buffer).cast('B')
+        fp = self._open_value(key, 'rb', buffering=0)
+        if fp is None:
+            return None
+        try:
+            with fp:
+                size = os.fstat(fp.fileno()).st_size
+                if size > len(view):
+                    raise FloeReadException(
+                        'value of %s is %s bytes, buffer holds %s' % (
+                            key, size, len(view)))
+                read = 0
+                while read < size:
+                    count = fp.readinto(view[read:size])
+                    if not count:
+                        break
+                    read += count
+                return read
+        except (OSError, IOError):
+            return None
+
     def get_multi(self, keys):
         """
         get the values for a list of keys as a dictionary.
@@ -71,8 +315,11 @@ class FileFloe(object):
         if not keys:
             return {}
         keys = [sanitize_key(key) for key in keys]
-        result = {k: self.get(k) for k in keys}
-        return {k: v for k, v in result.items() if v is not None}
+
+        def _get(key):
+            return key, self.get(key)
+
+        return {k: v for k, v in self._map(_get, keys) if v is not None}
 
     def set(self, key, bin_data):
         """
@@ -82,13 +329,127 @@ class FileFloe(object):
         :return:
         """
         key = sanitize_key(key)
-        path = self._resolve_path(key)
-        self._mkdirs(os.path.dirname(path))
+        self._store({key: bin_data})
+        if self._manifest is not None:
+            self._manifest.set(key, b'')
+
+    def _store(self, mapping):
+        if not self.durable:
+            def _set(row):
+                self._write(*row)
+
+            self._map(_set, list(mapping.items()))
+            return
+
+        staged = []
+
+        def _stage(row):
+            staged.append(self._stage(*row))
+
+        try:
+            self._map(_stage, list(mapping.items()))
+        except BaseException:
+            for _, _, tmp_path in staged:
+                self._unlink(tmp_path)
+            raise
+        self._commit(staged)
+
+    def _in_place(self, key, write):
+        """
+        call write with the path of a key once its directory exists, again
+        with the new path if a flush moved the data dir away meanwhile.
+        """
+        self._load_layout()
+        for attempt in range(0, 2):
+            path = self._resolve_path(key)
+            try:
+                self._mkdirs(os.path.dirname(path))
+                return path, write(path)
+            except (IOError, OSError) as e:
+                if attempt or not self._load_layout():
+                    raise FloeWriteException(e)
+
+    def _write(self, key, bin_data):
+        def write(path):
+            if self.mmap_threshold:
+                # a reader may have the old file mapped, and truncating it
+                # in place would crash them, so swap in a new file instead.
+                self._replace(path, bin_data)
+            else:
+                with open(path, 'wb+', buffering=0) as fp:
+                    self._write_all(fp, bin_data)
+
+        self._in_place(key, write)
+
+        if self._previous_layout is not None:
+            self._unlink(self._layout_path(self._previous_layout, key))
+
+    def _stage(self, key, bin_data):
+        """
+        write a value to a synced temp file next to where it belongs.
+        nothing is visible to readers until _commit renames it into place.
+        """
+        path, tmp_path = self._in_place(
+            key, lambda path: self._write_temp(path, bin_data, sync=True))
+        return key, path, tmp_path
+
+    def _commit(self, staged):
+        # the renames only need one directory fsync per directory touched,
+        # however many files landed in it.
+        dirs = set()
+        try:
+            for key, path, tmp_path in staged:
+                os.replace(tmp_path, path)
+                dirs.add(os.path.dirname(path))
+            for dir_name in dirs:
+                self._fsync_dir(dir_name)
+        except OSError as e:
+            for _, _, tmp_path in staged:
+                self._unlink(tmp_path)
+            raise FloeWriteException(e)
+
+        if self._previous_layout is not None:
+            for key, _, _ in staged:
+                self._unlink(self._layout_path(self._previous_layout, key))
+
+    @classmethod
+    def _fsync_dir(cls, dir_name):
+        fd = os.open(dir_name, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def _write_all(cls, fp, bin_data):
+        # unbuffered writes straight from the caller's buffer, so bytearray
+        # and memoryview values are written without an intermediate copy.
+        view = memoryview(bin_data).cast('B')
+        while view:
+            view = view[fp.write(view):]
+
+    @classmethod
+    def _write_temp(cls, path, bin_data, sync=False):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        prefix='.', suffix='.tmp')
+        try:
+            with open(fd, 'wb', buffering=0) as fp:
+                cls._write_all(fp, bin_data)
+                if sync:
+                    os.fsync(fp.fileno())
+        except BaseException:
+            cls._unlink(tmp_path)
+            raise
+        return tmp_path
+
+    @classmethod
+    def _replace(cls, path, bin_data):
+        tmp_path = cls._write_temp(path, bin_data)
         try:
-            with open(path, 'wb+') as fp:
-                fp.write(bin_data)
-        except (IOError):
-            raise FloeWriteException()
+            os.replace(tmp_path, path)
+        except BaseException:
+            cls._unlink(tmp_path)
+            raise
 
     def set_multi(self, mapping):
         """
@@ -97,9 +458,9 @@ class FileFloe(object):
         :return:
         """
         mapping = {sanitize_key(key): value for key, value in mapping.items()}
-
-        for key, value in mapping.items():
-            self.set(key, value)
+        self._store(mapping)
+        if self._manifest is not None:
+            self._manifest.set_multi({key: b'' for key in mapping})
 
     def delete(self, key):
         """
@@ -107,11 +468,20 @@ class FileFloe(object):
         :param key:
         :return:
         """
-        key = sanitize_key(key)
+        self.delete_multi([key])
+
+    def _remove(self, key):
+        self._load_layout()
+        return {os.path.dirname(path) for path in set(self._read_paths(key))
+                if self._unlink(path)}
+
+    @classmethod
+    def _unlink(cls, path):
         try:
-            os.unlink(self._resolve_path(key))
+            os.unlink(path)
+            return True
         except OSError:
-            pass
+            return False
 
     def delete_multi(self, keys):
         """
@@ -120,36 +490,301 @@ class FileFloe(object):
         :return:
         """
         keys = [sanitize_key(key) for key in keys]
-
-        for key in keys:
-            self.delete(key)
+        dirs = set().union(*self._map(self._remove, keys))
+        if self.durable:
+            try:
+                for dir_name in dirs:
+                    self._fsync_dir(dir_name)
+            except OSError as e:
+                raise FloeDeleteException(e)
+        if self._manifest is not None:
+            self._manifest.delete_multi(keys)
 
     def flush(self):
         """
-        remove all keys from a given database
+        remove all keys from a given database.
+        the layout file is pointed at a new empty data dir in one rename, so
+        every key is gone at once. the old data dir is renamed into the
+        trash directory, so this returns right away and the files are
+        deleted in the background. another instance that last looked at
+        the layout before the flush sees every key until the old dir is
+        moved, then none. the first flush of a store written before data
+        dirs existed moves its top level dirs one at a time, so such an
+        instance can see them go one by one.
         :return:
         """
+        self._load_layout()
+        root = '%s%s' % (DATA_DIR_PREFIX, uuid.uuid4().hex)
+        try:
+            self._mkdirs(os.path.join(self.dir, root))
+            self._write_layout(self._layout, previous=self._previous_layout,
+                               root=root)
+        except OSError as e:
+            raise FloeDeleteException(e)
+
+        # everything but the data dir the layout now names goes, which also
+        # picks up the dir of a flush that raced this one and lost
+        self._load_layout()
+        trash = os.path.join(self.dir, TRASH_DIR, '%d-%s' % (
+            time.time() * 1000, uuid.uuid4().hex[0:8]))
         try:
-            for subdir in os.listdir(self.dir):
-                shutil.rmtree(os.path.join(self.dir, subdir),
-                              ignore_errors=True)
+            names = [name for name in os.listdir(self.dir)
+                     if name != self._root_name and
+                     (name.startswith(DATA_DIR_PREFIX) or
+                      not name.startswith('.'))]
         except OSError:
-            pass
+            names = []
+
+        if names:
+            for name in names:
+                self._move_to_trash(trash, name)
+            self._start_reaper()
+
+        if self._manifest is not None:
+            self._manifest.flush()
+
+    def _move_to_trash(self, trash, name):
+        """
+        rename a top level entry into this flush's trash dir, making the
+        dir again if a reaper removed it while it was still empty.
+        """
+        source = os.path.join(self.dir, name)
+        for attempt in range(0, 3):
+            try:
+                self._mkdirs(trash)
+                os.rename(source, os.path.join(trash, name))
+                return
+            except OSError as e:
+                # anything else, or a source that is already gone, means
+                # another flush got there first
+                if e.errno != errno.ENOENT or not os.path.exists(source):
+                    return
+                if attempt == 2:
+                    raise FloeDeleteException(e)
+
+    def _start_reaper(self):
+        with self._reaper_lock:
+            if self._reaper is not None and self._reaper.is_alive():
+                self._reap_again = True
+                return
+            self._reap_again = False
+            self._reaper = threading.Thread(target=self._background_reap,
+                                            daemon=True)
+            self._reaper.start()
+
+    def _background_reap(self):
+        while True:
+            try:
+                self.reap()
+            except Exception as e:
+                logger.exception("Reaping %s failed: %s", self.dir, e)
+            with self._reaper_lock:
+                if not self._reap_again:
+                    return
+                self._reap_again = False
+
+    def reap(self):
+        """
+        delete everything in the trash directory left behind by flush,
+        pausing as needed to stay under reap_rate deletes per second.
+        :return:
+        """
+        trash = os.path.join(self.dir, TRASH_DIR)
+        pause = 100.0 / self.reap_rate if self.reap_rate > 0 else 0
+        count = 0
+        for root, dirs, files in os.walk(trash, topdown=False):
+            for f in files:
+                self._unlink(os.path.join(root, f))
+                count += 1
+                if pause and count % 100 == 0:
+                    time.sleep(pause)
+            # the trash dir itself stays, so a flush making its own dir in
+            # it never finds it gone
+            if root == trash:
+                continue
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
 
-    def ids(self):
+    def ids(self, after=None):
         """
         return a generator that iterates through all ids in cold storage
         no particular order. useful for a script to crawl through stuff that
         has been frozen and thaw it.
+        with the manifest on, the ids come back in key order and passing
+        the last id seen as `after` resumes an interrupted crawl.
+        :param after:
         :return:
         """
-        pattern = re.compile(r'^([A-Za-z0-9_\-\.]+)\.bin$')
+        if self._manifest is not None:
+            return self._manifest.ids(after=after)
+        if after is not None:
+            raise FloeConfigurationException(
+                'resuming ids needs the manifest on %s' % self.dir)
+        return self._scan()
+
+    def _scan(self):
+        """
+        crawl the directory tree with one thread per top level directory,
+        yielding keys as soon as any of them finds some.
+        """
+        self._load_layout()
         try:
-            for info in os.walk(self.dir):
-                for f in info[2]:
-                    match = pattern.match(f)
-                    if not match:
-                        continue
-                    yield match.group(1)
+            tops = [entry.path for entry in os.scandir(self._root)
+                    if not entry.name.startswith('.')]
         except OSError:
-            pass
+            return
+
+        found = queue.Queue(maxsize=self.scan_threads * 4)
+        stop = threading.Event()
+        done = object()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    found.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def _crawl(paths):
+            try:
+                for path in paths:
+                    self._scan_tree(path, _put, stop)
+            finally:
+                _put(done)
+
+        workers = max(1, min(self.scan_threads, len(tops)))
+        threads = [threading.Thread(target=_crawl, args=(tops[i::workers],),
+                                    daemon=True)
+                   for i in range(0, workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            running = workers
+            while running:
+                keys = found.get()
+                if keys is done:
+                    running -= 1
+                    continue
+                for key in keys:
+                    yield key
+        finally:
+            stop.set()
+
+    @classmethod
+    def _scan_tree(cls, path, emit, stop):
+        if not os.path.isdir(path):
+            match = FILE_PATTERN.match(os.path.basename(path))
+            if match:
+                emit([match.group(1)])
+            return
+
+        stack = [path]
+        while stack and not stop.is_set():
+            keys = []
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        if entry.name.startswith('.'):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                            continue
+                        match = FILE_PATTERN.match(entry.name)
+                        if match:
+                            keys.append(match.group(1))
+            except OSError:
+                continue
+            if keys:
+                emit(keys)
+
+    def rebuild_manifest(self):
+        """
+        re-create the manifest from the files on disk. run it when turning
+        the manifest on for a directory written without it, or to repair
+        it after a crash between writing a file and recording it.
+        """
+        if self._manifest is None:
+            raise FloeConfigurationException(
+                'manifest is not enabled on %s' % self.dir)
+        self._manifest.flush()
+        for keys in chunks(self._scan(), 1000):
+            self._manifest.set_multi({key: b'' for key in keys})
+
+    def migrate_layout(self, layout, depth=2, width=2, settle=1.0):
+        """
+        re-shard the directory into a new layout in place. reads keep
+        working while it runs because they fall back to the old layout, and
+        writes from any process land in the new one as soon as it has
+        noticed the layout file changed. a second pass after `settle`
+        seconds picks up anything written the old way in the meantime.
+        an interrupted migration can be resumed by running it again.
+        :param layout: 'prefix' or 'hash'
+        :param depth:
+        :param width:
+        :param settle:
+        :return: the number of files moved
+        """
+        target = make_layout(layout, depth, width)
+        self._load_layout()
+        if target == self._layout and self._previous_layout is None:
+            return 0
+
+        source = self._previous_layout or self._layout
+        self._write_layout(target, previous=source)
+        moved = self._relayout()
+        time.sleep(float(settle))
+        moved += self._relayout()
+        self._write_layout(target)
+        self._prune_dirs()
+        return moved
+
+    def _relayout(self):
+        moved = 0
+        for root, dirs, files in os.walk(self._root):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for f in files:
+                match = FILE_PATTERN.match(f)
+                if not match:
+                    continue
+                path = os.path.join(root, f)
+                dest = self._resolve_path(match.group(1))
+                if path == dest:
+                    continue
+                try:
+                    self._mkdirs(os.path.dirname(dest))
+                    # a writer that hadn't noticed the switch yet may have
+                    # left the newer copy in the old place.
+                    if os.path.exists(dest) and os.stat(dest).st_mtime_ns >= \
+                            os.stat(path).st_mtime_ns:
+                        os.unlink(path)
+                    else:
+                        os.replace(path, dest)
+                        moved += 1
+                except OSError:
+                    continue
+        return moved
+
+    def _prune_dirs(self):
+        layout = self._layout
+        for root, dirs, files in os.walk(self._root, topdown=False):
+            if root == self._root or files:
+                continue
+            parts = os.path.relpath(root, self._root).split(os.sep)
+            if parts[0].startswith('.'):
+                continue
+            if layout['layout'] == 'hash':
+                keep = len(parts) <= layout['depth'] and all(
+                    len(p) == layout['width'] and HEX_CHARS.issuperset(p)
+                    for p in parts)
+            else:
+                keep = len(parts) <= 3 and all(len(p) == 2 for p in parts)
+            if keep:
+                continue
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
@@ -0,0 +1,544 @@
+import os
+import errno
+import json
+import logging
+import struct
+import threading
+import zlib
+from .exceptions import FloeWriteException, FloeReadException, \
+    FloeDeleteException
+from .helpers import sanitize_key, to_bool
+
+logger = logging.getLogger(__name__)
+
+# crc32, flags, key length, value length
+RECORD_HEADER = struct.Struct('>IBHI')
+
+# flags, key length, value offset, value length
+HINT_HEADER = struct.Struct('>BHQI')
+
+FLAG_TOMBSTONE = 1
+
+DATA_SUFFIX = '.data'
+HINT_SUFFIX = '.hint'
+TMP_SUFFIX = '.tmp'
+MERGE_MANIFEST = 'MERGE'
+
+
+def _checksum(flags, key, value):
+    crc = zlib.crc32(struct.pack('>BHI', flags, len(key), len(value)))
+    crc = zlib.crc32(key, crc)
+    return zlib.crc32(value, crc)
+
+
+class FileLogFloe(object):
+    """
+    A log-structured implementation of cold storage for hbom.
+
+    Every write is appended to the active segment file in the directory and
+    an in-memory key directory maps each key to the segment, offset and
+    length of its latest value, so a read is a single positioned read.
+    When the active segment grows past `max_segment_size` it is closed,
+    a hint file listing its records is written next to it, and a new
+    segment is started. On startup the key directory is rebuilt from the
+    hint files, only scanning segments that don't have one.
+
+    Overwritten and deleted records are reclaimed by merging all the
+    closed segments into one. This runs in a background thread whenever
+    the fraction of dead bytes in closed segments passes
+    `compact_threshold`, or on demand by calling `compact`.
+
+    The key directory lives in this process, so only one process should
+    write to a given directory at a time.
+    """
+
+    def __init__(self, directory, max_segment_size=64 * 1024 * 1024,
+                 compact_threshold=0.5, sync=False):
+        """
+        specify the directory of where the segments are stored
+        """
+        self.dir = directory
+        self.max_segment_size = int(max_segment_size)
+        self.compact_threshold = float(compact_threshold)
+        self.sync = to_bool(sync)
+
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._compactor = None
+        self._epoch = 0
+
+        self._index = {}
+        self._sizes = {}
+        self._dead = {}
+        self._readers = {}
+        self._active = None
+        self._active_fd = None
+        self._active_hints = bytearray()
+
+        self._mkdirs(self.dir)
+        with self._lock:
+            self._load()
+
+    @classmethod
+    def _mkdirs(cls, dir_name):
+        if os.path.exists(dir_name):
+            return
+        try:
+            os.makedirs(dir_name)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, segment, suffix):
+        return os.path.join(self.dir, "%010d%s" % (segment, suffix))
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.dir):
+            if not name.endswith(DATA_SUFFIX):
+                continue
+            try:
+                segments.append(int(name[:-len(DATA_SUFFIX)]))
+            except ValueError:
+                continue
+        return sorted(segments)
+
+    def _load(self):
+        self._recover_merge()
+        segments = self._segments()
+
+        for segment in segments:
+            if os.path.exists(self._path(segment, HINT_SUFFIX)):
+                self._load_hints(segment)
+            else:
+                hints = self._scan_segment(segment)
+                if segment == segments[-1]:
+                    self._open_active(segment, hints)
+                else:
+                    self._write_hints(segment, hints)
+
+        if self._active is None:
+            self._open_active(segments[-1] + 1 if segments else 0)
+
+    def _recover_merge(self):
+        """
+        finish a compaction that was interrupted after its output was
+        complete, and throw away the leftovers of any that wasn't.
+        """
+        manifest = os.path.join(self.dir, MERGE_MANIFEST)
+        try:
+            with open(manifest, 'r') as fp:
+                plan = json.load(fp)
+        except (IOError, OSError, ValueError):
+            plan = None
+
+        if plan:
+            target = plan['target']
+            for suffix in (DATA_SUFFIX, HINT_SUFFIX):
+                path = self._path(target, suffix)
+                if os.path.exists(path + TMP_SUFFIX):
+                    os.replace(path + TMP_SUFFIX, path)
+            for segment in plan['remove']:
+                self._unlink_segment(segment)
+
+        for name in os.listdir(self.dir):
+            if name.endswith(TMP_SUFFIX) or name == MERGE_MANIFEST:
+                self._unlink(os.path.join(self.dir, name))
+
+    def _load_hints(self, segment):
+        data_path = self._path(segment, DATA_SUFFIX)
+        self._sizes[segment] = os.path.getsize(data_path)
+        self._dead.setdefault(segment, 0)
+        with open(self._path(segment, HINT_SUFFIX), 'rb') as fp:
+            data = fp.read()
+
+        pos = 0
+        while pos + HINT_HEADER.size <= len(data):
+            flags, key_len, offset, value_len = \
+                HINT_HEADER.unpack_from(data, pos)
+            pos += HINT_HEADER.size
+            key = data[pos:pos + key_len].decode('utf-8')
+            pos += key_len
+            self._apply(segment, flags, key, offset, value_len)
+
+    def _scan_segment(self, segment):
+        """
+        rebuild the key directory from the records of a segment that has no
+        hint file, truncating a torn record left at the end by a crash.
+        returns the hints for the segment.
+        """
+        path = self._path(segment, DATA_SUFFIX)
+        hints = bytearray()
+        offset = 0
+        self._dead.setdefault(segment, 0)
+        with open(path, 'rb') as fp:
+            while True:
+                header = fp.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                crc, flags, key_len, value_len = RECORD_HEADER.unpack(header)
+                body = fp.read(key_len + value_len)
+                if len(body) < key_len + value_len:
+                    break
+                key, value = body[:key_len], body[key_len:]
+                if crc != _checksum(flags, key, value):
+                    break
+
+                value_offset = offset + RECORD_HEADER.size + key_len
+                hints += HINT_HEADER.pack(flags, key_len, value_offset,
+                                          value_len) + key
+                self._apply(segment, flags, key.decode('utf-8'),
+                            value_offset, value_len)
+                offset = value_offset + value_len
+
+        if offset < os.path.getsize(path):
+            logger.warning("Truncating torn segment %s at %s", path, offset)
+            with open(path, 'rb+') as fp:
+                fp.truncate(offset)
+
+        self._sizes[segment] = offset
+        return hints
+
+    def _apply(self, segment, flags, key, offset, value_len):
+        record_size = RECORD_HEADER.size + len(key) + value_len
+        old = self._index.pop(key, None)
+        if old is not None:
+            self._dead[old[0]] += RECORD_HEADER.size + len(key) + old[2]
+
+        if flags & FLAG_TOMBSTONE:
+            self._dead[segment] += record_size
+        else:
+            self._index[key] = (segment, offset, value_len)
+
+    def _open_active(self, segment, hints=None):
+        path = self._path(segment, DATA_SUFFIX)
+        self._active_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                                  0o644)
+        self._active = segment
+        self._active_hints = hints if hints is not None else bytearray()
+        self._sizes.setdefault(segment, os.fstat(self._active_fd).st_size)
+        self._dead.setdefault(segment, 0)
+
+    def _close_active(self):
+        if self._active_fd is not None:
+            os.close(self._active_fd)
+        self._active_fd = None
+        self._active = None
+
+    def _roll(self):
+        segment = self._active
+        self._close_active()
+        self._write_hints(segment, self._active_hints)
+        self._open_active(segment + 1)
+
+        if self._should_compact():
+            self._compactor = threading.Thread(target=self._background_compact,
+                                               daemon=True)
+            self._compactor.start()
+
+    def _should_compact(self):
+        if self.compact_threshold <= 0:
+            return False
+        if self._compactor is not None and self._compactor.is_alive():
+            return False
+
+        closed = [s for s in self._sizes if s != self._active]
+        total = sum(self._sizes[s] for s in closed)
+        dead = sum(self._dead[s] for s in closed)
+        return total > 0 and float(dead) / total >= self.compact_threshold
+
+    def _write_hints(self, segment, hints):
+        path = self._path(segment, HINT_SUFFIX)
+        with open(path + TMP_SUFFIX, 'wb') as fp:
+            fp.write(hints)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(path + TMP_SUFFIX, path)
+
+    def _reader(self, segment):
+        # readers are never closed explicitly. when a segment is compacted
+        # away, a get that still holds the file object can finish reading
+        # from the unlinked file, and it closes once the last one lets go.
+        try:
+            return self._readers[segment]
+        except KeyError:
+            fp = open(self._path(segment, DATA_SUFFIX), 'rb', buffering=0)
+            self._readers[segment] = fp
+            return fp
+
+    @classmethod
+    def _pread(cls, fp, offset, length):
+        data = os.pread(fp.fileno(), length, offset)
+        while len(data) < length:
+            chunk = os.pread(fp.fileno(), length - len(data),
+                             offset + len(data))
+            if not chunk:
+                raise FloeReadException('short read at %s' % offset)
+            data += chunk
+        return data
+
+    @classmethod
+    def _unlink(cls, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _unlink_segment(self, segment):
+        self._unlink(self._path(segment, DATA_SUFFIX))
+        self._unlink(self._path(segment, HINT_SUFFIX))
+
+    def _append(self, records):
+        """
+        write a batch of (key, value) records to the active segment with a
+        single write. a value of None writes a tombstone.
+        """
+        with self._lock:
+            if self._sizes[self._active] >= self.max_segment_size:
+                self._roll()
+
+            segment = self._active
+            offset = self._sizes[segment]
+            buf = bytearray()
+            entries = []
+            for key, value in records:
+                key_bytes = key.encode('utf-8')
+                flags = FLAG_TOMBSTONE if value is None else 0
+                value = memoryview(b'' if value is None else value).cast('B')
+                value_len = len(value)
+                buf += RECORD_HEADER.pack(
+                    _checksum(flags, key_bytes, value),
+                    flags, len(key_bytes), value_len)
+                buf += key_bytes
+                value_offset = offset + len(buf)
+                buf += value
+                entries.append((flags, key, key_bytes, value_offset,
+                                value_len))
+
+            view = memoryview(buf)
+            while view:
+                written = os.write(self._active_fd, view)
+                view = view[written:]
+            if self.sync:
+                os.fsync(self._active_fd)
+
+            self._sizes[segment] = offset + len(buf)
+            for flags, key, key_bytes, value_offset, value_len in entries:
+                self._active_hints += HINT_HEADER.pack(
+                    flags, len(key_bytes), value_offset, value_len)
+                self._active_hints += key_bytes
+                self._apply(segment, flags, key, value_offset, value_len)
+
+    def get(self, key):
+        """
+        get the value of a given key
+        :param key:
+        :return:
+        """
+        key = sanitize_key(key)
+        with self._lock:
+            location = self._index.get(key)
+            if location is None:
+                return None
+            segment, offset, length = location
+            fp = self._reader(segment)
+        try:
+            return self._pread(fp, offset, length)
+        except (OSError, IOError) as e:
+            raise FloeReadException(e)
+
+    def get_multi(self, keys):
+        """
+        get the values for a list of keys as a dictionary.
+        keys that are not found will be missing from the response.
+
+        :param keys:
+        :return:
+        """
+        if not keys:
+            return {}
+        keys = [sanitize_key(key) for key in keys]
+        with self._lock:
+            locations = []
+            for key in keys:
+                location = self._index.get(key)
+                if location is not None:
+                    locations.append(
+                        (location, key, self._reader(location[0])))
+
+        # read in segment and offset order to keep the disk access sequential
+        locations.sort(key=lambda row: row[0][:2])
+        try:
+            return {key: self._pread(fp, offset, length)
+                    for (_, offset, length), key, fp in locations}
+        except (OSError, IOError) as e:
+            raise FloeReadException(e)
+
+    def set(self, key, bin_data):
+        """
+        set a given key
+        :param key:
+        :param bin_data:
+        :return:
+        """
+        self.set_multi({key: bin_data})
+
+    def set_multi(self, mapping):
+        """
+        set a series of keys based on the dictionary passed in
+        :param mapping: dict
+        :return:
+        """
+        records = [(sanitize_key(key), value) for key, value in
+                   mapping.items()]
+        if not records:
+            return
+        try:
+            self._append(records)
+        except (OSError, IOError) as e:
+            raise FloeWriteException(e)
+
+    def delete(self, key):
+        """
+        delete a given key
+        :param key:
+        :return:
+        """
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        """
+        delete a set of given keys
+        :param keys:
+        :return:
+        """
+        keys = [sanitize_key(key) for key in keys]
+        with self._lock:
+            keys = [key for key in keys if key in self._index]
+        if not keys:
+            return
+        try:
+            self._append([(key, None) for key in keys])
+        except (OSError, IOError) as e:
+            raise FloeDeleteException(e)
+
+    def flush(self):
+        """
+        remove all keys from a given database
+        :return:
+        """
+        with self._lock:
+            self._epoch += 1
+            next_segment = max(self._sizes) + 1 if self._sizes else 0
+            self._close_active()
+            for segment in list(self._sizes):
+                self._unlink_segment(segment)
+            self._index = {}
+            self._sizes = {}
+            self._dead = {}
+            self._readers = {}
+            self._open_active(next_segment)
+
+    def ids(self):
+        """
+        return a generator that iterates through all ids in cold storage
+        no particular order. useful for a script to crawl through stuff that
+        has been frozen and thaw it.
+        :return:
+        """
+        with self._lock:
+            keys = list(self._index)
+        for key in keys:
+            yield key
+
+    def _background_compact(self):
+        try:
+            self.compact()
+        except Exception as e:
+            logger.exception("Compaction of %s failed: %s", self.dir, e)
+
+    def compact(self):
+        """
+        merge all closed segments into one, dropping overwritten and deleted
+        records. writes keep going to the active segment while it runs.
+        :return:
+        """
+        with self._compact_lock:
+            with self._lock:
+                epoch = self._epoch
+                inputs = sorted(s for s in self._sizes if s != self._active)
+                if not inputs:
+                    return
+                members = set(inputs)
+                live = [(location, key, self._reader(location[0]))
+                        for key, location in self._index.items()
+                        if location[0] in members]
+
+            target = inputs[-1]
+            data_path = self._path(target, DATA_SUFFIX) + TMP_SUFFIX
+            hint_path = self._path(target, HINT_SUFFIX) + TMP_SUFFIX
+            live.sort(key=lambda row: row[0][:2])
+            moved = []
+            hints = bytearray()
+            offset = 0
+            with open(data_path, 'wb') as fp:
+                for location, key, reader in live:
+                    value = self._pread(reader, location[1], location[2])
+                    key_bytes = key.encode('utf-8')
+                    fp.write(RECORD_HEADER.pack(
+                        _checksum(0, key_bytes, value), 0, len(key_bytes),
+                        len(value)))
+                    fp.write(key_bytes)
+                    value_offset = offset + RECORD_HEADER.size + len(key_bytes)
+                    fp.write(value)
+                    hints += HINT_HEADER.pack(0, len(key_bytes), value_offset,
+                                              len(value)) + key_bytes
+                    moved.append((key, location,
+                                  (target, value_offset, len(value))))
+                    offset = value_offset + len(value)
+                fp.flush()
+                os.fsync(fp.fileno())
+
+            with open(hint_path, 'wb') as fp:
+                fp.write(hints)
+                fp.flush()
+                os.fsync(fp.fileno())
+
+            with self._lock:
+                if epoch != self._epoch:
+                    self._unlink(data_path)
+                    self._unlink(hint_path)
+                    return
+
+                manifest = os.path.join(self.dir, MERGE_MANIFEST)
+                with open(manifest + TMP_SUFFIX, 'w') as fp:
+                    json.dump({'target': target, 'remove': inputs[:-1]}, fp)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.replace(manifest + TMP_SUFFIX, manifest)
+
+                os.replace(data_path, self._path(target, DATA_SUFFIX))
+                os.replace(hint_path, self._path(target, HINT_SUFFIX))
+                for segment in inputs[:-1]:
+                    self._unlink_segment(segment)
+                    del self._sizes[segment]
+                    del self._dead[segment]
+                    self._readers.pop(segment, None)
+                self._readers.pop(target, None)
+                self._unlink(manifest)
+
+                # keys written or deleted since the snapshot already point
+                # at a newer segment, so their copy here is dead on arrival.
+                self._sizes[target] = offset
+                self._dead[target] = 0
+                for key, old, new in moved:
+                    if self._index.get(key) == old:
+                        self._index[key] = new
+                    else:
+                        self._dead[target] += \
+                            RECORD_HEADER.size + len(key) + new[2]
+
+    def close(self):
+        with self._lock:
+            self._close_active()
+            self._readers = {}
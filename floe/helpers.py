@@ -1,5 +1,7 @@
 import time
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from itertools import islice
 from .exceptions import FloeInvalidKeyException
 
@@ -24,3 +26,83 @@ def sanitize_key(key):
 def chunks(iterable, size):
     iterable = iter(iterable)
     return iter(lambda: list(islice(iterable, size)), [])
+
+
+def batches(items, size, max_bytes=0, weigh=len):
+    """
+    split items into lists of at most `size` items and, when max_bytes is
+    set, at most max_bytes as measured by `weigh`. an item heavier than
+    max_bytes gets a batch of its own.
+    """
+    batch, total = [], 0
+    for item in items:
+        weight = weigh(item) if max_bytes else 0
+        if batch and (len(batch) >= size or
+                      (max_bytes and total + weight > max_bytes)):
+            yield batch
+            batch, total = [], 0
+        batch.append(item)
+        total += weight
+    if batch:
+        yield batch
+
+
+def to_bool(value):
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+SIZE_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:I?B)?\s*$',
+                          re.IGNORECASE)
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(value):
+    """
+    turn a size like 512, '64KB' or '256MB' into bytes. the units are
+    powers of 1024.
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = SIZE_PATTERN.match(value)
+    if not match:
+        raise ValueError('invalid size %r' % value)
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit.upper()])
+
+
+def pipeline(batches, fn, workers, done):
+    """
+    run fn over each batch on worker threads. at most 2 * workers batches
+    are queued or in flight, so memory stays flat however many there are.
+    done(seq, batch, result) is called from the workers as batches finish.
+    the first error stops the pipeline and is raised once the batches in
+    flight have finished.
+    """
+    slots = threading.BoundedSemaphore(workers * 2)
+    errors = []
+
+    def finished(future, seq, batch):
+        try:
+            if future.exception() is not None:
+                errors.append(future.exception())
+            else:
+                done(seq, batch, future.result())
+        except Exception as e:
+            errors.append(e)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers,
+                            thread_name_prefix='floe-pipeline') as executor:
+        for seq, batch in enumerate(batches):
+            slots.acquire()
+            if errors:
+                slots.release()
+                break
+            future = executor.submit(fn, batch)
+            future.add_done_callback(
+                lambda f, seq=seq, batch=batch: finished(f, seq, batch))
+    if errors:
+        raise errors[0]
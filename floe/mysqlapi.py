@@ -1,15 +1,32 @@
 import pymysql
+import json
+import base64
+import logging
+import queue
+import tempfile
+import threading
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from .helpers import current_time, sanitize_key
+from .helpers import current_time, sanitize_key, batches
+from .otel_instrumentation import instrument_backend, child_span, \
+    propagate_context, record_pool_wait
 from .exceptions import FloeReadException, \
     FloeWriteException, FloeDeleteException, \
-    FloeDataOverflowException, FloeConfigurationException
+    FloeDataOverflowException, FloeConfigurationException, \
+    FloeOperationalException
 
 warnings.filterwarnings('ignore', category=pymysql.Warning)
 
+logger = logging.getLogger(__name__)
+
 DEFAULT_MAX_CHAR_LEN = 65535
 ALLOWED_BIN_DATA_TYPES = ['blob', 'mediumblob', 'longblob']
+REPLICA_STRATEGIES = ['round_robin', 'least_outstanding']
+BULK_LOAD_POLICIES = ['replace', 'ignore']
+
+# prune the read-your-writes window once it tracks this many keys
+RECENT_WRITES_PRUNE_SIZE = 10000
 
 
 class MySQLPool(object):
@@ -17,61 +34,209 @@ class MySQLPool(object):
     utility class that does mysql connection pooling.
     Thread-safe. Will allocate a connection and only release it back when you
     are done with it.
+
+    At most `max_connections` connections are open at once. When they are
+    all checked out, callers block for up to `timeout` seconds waiting for
+    one to come back. Up to `pool_size` idle connections are kept around.
+    Connections are retired after `max_lifetime` seconds or after sitting
+    idle for `inactive_timeout`, and an idle connection is pinged before
+    reuse once it has been idle for `ping_interval`. A connection that
+    raised while checked out is closed rather than returned to the pool.
     """
     exception_class = pymysql.Error
 
-    def __init__(self, pool_size=5, inactive_timeout=120, **kwargs):
+    def __init__(self, pool_size=5, inactive_timeout=120,
+                 max_connections=None, timeout=30, prewarm=0,
+                 max_lifetime=3600, ping_interval=30, **kwargs):
         self.inactive_timeout = inactive_timeout
         self.pool_size = pool_size
-        self.pool = []
+        self.max_connections = max(int(max_connections or pool_size), 1)
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
         self.conn_kwargs = kwargs
 
+        self.pool = []
+        self._created_at = {}
+        self._open = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            'checkouts': 0,
+            'created': 0,
+            'closed': 0,
+            'errors': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'max_wait_time': 0.0,
+            'timeouts': 0,
+        }
+
+        warm = []
+        try:
+            for _ in range(0, min(int(prewarm), self.max_connections)):
+                warm.append(self._allocate())
+        except (self.exception_class, FloeOperationalException) as e:
+            logger.warning("Unable to pre-warm mysql pool: %s", e)
+        for conn in warm:
+            self._release(conn)
+
     @contextmanager
     def connection(self):
         conn = self._allocate()
         try:
             yield conn
-            self._release(conn)
-        except self.exception_class:
+        except BaseException:
+            self._dispose(conn)
             raise
+        self._release(conn)
+
+    def _expired(self, created, last_used, now):
+        if last_used + self.inactive_timeout <= now:
+            return True
+        return bool(self.max_lifetime) and created + self.max_lifetime <= now
 
     def _allocate(self):
+        start = current_time()
+        while True:
+            conn, last_used = self._checkout(start)
+            if conn is None:
+                break
+
+            if last_used + self.ping_interval > current_time():
+                return conn
+
+            try:
+                conn.ping(reconnect=False)
+                return conn
+            except self.exception_class:
+                self._dispose(conn)
+
         try:
-            while True:
-                conn, ts = self.pool.pop()
-                if ts + self.inactive_timeout > current_time():
-                    return conn
+            conn = self._create_connection()
+        except BaseException:
+            with self._cond:
+                self._open -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
 
-                conn.close()
-        except IndexError:
-            pass
+        with self._cond:
+            self._created_at[conn] = current_time()
+            self._stats['created'] += 1
+        return conn
 
-        return self._create_connection()
+    def _checkout(self, start):
+        """
+        reserve a slot in the pool, waiting if they are all taken.
+        returns an idle connection and when it was last used, or None when
+        the caller should open a new connection in the slot.
+        """
+        stale = []
+        try:
+            with self._cond:
+                waited = False
+                while True:
+                    now = current_time()
+                    while self.pool:
+                        conn, last_used = self.pool.pop()
+                        if self._expired(self._created_at[conn], last_used,
+                                         now):
+                            stale.append(conn)
+                            continue
+                        self._checked_out(start, waited)
+                        return conn, last_used
+
+                    if self._open < self.max_connections:
+                        self._open += 1
+                        self._checked_out(start, waited)
+                        return None, None
+
+                    remaining = start + self.timeout - now
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise FloeOperationalException(
+                            'timed out waiting for a mysql connection')
+                    waited = True
+                    self._cond.wait(remaining)
+        finally:
+            for conn in stale:
+                self._close(conn)
+
+    def _checked_out(self, start, waited):
+        self._in_use += 1
+        self._stats['checkouts'] += 1
+        if waited:
+            wait_time = current_time() - start
+            self._stats['waits'] += 1
+            self._stats['wait_time'] += wait_time
+            self._stats['max_wait_time'] = max(self._stats['max_wait_time'],
+                                               wait_time)
+            record_pool_wait('mysql', wait_time)
 
     def _release(self, conn):
-        if len(self.pool) > self.pool_size:
+        now = current_time()
+        with self._cond:
+            self._in_use -= 1
+            if len(self.pool) < self.pool_size and \
+                    not self._expired(self._created_at[conn], now, now):
+                self.pool.append((conn, now))
+                self._cond.notify()
+                return
+
+        self._close(conn)
+
+    def _dispose(self, conn):
+        with self._cond:
+            self._in_use -= 1
+            self._stats['errors'] += 1
+        self._close(conn)
+
+    def _close(self, conn):
+        """
+        close a connection that is no longer idle in the pool and free up
+        its slot.
+        """
+        with self._cond:
+            self._open -= 1
+            self._created_at.pop(conn, None)
+            self._stats['closed'] += 1
+            self._cond.notify()
+        try:
             conn.close()
-            return
-
-        self.pool.append((conn, current_time()))
+        except Exception:
+            pass
 
     def _create_connection(self):
         return pymysql.connect(**self.conn_kwargs)
 
+    def stats(self):
+        """
+        counters for the pool: connections created and closed, how many are
+        in use and idle right now, and how often and how long callers had
+        to wait for one.
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['in_use'] = self._in_use
+            stats['idle'] = len(self.pool)
+            stats['open'] = self._open
+            stats['max_connections'] = self.max_connections
+        return stats
+
     def close(self):
-        try:
-            while True:
+        while True:
+            with self._cond:
+                if not self.pool:
+                    return
                 conn, _ = self.pool.pop()
-                try:
-                    conn.close()
-                except (AttributeError, TypeError):
-                    continue
-
-        except IndexError:
-            return
+            self._close(conn)
 
     def __del__(self):
-        self.close()
+        try:
+            self.close()
+        except (AttributeError, TypeError):
+            pass
 
 
 class MySQLConnection(object):
@@ -89,10 +254,16 @@ class MySQLConnection(object):
             conn.close()
 
 
+@instrument_backend('mysql')
 class MySQLFloe(object):
     def __init__(self, table, default_partitions=10, pool_size=5,
                  init_disable=False, bin_data_type='mediumblob',
-                 dynamic_char_len=False,
+                 dynamic_char_len=False, max_connections=None,
+                 pool_timeout=30, prewarm=0, max_lifetime=3600,
+                 ping_interval=30, batch_size=1000,
+                 batch_bytes=1024 * 1024, parallelism=4,
+                 page_size=1000, replicas=None,
+                 replica_strategy='round_robin', read_your_writes=0,
                  **conn_kwargs):
         """
         specify the database, table, and connection parameters for mysql.
@@ -102,6 +273,21 @@ class MySQLFloe(object):
         hits an error that says no db exists, it'll try to create it.
         This is useful for unit testing scenarios. On production, it's probably
         better to create the database and table in advance.
+        The pool keeps up to pool_size idle connections and opens at most
+        max_connections (pool_size by default), making callers wait up to
+        pool_timeout seconds for one. See MySQLPool for the rest.
+        The multi operations are split into batches of batch_size keys and
+        batch_bytes of data, run on up to parallelism threads at once.
+        escaping can double the size of a value in the statement, so keep
+        batch_bytes under half of the server's max_allowed_packet (4MB by
+        default on 5.7).
+        ids() reads page_size ids per query.
+        replicas is a list, or comma separated string, of host[:port] read
+        replicas. get, get_multi and ids go to one of them, picked by
+        replica_strategy ('round_robin' or 'least_outstanding'), while
+        writes, flush and schema changes stay on the primary. with
+        read_your_writes set, reads of a key written in the last that many
+        seconds by this process go to the primary.
         :param database:
         :param table:
         :param kwargs:
@@ -109,12 +295,45 @@ class MySQLFloe(object):
 
         self.table = table
         self.max_char_len = DEFAULT_MAX_CHAR_LEN
+        self.batch_size = int(batch_size)
+        self.batch_bytes = int(batch_bytes)
+        self.parallelism = int(parallelism)
+        self.page_size = int(page_size)
+        self._executor = None
         conn_kwargs['autocommit'] = True
         conn_kwargs.setdefault('cursorclass', pymysql.cursors.SSCursor)
 
         pool_size = int(pool_size)
+        self.pool_kwargs = {
+            'max_connections': max_connections,
+            'timeout': float(pool_timeout),
+            'prewarm': int(prewarm),
+            'max_lifetime': float(max_lifetime),
+            'ping_interval': float(ping_interval),
+        }
         self.pool = self._create_pool(pool_size=pool_size, **conn_kwargs)
 
+        if isinstance(replicas, str):
+            replicas = [r for r in replicas.split(',') if r.strip()]
+        self.replica_pools = []
+        for replica in replicas or []:
+            host, _, port = replica.strip().partition(':')
+            replica_kwargs = dict(conn_kwargs, host=host)
+            if port:
+                replica_kwargs['port'] = int(port)
+            self.replica_pools.append(
+                self._create_pool(pool_size=pool_size, **replica_kwargs))
+
+        if replica_strategy not in REPLICA_STRATEGIES:
+            raise FloeConfigurationException(
+                'invalid replica_strategy %s' % replica_strategy)
+        self.replica_strategy = replica_strategy
+        self.read_your_writes = float(read_your_writes)
+        self._outstanding = [0] * len(self.replica_pools)
+        self._next_replica = 0
+        self._recent_writes = {}
+        self._routing_lock = threading.Lock()
+
         if not init_disable:
             if bin_data_type.lower() not in ALLOWED_BIN_DATA_TYPES:
                 raise FloeConfigurationException(bin_data_type)
@@ -163,6 +382,7 @@ class MySQLFloe(object):
 
     def _create_pool(self, pool_size=5, **conn_kwargs):
         if pool_size and pool_size > 0:
+            conn_kwargs.update(self.pool_kwargs)
             return MySQLPool(pool_size=pool_size, **conn_kwargs)
         else:
             return MySQLConnection(**conn_kwargs)
@@ -172,6 +392,58 @@ class MySQLFloe(object):
         conn_kwargs['pool_size'] = pool_size
         self.pool = self._create_pool(**conn_kwargs)
 
+    def _choose_replica(self, keys):
+        """
+        pick the replica to read the keys from, or None for the primary.
+        """
+        if not self.replica_pools:
+            return None
+
+        with self._routing_lock:
+            if self._recent_writes:
+                now = current_time()
+                for key in keys:
+                    if self._recent_writes.get(key, 0) > now:
+                        return None
+
+            if self.replica_strategy == 'least_outstanding':
+                return min(range(0, len(self.replica_pools)),
+                           key=self._outstanding.__getitem__)
+
+            index = self._next_replica % len(self.replica_pools)
+            self._next_replica = index + 1
+            return index
+
+    @contextmanager
+    def _read_connection(self, keys=()):
+        index = self._choose_replica(keys)
+        if index is None:
+            with self.pool.connection() as connection:
+                yield connection
+            return
+
+        with self._routing_lock:
+            self._outstanding[index] += 1
+        try:
+            with self.replica_pools[index].connection() as connection:
+                yield connection
+        finally:
+            with self._routing_lock:
+                self._outstanding[index] -= 1
+
+    def _wrote(self, keys):
+        if not self.read_your_writes or not self.replica_pools:
+            return
+
+        now = current_time()
+        expires = now + self.read_your_writes
+        with self._routing_lock:
+            if len(self._recent_writes) >= RECENT_WRITES_PRUNE_SIZE:
+                self._recent_writes = {
+                    k: v for k, v in self._recent_writes.items() if v > now}
+            for key in keys:
+                self._recent_writes[key] = expires
+
     def get(self, pk):
         """
         get the value of a given key
@@ -181,7 +453,7 @@ class MySQLFloe(object):
         pk = sanitize_key(pk)
         statement = "SELECT `bin` FROM {} WHERE `pk` = %s".format(self.table)
         try:
-            with self.pool.connection() as connection:
+            with self._read_connection([pk]) as connection:
                 with connection.cursor() as cursor:
                     cursor.execute(statement, (pk,))
                     for row in cursor.fetchall():
@@ -189,10 +461,25 @@ class MySQLFloe(object):
         except pymysql.Error as e:
             raise FloeReadException(e)
 
+    def _fan_out(self, func, batches):
+        batches = list(batches)
+        if len(batches) > 1 and self.parallelism > 1:
+            return list(self.executor.map(propagate_context(func),
+                                          batches))
+        return [func(batch) for batch in batches]
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.parallelism)
+        return self._executor
+
     def get_multi(self, keys):
         """
         get the values for a list of keys as a dictionary.
         keys that are not found will be missing from the response.
+        large lists are split into batches of batch_size keys, which run
+        in parallel on separate connections.
 
         :param keys:
         :return:
@@ -200,12 +487,20 @@ class MySQLFloe(object):
         if not keys:
             return {}
         keys = [sanitize_key(key) for key in keys]
+        result = {}
+        for rows in self._fan_out(self._get_batch,
+                                  batches(keys, self.batch_size)):
+            result.update(rows)
+        return result
+
+    @child_span
+    def _get_batch(self, keys):
         statement = "SELECT `pk`, `bin` FROM {} WHERE `pk` IN ({})".format(
             self.table,
             ', '.join(["%s" for _ in keys])
         )
         try:
-            with self.pool.connection() as connection:
+            with self._read_connection(keys) as connection:
                 with connection.cursor() as cursor:
                     cursor.execute(statement, tuple(keys))
                     return {k.decode('utf-8'): v for k, v in cursor}
@@ -223,22 +518,36 @@ class MySQLFloe(object):
 
     def set_multi(self, mapping):
         """
-        set a series of keys based on the dictionary passed in
+        set a series of keys based on the dictionary passed in.
+        large mappings are split into statements of at most batch_size rows
+        and batch_bytes of data, so they stay under max_allowed_packet, and
+        the statements run in parallel on separate connections. each one
+        commits on its own, so a failure can leave earlier batches written.
         :param mapping: dict
         :return:
         """
-        mapping = {sanitize_key(key): self._validate_data(value) for key, value
-                   in mapping.items()}
+        rows = [(sanitize_key(key), self._validate_data(value)) for key, value
+                in mapping.items()]
+        try:
+            self._fan_out(self._set_batch,
+                          batches(rows, self.batch_size, self.batch_bytes,
+                                  lambda row: len(row[0]) + len(row[1])))
+        finally:
+            # the window starts once the write is done, so a slow write
+            # can't outlast it. a failed one may have written some batches.
+            self._wrote([key for key, _ in rows])
 
+    @child_span
+    def _set_batch(self, rows):
         statement = "INSERT INTO {} (`pk`, `bin`) VALUES {} " \
                     "ON DUPLICATE KEY UPDATE `bin` = VALUES(`bin`)"
         tuple_list = []
-        for key, value in mapping.items():
+        for key, value in rows:
             tuple_list.append(key)
             tuple_list.append(value)
 
         statement = statement.format(self.table, ', '.join(
-            ["(%s, %s)" for _ in range(0, len(mapping))]))
+            ["(%s, %s)" for _ in range(0, len(rows))]))
 
         try:
             with self.pool.connection() as connection:
@@ -257,7 +566,7 @@ class MySQLFloe(object):
 
     def delete_multi(self, keys):
         """
-        delete a set of given keys
+        delete a set of given keys, batch_size keys per statement.
         :param keys:
         :return:
         """
@@ -265,7 +574,13 @@ class MySQLFloe(object):
             return {}
 
         keys = [sanitize_key(key) for key in keys]
+        try:
+            self._fan_out(self._delete_batch, batches(keys, self.batch_size))
+        finally:
+            self._wrote(keys)
 
+    @child_span
+    def _delete_batch(self, keys):
         statement = "DELETE FROM {} WHERE `pk` IN ({})".format(
             self.table,
             ', '.join(["%s" for _ in keys])
@@ -287,19 +602,272 @@ class MySQLFloe(object):
             with connection.cursor() as cursor:
                 cursor.execute(statement)
 
-    def ids(self):
-        statement = "SELECT `pk` FROM {}".format(self.table)
+    def ids(self, after=None):
+        """
+        iterate through all ids in key order with keyset pagination. each
+        page is a short query on a pooled connection, so a slow consumer
+        doesn't hold a connection. pass the last id seen as `after` to
+        resume an interrupted crawl.
+        :param after:
+        :return:
+        """
+        after = '' if after is None else sanitize_key(after)
+        while True:
+            page = self._ids_page(None, after, self.page_size)
+            for key in page:
+                yield key
+            if len(page) < self.page_size:
+                return
+            after = page[-1]
+
+    def items(self, after=None):
+        """
+        iterate through all (key, value) pairs in key order, a page of
+        page_size rows per query. cheaper than ids() plus get_multi for a
+        full scan, since each page is one range read.
+        :param after:
+        :return:
+        """
+        after = '' if after is None else sanitize_key(after)
+        while True:
+            page = self._items_page(after, self.page_size)
+            for item in page:
+                yield item
+            if len(page) < self.page_size:
+                return
+            after = page[-1][0]
+
+    def _items_page(self, after, limit):
+        statement = "SELECT `pk`, `bin` FROM {} WHERE `pk` > %s " \
+                    "ORDER BY `pk` LIMIT %s".format(self.table)
         try:
-            with self.pool.connection() as connection:
+            with self._read_connection() as connection:
                 with connection.cursor() as cursor:
-                    cursor.execute(statement)
-                    for k, in cursor:
-                        yield k.decode('utf-8')
+                    cursor.execute(statement, (after, limit))
+                    return [(k.decode('utf-8'), v)
+                            for k, v in cursor.fetchall()]
         except pymysql.Error as e:
             raise FloeReadException(e)
 
+    def scan_ids(self, cursor=None, workers=None):
+        """
+        crawl the ids of every partition of the table in parallel.
+        see MySQLIdScan for how to resume an interrupted crawl.
+        :param cursor: a token from MySQLIdScan.cursor
+        :param workers: threads to use, defaults to parallelism
+        :return: MySQLIdScan
+        """
+        return MySQLIdScan(self, self._partitions(), cursor=cursor,
+                           workers=workers or self.parallelism)
+
+    def _partitions(self):
+        statement = "SELECT `PARTITION_NAME` " \
+                    "FROM `INFORMATION_SCHEMA`.`PARTITIONS` " \
+                    "WHERE `TABLE_SCHEMA` = DATABASE() " \
+                    "AND `TABLE_NAME` = %s " \
+                    "AND `PARTITION_NAME` IS NOT NULL " \
+                    "ORDER BY `PARTITION_ORDINAL_POSITION`"
+        try:
+            with self._read_connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(statement, (self.table,))
+                    partitions = [name for name, in cursor.fetchall()]
+        except pymysql.Error as e:
+            raise FloeReadException(e)
+        return [p.decode('utf-8') if isinstance(p, bytes) else p
+                for p in partitions] or [None]
+
+    def _ids_page(self, partition, after, limit):
+        statement = "SELECT `pk` FROM {}{} WHERE `pk` > %s " \
+                    "ORDER BY `pk` LIMIT %s".format(
+                        self.table,
+                        " PARTITION (`{}`)".format(partition)
+                        if partition else "")
+        try:
+            with self._read_connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(statement, (after, limit))
+                    return [k.decode('utf-8') for k, in cursor.fetchall()]
+        except pymysql.Error as e:
+            raise FloeReadException(e)
+
+    def _bulk_connection(self):
+        conn_kwargs = dict(self.pool.conn_kwargs)
+        conn_kwargs['local_infile'] = True
+        return pymysql.connect(**conn_kwargs)
+
+    def bulk_load(self, pairs, policy='replace',
+                  chunk_bytes=64 * 1024 * 1024):
+        """
+        stream (key, value) pairs into the table with LOAD DATA LOCAL
+        INFILE, which is much cheaper than multi-row inserts for large
+        imports. rows are staged in a temp file of about chunk_bytes and
+        loaded a file at a time. values are hex encoded so any bytes are
+        safe. the server needs local_infile turned on.
+        :param pairs: iterable of (key, value) tuples
+        :param policy: 'replace' or 'ignore' rows whose key already exists
+        :param chunk_bytes:
+        :return: dict with rows loaded, rows skipped by policy='ignore',
+            seconds and rows_per_second
+        """
+        if policy not in BULK_LOAD_POLICIES:
+            raise FloeConfigurationException('invalid policy %s' % policy)
+
+        statement = "LOAD DATA LOCAL INFILE %s {} INTO TABLE {} " \
+                    "FIELDS TERMINATED BY '\\t' " \
+                    "LINES TERMINATED BY '\\n' " \
+                    "(`pk`, @bin) SET `bin` = UNHEX(@bin)".format(
+                        policy.upper(), self.table)
+        chunk_bytes = int(chunk_bytes)
+        start = current_time()
+        rows = skipped = 0
+        pairs = iter(pairs)
+        try:
+            connection = self._bulk_connection()
+            try:
+                while True:
+                    with tempfile.NamedTemporaryFile(suffix='.tsv') as fp:
+                        keys = []
+                        for key, value in pairs:
+                            key = sanitize_key(key)
+                            line = b'%s\t%s\n' % (
+                                key.encode('utf-8'),
+                                memoryview(self._validate_data(value))
+                                .hex().encode('ascii'))
+                            fp.write(line)
+                            keys.append(key)
+                            if fp.tell() >= chunk_bytes:
+                                break
+                        if not keys:
+                            break
+                        fp.flush()
+                        try:
+                            with connection.cursor() as cursor:
+                                cursor.execute(statement, (fp.name,))
+                                loaded = cursor.rowcount
+                        finally:
+                            self._wrote(keys)
+                        # with replace every row is loaded, but the affected
+                        # row count also counts the old rows it deleted
+                        if policy == 'ignore':
+                            rows += loaded
+                            skipped += len(keys) - loaded
+                        else:
+                            rows += len(keys)
+                        logger.info("Bulk loaded %s rows into %s, %.0f/s",
+                                    rows, self.table,
+                                    rows / max(current_time() - start, 1e-6))
+            finally:
+                connection.close()
+        except pymysql.Error as e:
+            raise FloeWriteException(e)
+
+        seconds = current_time() - start
+        return {
+            'rows': rows,
+            'skipped': skipped,
+            'seconds': seconds,
+            'rows_per_second': rows / seconds if seconds > 0 else 0.0,
+        }
+
     def drop_table(self):
         statement = "DROP TABLE IF EXISTS {}".format(self.table)
         with self.pool.connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute(statement)
+
+
+class MySQLIdScan(object):
+    """
+    iterates over the ids of a partitioned table, crawling each partition
+    with keyset pagination on its own thread. ids come back in key order
+    within a partition but interleaved across partitions.
+
+    `cursor` is a token recording how far each partition has been consumed.
+    pass it to MySQLFloe.scan_ids to pick up where an interrupted crawl
+    stopped.
+    """
+
+    def __init__(self, floe, partitions, cursor=None, workers=4):
+        self.floe = floe
+        self.workers = max(1, int(workers))
+        self._positions = {p or '': {'after': '', 'done': False}
+                           for p in partitions}
+        if cursor:
+            try:
+                state = json.loads(base64.urlsafe_b64decode(
+                    cursor.encode('utf-8')).decode('utf-8'))
+            except (ValueError, TypeError):
+                raise FloeConfigurationException('invalid cursor')
+            if set(state) != set(self._positions):
+                raise FloeConfigurationException(
+                    'cursor is for different partitions')
+            self._positions = state
+
+    @property
+    def cursor(self):
+        state = json.dumps(self._positions, sort_keys=True,
+                           separators=(',', ':'))
+        return base64.urlsafe_b64encode(state.encode('utf-8')).decode('utf-8')
+
+    @property
+    def done(self):
+        return all(p['done'] for p in self._positions.values())
+
+    def __iter__(self):
+        pending = [p for p, state in sorted(self._positions.items())
+                   if not state['done']]
+        if not pending:
+            return
+
+        workers = min(self.workers, len(pending))
+        found = queue.Queue(maxsize=workers * 2)
+        stop = threading.Event()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    found.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def _crawl(partitions):
+            page_size = self.floe.page_size
+            for partition in partitions:
+                after = self._positions[partition]['after']
+                try:
+                    while not stop.is_set():
+                        page = self.floe._ids_page(partition or None, after,
+                                                   page_size)
+                        if page:
+                            _put((partition, page))
+                        if len(page) < page_size:
+                            break
+                        after = page[-1]
+                except Exception as e:
+                    _put((partition, e))
+                    continue
+                _put((partition, None))
+
+        threads = [threading.Thread(target=_crawl,
+                                    args=(pending[i::workers],), daemon=True)
+                   for i in range(0, workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            remaining = len(pending)
+            while remaining:
+                partition, page = found.get()
+                if isinstance(page, Exception):
+                    raise page
+                if page is None:
+                    self._positions[partition]['done'] = True
+                    remaining -= 1
+                    continue
+                for key in page:
+                    yield key
+                    self._positions[partition]['after'] = key
+        finally:
+            stop.set()
@@ -1,22 +1,89 @@
+"""
+OpenTelemetry spans and metrics for the floe server and backends.
+
+app_trace wraps the falcon resource methods. instrument_backend wraps the
+get, set, delete, multi, ids and flush methods of a backend class with a
+span and three histograms, all with floe.domain, floe.backend and
+floe.operation attributes:
+
+    floe.backend.duration   seconds per call
+    floe.backend.keys       keys per call
+    floe.backend.bytes      value bytes read or written per call
+
+ids is timed until its last id is read. set FLOE_OTEL=0 before floe is
+imported to leave every class and method as it is, with no wrappers at
+all.
+"""
+import contextvars
 import functools
+import inspect
+import os
+import time
+from .helpers import to_bool
 
 try:
-    import falcon
-    from opentelemetry import trace
+    from opentelemetry import metrics, propagate, trace
+    from opentelemetry.propagators.textmap import Getter
     OTEL_AVAILABLE = True
 except ImportError:
     OTEL_AVAILABLE = False
 
+try:
+    import falcon
+except ImportError:
+    falcon = None
+
+OTEL_ENABLED = OTEL_AVAILABLE and to_bool(os.getenv('FLOE_OTEL', 'true'))
+
+BACKEND_OPS = ('get', 'get_multi', 'set', 'set_multi', 'delete',
+               'delete_multi', 'ids', 'flush')
+
+# the backend whose op is running in this context, so the calls it makes
+# to its own public methods aren't counted twice
+_active = contextvars.ContextVar('floe_otel_active', default=None)
+
+if OTEL_ENABLED:
+    _tracer = trace.get_tracer('floe')
+    _meter = metrics.get_meter('floe')
+    _duration = _meter.create_histogram(
+        'floe.backend.duration', unit='s',
+        description='time taken by a backend operation')
+    _keys = _meter.create_histogram(
+        'floe.backend.keys', unit='{key}',
+        description='keys per backend operation')
+    _bytes = _meter.create_histogram(
+        'floe.backend.bytes', unit='By',
+        description='value bytes read or written per backend operation')
+    _pool_wait = _meter.create_histogram(
+        'floe.pool.wait', unit='s',
+        description='time spent waiting for a free pooled connection')
+
+    class _RequestGetter(Getter):
+        def get(self, carrier, key):
+            value = carrier.get_header(key)
+            return None if value is None else [value]
+
+        def keys(self, carrier):
+            return list(carrier.headers)
+
+    _request_getter = _RequestGetter()
+
 
 def app_trace(f):
-    if not OTEL_AVAILABLE:
+    if not OTEL_AVAILABLE or falcon is None:
         return f
 
     @functools.wraps(f)
     def inner(resource, req, resp, *args, **kwargs):
         tracer = trace.get_tracer(__name__)
         span_name = f"{resource.__class__.__name__}.{f.__name__}"
-        with tracer.start_as_current_span(span_name) as span:
+        # carry on the trace of a floe client unless a middleware already
+        # started a span for this request
+        context = None
+        if not trace.get_current_span().get_span_context().is_valid:
+            context = propagate.extract(req, getter=_request_getter)
+        with tracer.start_as_current_span(span_name,
+                                          context=context) as span:
             try:
                 return f(resource, req, resp, *args, **kwargs)
             except Exception as e:
@@ -25,3 +92,202 @@ def app_trace(f):
                     span.set_status(trace.StatusCode.ERROR, str(e))
                 raise
     return inner
+
+
+def _argument(args, kwargs, index, name):
+    return args[index] if len(args) > index else kwargs.get(name)
+
+
+def _count(items, fallback):
+    return len(items) if hasattr(items, '__len__') else len(fallback)
+
+
+def _measure(op, params, args, kwargs, result):
+    """
+    the keys and value bytes of a finished op, bytes being None when the op
+    moves no values.
+    """
+    if op == 'get':
+        return 1, len(result) if result is not None else 0
+    if op == 'set':
+        return 1, len(_argument(args, kwargs, 1, params[1]))
+    if op == 'get_multi':
+        keys = _argument(args, kwargs, 0, params[0])
+        return (_count(keys, result),
+                sum(len(value) for value in result.values()))
+    if op == 'set_multi':
+        mapping = _argument(args, kwargs, 0, params[0])
+        return len(mapping), sum(len(value) for value in mapping.values())
+    if op == 'delete':
+        return 1, None
+    if op == 'delete_multi':
+        keys = _argument(args, kwargs, 0, params[0])
+        return (len(keys) if hasattr(keys, '__len__') else None), None
+    return None, None
+
+
+def _attributes(backend, instance, op):
+    return {'floe.domain': getattr(instance, 'domain', None) or '',
+            'floe.backend': backend,
+            'floe.operation': op}
+
+
+def _trace_op(f, backend, op):
+    params = list(inspect.signature(f).parameters)[1:]
+    span_name = f.__qualname__
+
+    @functools.wraps(f)
+    def inner(self, *args, **kwargs):
+        if _active.get() is self:
+            return f(self, *args, **kwargs)
+        attributes = _attributes(backend, self, op)
+        token = _active.set(self)
+        started = time.perf_counter()
+        try:
+            with _tracer.start_as_current_span(
+                    span_name, attributes=attributes) as span:
+                result = f(self, *args, **kwargs)
+                keys, size = _measure(op, params, args, kwargs, result)
+                if keys is not None:
+                    span.set_attribute('floe.keys', keys)
+                    _keys.record(keys, attributes)
+                if size is not None:
+                    span.set_attribute('floe.bytes', size)
+                    _bytes.record(size, attributes)
+                return result
+        except Exception as e:
+            attributes = dict(attributes, **{'error.type': type(e).__name__})
+            raise
+        finally:
+            _active.reset(token)
+            _duration.record(time.perf_counter() - started, attributes)
+    return inner
+
+
+def _trace_ids(f, backend):
+    span_name = f.__qualname__
+
+    def traced(keys, span, started, attributes):
+        count = 0
+        try:
+            for key in keys:
+                count += 1
+                yield key
+        except Exception as e:
+            span.record_exception(e)
+            span.set_status(trace.StatusCode.ERROR, str(e))
+            attributes = dict(attributes, **{'error.type': type(e).__name__})
+            raise
+        finally:
+            span.set_attribute('floe.keys', count)
+            span.end()
+            _keys.record(count, attributes)
+            _duration.record(time.perf_counter() - started, attributes)
+
+    @functools.wraps(f)
+    def inner(self, *args, **kwargs):
+        if _active.get() is self:
+            return f(self, *args, **kwargs)
+        attributes = _attributes(backend, self, 'ids')
+        span = _tracer.start_span(span_name, attributes=attributes)
+        started = time.perf_counter()
+        try:
+            # called straight away so a backend that checks its arguments
+            # up front still raises here. one whose ids is a generator only
+            # raises once iterated, and traced records that on the span.
+            keys = f(self, *args, **kwargs)
+        except Exception as e:
+            span.record_exception(e)
+            span.set_status(trace.StatusCode.ERROR, str(e))
+            span.end()
+            raise
+        return traced(keys, span, started, attributes)
+    return inner
+
+
+def instrument_backend(backend):
+    """
+    class decorator adding a span and metrics to each floe operation a
+    backend defines. does nothing when instrumentation is off.
+    :param backend: name for the floe.backend attribute
+    """
+    def decorator(cls):
+        if not OTEL_ENABLED:
+            return cls
+        for op in BACKEND_OPS:
+            f = cls.__dict__.get(op)
+            if f is None:
+                continue
+            setattr(cls, op, _trace_ids(f, backend) if op == 'ids'
+                    else _trace_op(f, backend, op))
+        return cls
+    return decorator
+
+
+def child_span(f):
+    """
+    run a method in a span named after it, a child of whatever op called
+    it. the first argument's length, when it has one, is the floe.keys
+    attribute.
+    """
+    if not OTEL_ENABLED:
+        return f
+
+    @functools.wraps(f)
+    def inner(self, *args, **kwargs):
+        attributes = {}
+        if args and hasattr(args[0], '__len__'):
+            attributes['floe.keys'] = len(args[0])
+        with _tracer.start_as_current_span(f.__qualname__,
+                                           attributes=attributes):
+            return f(self, *args, **kwargs)
+    return inner
+
+
+def client_span(f):
+    """
+    wrap a method taking (endpoint, method, path, **kwargs) that makes an
+    http request, in a client span, and pass the trace on to the server in
+    w3c traceparent and tracestate headers.
+    """
+    if not OTEL_ENABLED:
+        return f
+
+    @functools.wraps(f)
+    def inner(self, endpoint, method, path, **kwargs):
+        attributes = {'http.request.method': method,
+                      'url.full': endpoint.url + path}
+        with _tracer.start_as_current_span(
+                method, kind=trace.SpanKind.CLIENT,
+                attributes=attributes) as span:
+            headers = dict(kwargs.get('headers') or {})
+            propagate.inject(headers)
+            kwargs['headers'] = headers
+            resp = f(self, endpoint, method, path, **kwargs)
+            span.set_attribute('http.response.status_code', resp.status_code)
+            return resp
+    return inner
+
+
+def propagate_context(func):
+    """
+    func, carrying the current span and op over to the pool thread that
+    runs it.
+    """
+    if not OTEL_ENABLED:
+        return func
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        # a context can only be entered by one thread at a time
+        return context.copy().run(func, *args, **kwargs)
+    return inner
+
+
+def record_pool_wait(backend, seconds):
+    """
+    record a wait for a pooled connection.
+    """
+    if OTEL_ENABLED:
+        _pool_wait.record(seconds, {'floe.backend': backend})
@@ -1,23 +1,132 @@
+import logging
+import threading
+import time
 import requests
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import count
+from urllib.parse import urlsplit, urlunsplit
 from .exceptions import FloeException, FloeWriteException, \
     FloeDeleteException, FloeConfigurationException, FloeInvalidKeyException, \
     FloeOperationalException, FloeReadException
-from .helpers import sanitize_key
-from concurrent.futures import ThreadPoolExecutor
+from .helpers import sanitize_key, to_bool
+from .otel_instrumentation import instrument_backend, client_span, \
+    propagate_context
+
+logger = logging.getLogger(__name__)
 
 FLOE_REST_TIMEOUT = 30
 FLOE_TASK_TIMEOUT = 60
 
+# latencies kept per server for the hedge delay and stats
+LATENCY_WINDOW = 200
+
+# until this many latencies are known the hedge delay is the default
+MIN_HEDGE_SAMPLES = 20
+DEFAULT_HEDGE_DELAY = 0.05
+
+
+def split_base_urls(base_url):
+    """
+    expand http://h1,h2:8080/ns into a base url per host.
+    """
+    parts = urlsplit(base_url)
+    return [urlunsplit(parts._replace(netloc=host))
+            for host in parts.netloc.split(',') if host]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class RestEndpoint(object):
+    """
+    the recent latencies and health of one floe server.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0
+        self.ejected_until = 0
+        self.lock = threading.Lock()
+
+    def succeeded(self, seconds):
+        with self.lock:
+            self.requests += 1
+            self.failures = 0
+            self.latencies.append(seconds)
+
+    def failed(self, eject_after, eject_time):
+        with self.lock:
+            self.requests += 1
+            self.errors += 1
+            self.failures += 1
+            if self.failures >= eject_after:
+                self.failures = 0
+                self.ejected_until = time.monotonic() + eject_time
+                logger.warning('ejecting floe server %s for %ss',
+                               self.url, eject_time)
+
+    def healthy(self, now):
+        return self.ejected_until <= now
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            stats = {'url': self.url, 'requests': self.requests,
+                     'errors': self.errors,
+                     'ejected': not self.healthy(time.monotonic())}
+        stats['p50'] = percentile(latencies, 50)
+        stats['p99'] = percentile(latencies, 99)
+        return stats
+
+
+@instrument_backend('http')
 class RestClientFloe(object):
+    """
+    Talks to one or more equivalent floe servers. With several, given as
+    http://h1,h2/ns, requests are spread over the healthy ones, a server
+    that keeps failing is ejected for a while, and a get that is slower
+    than the recent hedge_percentile latency is sent to a second server
+    too, taking whichever answers first.
+    """
 
     queue_size = 10
 
     session = requests.Session()
 
-    def __init__(self, base_url):
-        self._baseurl = base_url
+    def __init__(self, base_url, hedge=True, hedge_percentile=95,
+                 hedge_min_delay=0.005, eject_after=3, eject_time=10):
+        """
+        :param base_url: one or more comma separated hosts and a namespace
+        :param hedge: send slow gets to a second server
+        :param hedge_percentile: latency percentile a get must exceed
+            before it is hedged
+        :param hedge_min_delay: seconds to always wait before hedging
+        :param eject_after: consecutive failures before a server is ejected
+        :param eject_time: seconds an ejected server is left alone
+        """
+        self.endpoints = [RestEndpoint(url)
+                          for url in split_base_urls(base_url)]
+        if not self.endpoints:
+            raise FloeConfigurationException('no servers in %s' % base_url)
+        self._baseurl = self.endpoints[0].url
+        self.hedge = to_bool(hedge)
+        self.hedge_percentile = float(hedge_percentile)
+        self.hedge_min_delay = float(hedge_min_delay)
+        self.eject_after = int(eject_after)
+        self.eject_time = float(eject_time)
+        self.hedges = 0
+        self._next = count()
         self._pool = None
+        self._hedge_pool = None
 
     def raise_exception_from_response(self, resp):
         if resp.status_code == 200:
@@ -65,9 +174,117 @@ class RestClientFloe(object):
             self._pool = ThreadPoolExecutor(max_workers=self.queue_size)
         return self._pool
 
-    def get(self, key):
-        key = sanitize_key(key)
-        resp = self.session.get("%s/%s" % (self._baseurl, key), timeout=FLOE_REST_TIMEOUT)
+    @property
+    def hedge_pool(self):
+        # kept apart from pool so a get_multi filling pool can't starve the
+        # requests its own gets are waiting on
+        if self._hedge_pool is None:
+            self._hedge_pool = ThreadPoolExecutor(
+                max_workers=self.queue_size * 2,
+                thread_name_prefix='floe-rest-hedge')
+        return self._hedge_pool
+
+    def _order(self, offset=None):
+        """
+        the healthy servers starting from the next one in turn, or every
+        server if none are healthy.
+        """
+        now = time.monotonic()
+        healthy = [e for e in self.endpoints if e.healthy(now)] or \
+            self.endpoints
+        offset = next(self._next) if offset is None else offset
+        offset %= len(healthy)
+        return healthy[offset:] + healthy[:offset]
+
+    def _hedge_delay(self):
+        latencies = []
+        for endpoint in self.endpoints:
+            with endpoint.lock:
+                latencies.extend(endpoint.latencies)
+        if len(latencies) < MIN_HEDGE_SAMPLES:
+            return max(self.hedge_min_delay, DEFAULT_HEDGE_DELAY)
+        return max(self.hedge_min_delay,
+                   percentile(latencies, self.hedge_percentile))
+
+    @client_span
+    def _call(self, endpoint, method, path, **kwargs):
+        """
+        make one request to one server, recording how it went. a transport
+        error, or a 5xx that didn't come from a floe backend, counts against
+        the server. with several servers it raises FloeOperationalException
+        so the next one can be tried. with one there is nowhere to fail over
+        to, so the requests exception is raised and the response returned
+        as they always were.
+        """
+        several = len(self.endpoints) > 1
+        started = time.monotonic()
+        try:
+            resp = self.session.request(method, endpoint.url + path,
+                                        timeout=FLOE_REST_TIMEOUT, **kwargs)
+        except requests.RequestException as e:
+            endpoint.failed(self.eject_after, self.eject_time)
+            if not several:
+                raise
+            raise FloeOperationalException(
+                'unable to communicate with %s - %s' % (endpoint.url, e))
+
+        if resp.status_code >= 500 and 'X-ERR' not in resp.headers:
+            endpoint.failed(self.eject_after, self.eject_time)
+            if several:
+                raise FloeOperationalException(
+                    'unable to communicate with %s - %s' %
+                    (endpoint.url, resp.text))
+        else:
+            endpoint.succeeded(time.monotonic() - started)
+        return resp
+
+    def _request(self, method, path, endpoints=None, **kwargs):
+        """
+        send a request to the first server that answers, trying the next
+        one when a server can't be reached.
+        """
+        endpoints = endpoints or self._order()
+        for endpoint in endpoints[:-1]:
+            try:
+                return self._call(endpoint, method, path, **kwargs)
+            except FloeOperationalException as e:
+                logger.info('retrying on another server: %s', e.message)
+        return self._call(endpoints[-1], method, path, **kwargs)
+
+    def _hedged(self, method, path, endpoints):
+        """
+        send a request to the first server, and to the second as well if
+        the first is slower than the hedge delay or fails. whichever good
+        answer comes first wins. the other request is cancelled if it
+        hasn't started, otherwise its answer is dropped.
+        """
+        call = propagate_context(self._call)
+        first = self.hedge_pool.submit(call, endpoints[0], method, path)
+        done, _ = wait([first], timeout=self._hedge_delay())
+        if done and first.exception() is None:
+            return first.result()
+
+        if not done:
+            self.hedges += 1
+        second = self.hedge_pool.submit(call, endpoints[1], method, path)
+        pending = {second} if done else {first, second}
+        error = first.exception() if done else None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _get(self, key, endpoints):
+        path = '/%s' % key
+        if self.hedge and len(endpoints) > 1:
+            resp = self._hedged('GET', path, endpoints)
+        else:
+            resp = self._request('GET', path, endpoints)
         self.raise_exception_from_response(resp)
 
         if resp.status_code == 404:
@@ -78,28 +295,45 @@ class RestClientFloe(object):
 
         return resp.content
 
+    def stats(self):
+        """
+        the number of hedged gets, and the requests, errors, latencies and
+        health of each server.
+        :return: dict
+        """
+        return {'hedges': self.hedges,
+                'servers': [e.stats() for e in self.endpoints]}
+
+    def get(self, key):
+        key = sanitize_key(key)
+        return self._get(key, self._order())
+
     def set(self, key, value):
         key = sanitize_key(key)
-        resp = self.session.put("%s/%s" % (self._baseurl, key),
-                                data=value,
-                                headers={
-                                    'content-type': 'binary/octet-stream'},
-                                timeout=FLOE_REST_TIMEOUT
-                                )
+        resp = self._request('PUT', '/%s' % key,
+                             data=value,
+                             headers={
+                                 'content-type': 'binary/octet-stream'})
         self.raise_exception_from_response(resp)
 
     def delete(self, key):
         key = sanitize_key(key)
-        resp = self.session.delete("%s/%s" % (self._baseurl, key), timeout=FLOE_REST_TIMEOUT)
+        resp = self._request('DELETE', '/%s' % key)
         self.raise_exception_from_response(resp)
 
     def get_multi(self, keys):
         keys = [sanitize_key(key) for key in keys]
+        # start each key on the next server along, so the fan out is spread
+        # over all the healthy servers
+        start = next(self._next)
 
-        def _get(key):
-            return key, self.get(key)
+        def _get(item):
+            i, key = item
+            return key, self._get(key, self._order(start + i))
 
-        responses = list(self.pool.map(_get, keys, timeout=FLOE_TASK_TIMEOUT))
+        responses = list(self.pool.map(propagate_context(_get),
+                                       enumerate(keys),
+                                       timeout=FLOE_TASK_TIMEOUT))
 
         return {k: v for k, v in responses if v is not None}
 
@@ -110,7 +344,8 @@ class RestClientFloe(object):
             self.set(*row)
 
         # Iterate over the results to block until all requests finish
-        list(self.pool.map(_set, mapping.items(), timeout=FLOE_TASK_TIMEOUT))
+        list(self.pool.map(propagate_context(_set), mapping.items(),
+                           timeout=FLOE_TASK_TIMEOUT))
 
     def delete_multi(self, keys):
         for key in keys:
@@ -120,10 +355,11 @@ class RestClientFloe(object):
             self.delete(key)
 
         # Iterate over the results to block until all requests finish
-        list(self.pool.map(_delete, keys, timeout=FLOE_TASK_TIMEOUT))
+        list(self.pool.map(propagate_context(_delete), keys,
+                           timeout=FLOE_TASK_TIMEOUT))
 
     def ids(self):
-        resp = self.session.get(self._baseurl, timeout=FLOE_REST_TIMEOUT)
+        resp = self._request('GET', '')
         self.raise_exception_from_response(resp)
 
         buffer = b''
@@ -147,5 +383,5 @@ class RestClientFloe(object):
                 yield key
 
     def flush(self):
-        resp = self.session.delete(self._baseurl)
+        resp = self._request('DELETE', '')
         self.raise_exception_from_response(resp)
@@ -41,7 +41,12 @@ class RestServerFloeResource(object):
     def on_get(self, req, resp, domain, key):
         cs = get_connection(domain)
         response = cs.get(key)
-        resp.data = b'' if response is None else response
+        if response is None:
+            response = b''
+        elif not isinstance(response, bytes):
+            # backends may hand back a memoryview over an mmap
+            response = bytes(response)
+        resp.data = response
 
     @app_trace
     def on_put(self, req, resp, domain, key):
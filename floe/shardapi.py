@@ -0,0 +1,275 @@
+import bisect
+import hashlib
+import logging
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .helpers import sanitize_key, chunks
+from .exceptions import FloeConfigurationException
+
+logger = logging.getLogger(__name__)
+
+REBALANCE_BATCH_SIZE = 500
+
+
+def ring_hash(value):
+    return struct.unpack('>Q', hashlib.md5(
+        value.encode('utf-8')).digest()[:8])[0]
+
+
+class HashRing(object):
+    """
+    A consistent hash ring. Each shard owns vnodes points on the ring and a
+    key belongs to the shard with the first point at or after its hash, so
+    adding a shard only takes keys from its neighbours.
+    """
+
+    def __init__(self, names, vnodes=128):
+        if not names:
+            raise FloeConfigurationException('no shards configured')
+        points = sorted((ring_hash('%s#%s' % (name, i)), name)
+                        for name in names for i in range(vnodes))
+        self.names = list(names)
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def get(self, key):
+        i = bisect.bisect(self._hashes, ring_hash(key))
+        return self._names[i % len(self._names)]
+
+
+class ShardFloe(object):
+    """
+    Spreads keys across several floes with consistent hashing. The multi
+    operations are split per shard and run concurrently.
+
+    To add a shard, list it in shards and pass the old list as previous.
+    Reads that miss on a key's new shard then fall back to its old one
+    until rebalance() has moved the keys across. While previous is set,
+    writes through this object and the moves of rebalance() wait for each
+    other key by key.
+    """
+
+    def __init__(self, shards, vnodes=128, previous=None, parallelism=8):
+        """
+        :param shards: dict of shard name to floe. keys are placed by name,
+            so the order doesn't matter but the names must stay the same.
+        :param vnodes: points per shard on the ring
+        :param previous: the shard names before a shard was added
+        :param parallelism: shards written or read at once
+        """
+        self.shards = shards
+        self.vnodes = int(vnodes)
+        self.ring = HashRing(sorted(shards), self.vnodes)
+        self.previous = None
+        if previous:
+            missing = set(previous) - set(shards)
+            if missing:
+                raise FloeConfigurationException(
+                    'previous shards %s are not configured' %
+                    ','.join(sorted(missing)))
+            self.previous = HashRing(sorted(previous), self.vnodes)
+        self.parallelism = int(parallelism)
+        self._executor = None
+        # writes in progress per key, and keys being moved by rebalance. a
+        # key is only moved while nothing is writing it, and writers wait
+        # for a move to finish, so a move never clobbers a newer write.
+        self._busy = {}
+        self._moving = set()
+        self._cond = threading.Condition()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.parallelism,
+                thread_name_prefix='floe-shard')
+        return self._executor
+
+    def _group(self, keys, ring=None):
+        ring = ring or self.ring
+        groups = {}
+        for key in keys:
+            groups.setdefault(ring.get(key), []).append(key)
+        return groups
+
+    def _fan_out(self, fn, groups):
+        """
+        call fn(shard, items) for each group, concurrently when there is
+        more than one, and return the results by shard name.
+        """
+        if len(groups) == 1:
+            name, items = next(iter(groups.items()))
+            return {name: fn(self.shards[name], items)}
+        futures = {name: self.executor.submit(fn, self.shards[name], items)
+                   for name, items in groups.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+    def _begin_write(self, keys):
+        if self.previous is None:
+            return
+        with self._cond:
+            self._cond.wait_for(lambda: self._moving.isdisjoint(keys))
+            for key in keys:
+                self._busy[key] = self._busy.get(key, 0) + 1
+
+    def _end_write(self, keys):
+        if self.previous is None:
+            return
+        with self._cond:
+            for key in keys:
+                busy = self._busy.pop(key) - 1
+                if busy:
+                    self._busy[key] = busy
+            self._cond.notify_all()
+
+    def _claim(self, keys):
+        """
+        wait until nothing is writing or moving keys, then mark them as
+        moving.
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: not any(key in self._busy or key in self._moving
+                                for key in keys))
+            self._moving.update(keys)
+
+    def _release(self, keys):
+        with self._cond:
+            self._moving.difference_update(keys)
+            self._cond.notify_all()
+
+    def shard_for(self, key):
+        """
+        the name of the shard a key belongs to
+        :param key:
+        :return:
+        """
+        return self.ring.get(sanitize_key(key))
+
+    def get(self, key):
+        return self.get_multi([key]).get(sanitize_key(key))
+
+    def get_multi(self, keys):
+        keys = [sanitize_key(key) for key in keys]
+        result = {}
+        for found in self._fan_out(lambda shard, items: shard.get_multi(
+                items), self._group(keys)).values():
+            result.update(found)
+
+        if self.previous is not None:
+            missing = [key for key in keys if key not in result and
+                       self.previous.get(key) != self.ring.get(key)]
+            if missing:
+                groups = self._group(missing, self.previous)
+                for found in self._fan_out(
+                        lambda shard, items: shard.get_multi(items),
+                        groups).values():
+                    result.update(found)
+        return result
+
+    def set(self, key, bin_data):
+        key = sanitize_key(key)
+        self._begin_write([key])
+        try:
+            return self.shards[self.ring.get(key)].set(key, bin_data)
+        finally:
+            self._end_write([key])
+
+    def set_multi(self, mapping):
+        mapping = {sanitize_key(key): value for key, value in mapping.items()}
+        self._begin_write(mapping)
+        try:
+            self._fan_out(
+                lambda shard, items: shard.set_multi(
+                    {key: mapping[key] for key in items}),
+                self._group(mapping))
+        finally:
+            self._end_write(mapping)
+
+    def delete(self, key):
+        return self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        """
+        delete keys from their shard, and from their previous shard while a
+        rebalance is pending so the old copy can't be read back.
+        :param keys:
+        :return:
+        """
+        keys = list(dict.fromkeys(sanitize_key(key) for key in keys))
+        groups = self._group(keys)
+        if self.previous is not None:
+            for name, items in self._group(keys, self.previous).items():
+                groups.setdefault(name, []).extend(items)
+        self._begin_write(keys)
+        try:
+            self._fan_out(lambda shard, items: shard.delete_multi(items),
+                          groups)
+        finally:
+            self._end_write(keys)
+
+    def ids(self):
+        """
+        interleave the ids of every shard, taking one from each in turn.
+        while a rebalance is pending a key being moved can be listed twice.
+        :return:
+        """
+        streams = [iter(self.shards[name].ids()) for name in self.ring.names]
+        while streams:
+            for stream in list(streams):
+                try:
+                    yield next(stream)
+                except StopIteration:
+                    streams.remove(stream)
+
+    def flush(self):
+        self._fan_out(lambda shard, items: shard.flush(),
+                      {name: None for name in self.shards})
+
+    def rebalance(self, batch_size=REBALANCE_BATCH_SIZE):
+        """
+        move the keys whose shard changed to the shard that now owns them.
+        only the shards named in previous are scanned, and only the keys the
+        ring gives to another shard are copied. each batch is read, copied
+        and deleted while writes to its keys through this object wait, and a
+        key already written to its new shard is left alone, so a newer write
+        or a delete is never undone by the old copy. writes from other
+        processes or connections aren't held back, so stop them while this
+        runs. once this returns, drop previous from the config.
+        :param batch_size: keys read and written per call
+        :return: number of keys moved
+        """
+        if self.previous is None:
+            return 0
+
+        def rebalance_shard(source, source_name):
+            moved = 0
+            stale = (key for key in source.ids()
+                     if self.ring.get(key) != source_name)
+            for batch in chunks(stale, batch_size):
+                self._claim(batch)
+                try:
+                    values = source.get_multi(batch)
+                    for name, keys in self._group(values).items():
+                        target = self.shards[name]
+                        existing = target.get_multi(keys)
+                        copies = {key: values[key] for key in keys
+                                  if key not in existing}
+                        if copies:
+                            target.set_multi(copies)
+                        moved += len(copies)
+                    source.delete_multi(batch)
+                finally:
+                    self._release(batch)
+            logger.info('moved %s keys off shard %s', moved, source_name)
+            return moved
+
+        # its own threads, so the shards being scanned don't hold the pool
+        # that writes waiting on their keys need
+        names = self.previous.names
+        with ThreadPoolExecutor(max_workers=len(names),
+                                thread_name_prefix='floe-rebalance') as pool:
+            futures = [pool.submit(rebalance_shard, self.shards[name], name)
+                       for name in names]
+            return sum(future.result() for future in futures)
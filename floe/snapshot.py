@@ -0,0 +1,310 @@
+"""
+export a floe domain to a snapshot file and import it again, into any
+backend.
+
+    floe-snapshot export DOMAIN FILE [--codec zlib]
+    floe-snapshot import DOMAIN FILE [--workers 4]
+
+FILE may be - for stdout or stdin.
+
+A snapshot starts with MAGIC and a version byte, followed by blocks. Each
+block has a header of codec id, raw length, stored length and the crc32 of
+the stored bytes, then the stored bytes: the block's records, compressed
+with the codec. A record is a key length, a value length, the key and the
+value. The last block has the END codec id and holds the record count, so
+a truncated snapshot is caught.
+"""
+import argparse
+import json
+import logging
+import struct
+import sys
+import threading
+import time
+import zlib
+from .codecapi import CODECS, DECOMPRESSORS
+from .connector import connect
+from .helpers import chunks, pipeline, parse_size
+from .exceptions import FloeConfigurationException, FloeReadException
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'FLOESNAP'
+VERSION = 1
+FILE_HEADER = struct.Struct('>8sB')
+BLOCK_HEADER = struct.Struct('>BIII')
+RECORD_HEADER = struct.Struct('>HI')
+END_BLOCK = struct.Struct('>Q')
+
+NONE = 0
+END = 0xff
+
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+
+class SnapshotWriter(object):
+    """
+    writes records to a snapshot, a block of about block_size bytes at a
+    time.
+    """
+
+    def __init__(self, fileobj, codec='zlib', block_size=DEFAULT_BLOCK_SIZE,
+                 level=None):
+        if codec not in CODECS and codec != 'none':
+            raise FloeConfigurationException('invalid codec %s' % codec)
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = level
+        self.block_size = parse_size(block_size)
+        self.records = 0
+        self.bytes = 0
+        self._block = []
+        self._block_bytes = 0
+        self.fileobj.write(FILE_HEADER.pack(MAGIC, VERSION))
+
+    def add(self, key, value):
+        key = key.encode('utf-8')
+        self._block.append(RECORD_HEADER.pack(len(key), len(value)))
+        self._block.append(key)
+        self._block.append(value)
+        self._block_bytes += RECORD_HEADER.size + len(key) + len(value)
+        self.records += 1
+        self.bytes += len(value)
+        if self._block_bytes >= self.block_size:
+            self._flush()
+
+    def _write_block(self, codec_id, raw_len, data):
+        self.fileobj.write(BLOCK_HEADER.pack(codec_id, raw_len, len(data),
+                                             zlib.crc32(data)))
+        self.fileobj.write(data)
+
+    def _flush(self):
+        if not self._block:
+            return
+        raw = b''.join(self._block)
+        codec_id, data = NONE, raw
+        if self.codec != 'none':
+            codec_id, compress, _, default_level = CODECS[self.codec]
+            compressed = compress(
+                raw, default_level if self.level is None else self.level)
+            if len(compressed) < len(raw):
+                data = compressed
+            else:
+                codec_id = NONE
+        self._write_block(codec_id, len(raw), data)
+        self._block = []
+        self._block_bytes = 0
+
+    def close(self):
+        """
+        write the last block and the end marker.
+        :return:
+        """
+        self._flush()
+        end = END_BLOCK.pack(self.records)
+        self._write_block(END, len(end), end)
+        self.fileobj.flush()
+
+
+def _read_exactly(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise FloeReadException('snapshot is truncated')
+    return data
+
+
+def read_blocks(fileobj, end=None):
+    """
+    iterate through the (codec id, raw length, stored bytes) of each block
+    of a snapshot, checking each block's crc. the record count from the end
+    block is put in end['records'].
+    """
+    magic, version = FILE_HEADER.unpack(
+        _read_exactly(fileobj, FILE_HEADER.size))
+    if magic != MAGIC:
+        raise FloeReadException('not a floe snapshot')
+    if version != VERSION:
+        raise FloeReadException('unsupported snapshot version %s' % version)
+
+    while True:
+        codec_id, raw_len, stored_len, crc = BLOCK_HEADER.unpack(
+            _read_exactly(fileobj, BLOCK_HEADER.size))
+        data = _read_exactly(fileobj, stored_len)
+        if zlib.crc32(data) != crc:
+            raise FloeReadException('snapshot block failed its checksum')
+        if codec_id == END:
+            if end is not None:
+                end['records'] = END_BLOCK.unpack(data)[0]
+            return
+        yield codec_id, raw_len, data
+
+
+def decode_block(codec_id, raw_len, data):
+    """
+    the (key, value) records of a block.
+    """
+    if codec_id != NONE:
+        try:
+            _, decompress = DECOMPRESSORS[codec_id]
+        except KeyError:
+            raise FloeReadException('unknown snapshot codec %s' % codec_id)
+        try:
+            data = decompress(data)
+        except Exception as e:
+            raise FloeReadException('failed to decompress block: %s' % e)
+    if len(data) != raw_len:
+        raise FloeReadException('snapshot block has the wrong length')
+
+    records = []
+    view = memoryview(data)
+    offset = 0
+    while offset < raw_len:
+        if offset + RECORD_HEADER.size > raw_len:
+            raise FloeReadException('snapshot block has a torn record')
+        key_len, value_len = RECORD_HEADER.unpack_from(view, offset)
+        offset += RECORD_HEADER.size
+        key = bytes(view[offset:offset + key_len]).decode('utf-8')
+        offset += key_len
+        records.append((key, bytes(view[offset:offset + value_len])))
+        offset += value_len
+    if offset != raw_len:
+        raise FloeReadException('snapshot block has a torn record')
+    return records
+
+
+def read_snapshot(fileobj):
+    """
+    iterate through the (key, value) records of a snapshot.
+    """
+    end = {}
+    count = 0
+    for block in read_blocks(fileobj, end):
+        for record in decode_block(*block):
+            count += 1
+            yield record
+    if end['records'] != count:
+        raise FloeReadException('snapshot has %s records, expected %s' %
+                                (count, end['records']))
+
+
+def scan(floe, batch_size=500):
+    """
+    every (key, value) pair of a floe, using the backend's own items() when
+    it has one and ids() with get_multi otherwise.
+    """
+    if hasattr(floe, 'items'):
+        return floe.items()
+
+    def items():
+        for keys in chunks(floe.ids(), batch_size):
+            for item in floe.get_multi(keys).items():
+                yield item
+    return items()
+
+
+def export_snapshot(domain, fileobj, codec='zlib',
+                    block_size=DEFAULT_BLOCK_SIZE, batch_size=500):
+    """
+    write every key of a domain to a snapshot.
+    :param domain: domain name or floe
+    :param fileobj: binary file to write to
+    :param codec: none, zlib, lzma or bz2
+    :param block_size: raw bytes per block
+    :param batch_size: keys per get_multi for backends without items()
+    :return: dict of keys and value bytes written, and seconds taken
+    """
+    floe = connect(domain) if isinstance(domain, str) else domain
+    started = time.monotonic()
+    writer = SnapshotWriter(fileobj, codec=codec, block_size=block_size)
+    for key, value in scan(floe, batch_size):
+        writer.add(key, value)
+    writer.close()
+    result = {'keys': writer.records, 'bytes': writer.bytes,
+              'seconds': time.monotonic() - started}
+    logger.info('exported %(keys)s keys, %(bytes)s bytes in %(seconds).1fs',
+                result)
+    return result
+
+
+def import_snapshot(domain, fileobj, workers=4, batch_size=500):
+    """
+    load a snapshot into a domain with set_multi. blocks are read in order
+    and decoded and written by several workers at once.
+    :param domain: domain name or floe
+    :param fileobj: binary file to read from
+    :param workers: blocks loaded at once
+    :param batch_size: keys per set_multi
+    :return: dict of keys and value bytes loaded, and seconds taken
+    """
+    floe = connect(domain) if isinstance(domain, str) else domain
+    started = time.monotonic()
+    lock = threading.Lock()
+    result = {'keys': 0, 'bytes': 0}
+
+    def load_block(block):
+        records = decode_block(*block)
+        for batch in chunks(records, batch_size):
+            floe.set_multi(dict(batch))
+        return len(records), sum(len(value) for _, value in records)
+
+    def done(seq, block, counts):
+        with lock:
+            result['keys'] += counts[0]
+            result['bytes'] += counts[1]
+
+    end = {}
+    pipeline(read_blocks(fileobj, end), load_block, int(workers), done)
+    if end['records'] != result['keys']:
+        raise FloeReadException('snapshot has %s records, expected %s' %
+                                (result['keys'], end['records']))
+    result['seconds'] = time.monotonic() - started
+    logger.info('imported %(keys)s keys, %(bytes)s bytes in %(seconds).1fs',
+                result)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='floe-snapshot',
+        description='export a floe domain to a snapshot or import one')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='write a domain to a file')
+    export.add_argument('domain')
+    export.add_argument('file', help='snapshot to write, - for stdout')
+    export.add_argument('--codec', default='zlib',
+                        choices=['none'] + sorted(CODECS))
+    export.add_argument('--block-size', default=DEFAULT_BLOCK_SIZE)
+    load = commands.add_parser('import', help='load a file into a domain')
+    load.add_argument('domain')
+    load.add_argument('file', help='snapshot to read, - for stdin')
+    load.add_argument('--workers', type=int, default=4)
+    load.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'export':
+        fileobj = sys.stdout.buffer if args.file == '-' \
+            else open(args.file, 'wb')
+        try:
+            result = export_snapshot(args.domain, fileobj, codec=args.codec,
+                                     block_size=args.block_size)
+        finally:
+            if fileobj is not sys.stdout.buffer:
+                fileobj.close()
+    else:
+        fileobj = sys.stdin.buffer if args.file == '-' \
+            else open(args.file, 'rb')
+        try:
+            result = import_snapshot(args.domain, fileobj,
+                                     workers=args.workers,
+                                     batch_size=args.batch_size)
+        finally:
+            if fileobj is not sys.stdin.buffer:
+                fileobj.close()
+    json.dump(result, sys.stderr)
+    sys.stderr.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+import os
+import errno
+import sqlite3
+import threading
+from contextlib import contextmanager
+from .helpers import sanitize_key, chunks
+from .exceptions import FloeReadException, FloeWriteException, \
+    FloeDeleteException
+
+# stay under SQLITE_MAX_VARIABLE_NUMBER on older builds of sqlite
+MAX_VARIABLES = 900
+
+
+class SQLiteFloe(object):
+    """
+    An implementation of cold storage backed by a single sqlite database
+    file. Useful for single node deployments with more keys than FileFloe
+    can comfortably handle.
+    """
+
+    def __init__(self, path, table, init_disable=False, timeout=30,
+                 page_size=1000):
+        """
+        specify the database file and table. The database runs in WAL mode
+        so readers don't block the writer. Each thread gets its own
+        connection, created on demand.
+        :param path:
+        :param table:
+        :param init_disable:
+        :param timeout: seconds to wait for a lock held by another writer
+        :param page_size: number of ids fetched per query by ids()
+        """
+        self.path = path
+        self.table = table
+        self.timeout = float(timeout)
+        self.page_size = int(page_size)
+        self._local = threading.local()
+
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name):
+            try:
+                os.makedirs(dir_name)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        if not init_disable:
+            statement = "CREATE TABLE IF NOT EXISTS `{}` (" \
+                        "`pk` TEXT NOT NULL PRIMARY KEY, " \
+                        "`bin` BLOB NOT NULL" \
+                        ") WITHOUT ROWID".format(self.table)
+            self._connection().execute(statement)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None leaves us in autocommit mode, and the
+            # multi operations open their own transaction explicitly.
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            # a failed commit leaves the transaction open on this thread's
+            # connection, unless sqlite already rolled it back itself
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+
+    def get(self, pk):
+        """
+        get the value of a given key
+        :param pk:
+        :return:
+        """
+        pk = sanitize_key(pk)
+        statement = "SELECT `bin` FROM `{}` WHERE `pk` = ?".format(self.table)
+        try:
+            for row in self._connection().execute(statement, (pk,)):
+                return row[0]
+        except sqlite3.Error as e:
+            raise FloeReadException(e)
+
+    def get_multi(self, keys):
+        """
+        get the values for a list of keys as a dictionary.
+        keys that are not found will be missing from the response.
+
+        :param keys:
+        :return:
+        """
+        if not keys:
+            return {}
+        keys = [sanitize_key(key) for key in keys]
+        result = {}
+        try:
+            conn = self._connection()
+            for chunk in chunks(keys, MAX_VARIABLES):
+                statement = "SELECT `pk`, `bin` FROM `{}` " \
+                            "WHERE `pk` IN ({})".format(
+                                self.table, ', '.join(['?' for _ in chunk]))
+                result.update(conn.execute(statement, chunk))
+        except sqlite3.Error as e:
+            raise FloeReadException(e)
+        return result
+
+    def set(self, pk, bin_data):
+        """
+        set a given key
+        :param pk:
+        :param bin_data:
+        :return:
+        """
+        return self.set_multi({pk: bin_data})
+
+    def set_multi(self, mapping):
+        """
+        set a series of keys based on the dictionary passed in.
+        all the keys are written in a single transaction.
+        :param mapping: dict
+        :return:
+        """
+        rows = [(sanitize_key(key), value) for key, value in mapping.items()]
+        if not rows:
+            return
+        statement = "INSERT OR REPLACE INTO `{}` (`pk`, `bin`) " \
+                    "VALUES (?, ?)".format(self.table)
+        try:
+            with self._transaction() as conn:
+                conn.executemany(statement, rows)
+        except sqlite3.Error as e:
+            raise FloeWriteException(e)
+
+    def delete(self, key):
+        """
+        delete a given key
+        :param key:
+        :return:
+        """
+        return self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        """
+        delete a set of given keys in a single transaction
+        :param keys:
+        :return:
+        """
+        if not keys:
+            return
+        keys = [(sanitize_key(key),) for key in keys]
+        statement = "DELETE FROM `{}` WHERE `pk` = ?".format(self.table)
+        try:
+            with self._transaction() as conn:
+                conn.executemany(statement, keys)
+        except sqlite3.Error as e:
+            raise FloeDeleteException(e)
+
+    def flush(self):
+        """
+        remove all keys from a given database
+        :return:
+        """
+        statement = "DELETE FROM `{}`".format(self.table)
+        with self._transaction() as conn:
+            conn.execute(statement)
+
+    def ids(self, after=None):
+        """
+        iterate through all ids in key order, one page at a time so no read
+        transaction is held open between pages. pass the last id seen as
+        `after` to resume an interrupted crawl.
+        :param after:
+        :return:
+        """
+        statement = "SELECT `pk` FROM `{}` WHERE `pk` > ? " \
+                    "ORDER BY `pk` LIMIT ?".format(self.table)
+        after = '' if after is None else sanitize_key(after)
+        while True:
+            try:
+                page = self._connection().execute(
+                    statement, (after, self.page_size)).fetchall()
+            except sqlite3.Error as e:
+                raise FloeReadException(e)
+            for pk, in page:
+                yield pk
+            if len(page) < self.page_size:
+                return
+            after = page[-1][0]
+
+    def items(self, after=None):
+        """
+        iterate through all (key, value) pairs in key order, a page at a
+        time like ids().
+        :param after:
+        :return:
+        """
+        statement = "SELECT `pk`, `bin` FROM `{}` WHERE `pk` > ? " \
+                    "ORDER BY `pk` LIMIT ?".format(self.table)
+        after = '' if after is None else sanitize_key(after)
+        while True:
+            try:
+                page = self._connection().execute(
+                    statement, (after, self.page_size)).fetchall()
+            except sqlite3.Error as e:
+                raise FloeReadException(e)
+            for item in page:
+                yield item
+            if len(page) < self.page_size:
+                return
+            after = page[-1][0]
+
+    def drop_table(self):
+        statement = "DROP TABLE IF EXISTS `{}`".format(self.table)
+        self._connection().execute(statement)
@@ -0,0 +1,288 @@
+import logging
+import threading
+from collections import OrderedDict
+from .helpers import sanitize_key, chunks, current_time, parse_size, \
+    to_bool
+
+logger = logging.getLogger(__name__)
+
+MOVE_BATCH_SIZE = 500
+
+# forget the write versions once there are this many, so they are bounded
+VERSIONS_PRUNE_SIZE = 100000
+
+
+class TieredFloe(object):
+    """
+    Combines a small fast hot floe with a large cold one. Writes go to the
+    hot tier, reads try hot then cold and copy cold hits back to hot, and a
+    background thread moves keys that are idle or over the hot tier's byte
+    budget down to cold.
+
+    The access times and sizes the demoter works from are kept in memory
+    for the keys this process has seen in the hot tier. Keys already there
+    are picked up by a scan when the demoter starts. Only one process
+    should demote a given hot tier.
+    """
+
+    def __init__(self, hot, cold, hot_bytes=0, max_idle=0,
+                 demote_interval=10, promote=True):
+        """
+        :param hot: the floe for recently used keys
+        :param cold: the floe for everything else
+        :param hot_bytes: byte budget for the hot tier, as bytes or a size
+            such as 1GB. 0 for no budget.
+        :param max_idle: seconds since a key was last used before it is
+            demoted, 0 to never demote on age
+        :param demote_interval: seconds between passes of the demoter
+        :param promote: copy cold hits into the hot tier
+        """
+        self.hot = hot
+        self.cold = cold
+        self.hot_bytes = parse_size(hot_bytes)
+        self.max_idle = float(max_idle)
+        self.demote_interval = float(demote_interval)
+        self.promote = to_bool(promote)
+
+        # key -> (size, last access) for the keys in the hot tier, least
+        # recently used first
+        self._tracked = OrderedDict()
+        self._tracked_bytes = 0
+        # writes in progress per key, and keys being moved between tiers.
+        # a key is only moved while nothing is writing it, and writers wait
+        # for a move to finish, so a move never clobbers a newer write.
+        self._busy = {}
+        self._moving = set()
+        self._versions = {}
+        self._epoch = 0
+        self._cond = threading.Condition()
+        self._closed = threading.Event()
+        self._thread = None
+        if self.hot_bytes or self.max_idle:
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='floe-tiered-demoter')
+            self._thread.start()
+
+    def _begin_write(self, keys):
+        with self._cond:
+            self._cond.wait_for(lambda: self._moving.isdisjoint(keys))
+            for key in keys:
+                self._busy[key] = self._busy.get(key, 0) + 1
+
+    def _end_write(self, keys, sizes):
+        """
+        :param keys: the keys written
+        :param sizes: key -> size in the hot tier, or None once deleted. a
+            key left out, as after a failed write, keeps its tracking so a
+            value still in the hot tier is aged out as before.
+        """
+        now = current_time()
+        with self._cond:
+            for key in keys:
+                busy = self._busy.pop(key) - 1
+                if busy:
+                    self._busy[key] = busy
+                if len(self._versions) > VERSIONS_PRUNE_SIZE:
+                    self._versions.clear()
+                    self._epoch += 1
+                self._versions[key] = self._versions.get(key, 0) + 1
+                if key in sizes:
+                    self._untrack(key)
+                    if sizes[key] is not None:
+                        self._track(key, sizes[key], now)
+            self._cond.notify_all()
+
+    def _track(self, key, size, now):
+        self._tracked[key] = (size, now)
+        self._tracked_bytes += size
+
+    def _untrack(self, key):
+        entry = self._tracked.pop(key, None)
+        if entry is not None:
+            self._tracked_bytes -= entry[0]
+
+    def _touch(self, keys):
+        now = current_time()
+        with self._cond:
+            for key in keys:
+                entry = self._tracked.get(key)
+                if entry is not None:
+                    self._tracked[key] = (entry[0], now)
+                    self._tracked.move_to_end(key)
+
+    def _claim(self, keys, versions=None):
+        """
+        mark keys nobody is writing as moving. with versions, only keys not
+        written since the versions were read are claimed.
+        """
+        with self._cond:
+            if versions is not None and versions[0] != self._epoch:
+                return []
+            claimed = [
+                key for key in keys
+                if key not in self._busy and key not in self._moving and
+                (versions is None or
+                 self._versions.get(key, 0) == versions[1][key])]
+            self._moving.update(claimed)
+            return claimed
+
+    def _release(self, keys):
+        with self._cond:
+            self._moving.difference_update(keys)
+            self._cond.notify_all()
+
+    def _snapshot_versions(self, keys):
+        with self._cond:
+            return self._epoch, {key: self._versions.get(key, 0)
+                                 for key in keys}
+
+    def _promote(self, values, versions):
+        claimed = self._claim(values, versions)
+        if not claimed:
+            return
+        try:
+            self.hot.set_multi({key: values[key] for key in claimed})
+            now = current_time()
+            with self._cond:
+                for key in claimed:
+                    self._untrack(key)
+                    self._track(key, len(values[key]), now)
+        except Exception as e:
+            logger.warning('failed to promote %s keys: %s', len(claimed), e)
+        finally:
+            self._release(claimed)
+
+    def get(self, key):
+        return self.get_multi([key]).get(sanitize_key(key))
+
+    def get_multi(self, keys):
+        keys = [sanitize_key(key) for key in keys]
+        versions = self._snapshot_versions(keys) if self.promote else None
+        result = self.hot.get_multi(keys)
+        self._touch(result)
+        missing = [key for key in keys if key not in result]
+        if missing:
+            found = self.cold.get_multi(missing)
+            result.update(found)
+            if found and self.promote:
+                self._promote(found, versions)
+        return result
+
+    def set(self, key, bin_data):
+        return self.set_multi({key: bin_data})
+
+    def set_multi(self, mapping):
+        mapping = {sanitize_key(key): value for key, value in mapping.items()}
+        self._begin_write(mapping)
+        sizes = {}
+        try:
+            self.hot.set_multi(mapping)
+            sizes = {key: len(value) for key, value in mapping.items()}
+        finally:
+            self._end_write(mapping, sizes)
+
+    def delete(self, key):
+        return self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        keys = list(dict.fromkeys(sanitize_key(key) for key in keys))
+        self._begin_write(keys)
+        sizes = {}
+        try:
+            self.hot.delete_multi(keys)
+            sizes = {key: None for key in keys}
+            self.cold.delete_multi(keys)
+        finally:
+            self._end_write(keys, sizes)
+
+    def ids(self):
+        """
+        the keys in either tier, each once. the hot ids are held in memory
+        while the cold ones are read.
+        """
+        seen = set()
+        for key in self.hot.ids():
+            seen.add(key)
+            yield key
+        for key in self.cold.ids():
+            if key not in seen:
+                yield key
+
+    def flush(self):
+        self.hot.flush()
+        self.cold.flush()
+        with self._cond:
+            self._tracked.clear()
+            self._tracked_bytes = 0
+
+    def _candidates(self):
+        """
+        the keys to demote, least recently used first: everything idle
+        longer than max_idle, then enough more to fit the byte budget.
+        """
+        cutoff = current_time() - self.max_idle if self.max_idle else None
+        with self._cond:
+            excess = self._tracked_bytes - self.hot_bytes \
+                if self.hot_bytes else 0
+            keys = []
+            for key, (size, accessed) in self._tracked.items():
+                if excess <= 0 and (cutoff is None or accessed >= cutoff):
+                    break
+                keys.append(key)
+                excess -= size
+            return keys
+
+    def demote(self):
+        """
+        run one pass of the demoter now.
+        :return: number of keys moved to the cold tier
+        """
+        moved = 0
+        for keys in chunks(self._candidates(), MOVE_BATCH_SIZE):
+            claimed = self._claim(keys)
+            if not claimed:
+                continue
+            try:
+                values = self.hot.get_multi(claimed)
+                if values:
+                    self.cold.set_multi(values)
+                self.hot.delete_multi(claimed)
+                with self._cond:
+                    for key in claimed:
+                        self._untrack(key)
+                moved += len(values)
+            finally:
+                self._release(claimed)
+        return moved
+
+    def _scan_hot(self):
+        """
+        start tracking the keys already in the hot tier.
+        """
+        for keys in chunks(self.hot.ids(), MOVE_BATCH_SIZE):
+            values = self.hot.get_multi(keys)
+            now = current_time()
+            with self._cond:
+                for key, value in values.items():
+                    if key not in self._tracked and key not in self._busy:
+                        self._track(key, len(value), now)
+
+    def _run(self):
+        try:
+            self._scan_hot()
+        except Exception:
+            logger.exception('failed to scan the hot tier')
+        while not self._closed.wait(self.demote_interval):
+            try:
+                self.demote()
+            except Exception:
+                logger.exception('failed to demote keys')
+
+    def close(self):
+        """
+        stop the demoter.
+        :return:
+        """
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
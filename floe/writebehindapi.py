@@ -0,0 +1,245 @@
+import logging
+import threading
+import time
+from .helpers import sanitize_key, chunks
+from .exceptions import FloeWriteException
+
+logger = logging.getLogger(__name__)
+
+# marks a queued delete
+DELETED = object()
+
+
+def log_error(e, values, deletes):
+    logger.error('write behind dropped %s writes and %s deletes: %s',
+                 len(values), len(deletes), e)
+
+
+class WriteBehindFloe(object):
+    """
+    Wraps a floe so set and delete return as soon as the write is queued in
+    memory. A background thread writes the queue through set_multi and
+    delete_multi, keeping only the last write to each key. Reads see queued
+    writes. Queued writes are lost if the process dies, so call
+    flush_pending() or close() before exiting.
+    """
+
+    def __init__(self, backend, max_pending=10000, batch_size=500,
+                 interval=0.05, block_timeout=None, retries=3,
+                 on_error=log_error):
+        """
+        :param backend: the floe to write to
+        :param max_pending: number of queued keys before writers block
+        :param batch_size: keys per set_multi or delete_multi call
+        :param interval: seconds to let writes pile up before a flush
+        :param block_timeout: seconds a writer waits for room in the queue
+            before FloeWriteException, None to wait forever
+        :param retries: attempts at a failed batch before giving up on it
+        :param on_error: called with the exception, the dict of values and
+            the list of deletes of a batch that could not be written
+        """
+        self.backend = backend
+        self.max_pending = int(max_pending)
+        self.batch_size = int(batch_size)
+        self.interval = float(interval)
+        self.block_timeout = None if block_timeout is None \
+            else float(block_timeout)
+        self.retries = int(retries)
+        self.on_error = on_error
+        self._pending = {}
+        self._inflight = {}
+        self._cond = threading.Condition()
+        # the flusher takes everything pending in rounds. a round is started
+        # when it is taken and completed once it is written or given up on.
+        self._started = 0
+        self._completed = 0
+        self._failed = 0
+        # the last failed round flush_pending has raised for
+        self._reported = 0
+        self._thread = None
+        self._closed = False
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='floe-write-behind')
+            self._thread.start()
+
+    def _enqueue(self, mapping):
+        deadline = None if self.block_timeout is None \
+            else time.monotonic() + self.block_timeout
+        with self._cond:
+            if self._closed:
+                raise FloeWriteException('write behind queue is closed')
+            self._start()
+            # wait for room for the whole mapping before queuing any of it,
+            # so a timeout leaves none of it to be written. a mapping bigger
+            # than max_pending goes in once the queue is empty.
+            while True:
+                new = sum(1 for key in mapping if key not in self._pending)
+                if not new or not self._pending or \
+                        len(self._pending) + new <= self.max_pending:
+                    break
+                remaining = None if deadline is None \
+                    else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise FloeWriteException('write behind queue full')
+                self._cond.wait(remaining)
+            self._pending.update(mapping)
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                if self.interval:
+                    # every write notifies, so wait out the whole interval
+                    # unless a full batch or close cuts it short
+                    self._cond.wait_for(
+                        lambda: len(self._pending) >= self.batch_size or
+                        self._closed, self.interval)
+                    if not self._pending:
+                        continue
+                self._inflight, self._pending = self._pending, {}
+                self._started += 1
+                batch = self._inflight
+                self._cond.notify_all()
+
+            failed = False
+            for keys in chunks(list(batch), self.batch_size):
+                if not self._write({key: batch[key] for key in keys}):
+                    failed = True
+
+            with self._cond:
+                self._inflight = {}
+                self._completed = self._started
+                if failed:
+                    self._failed = self._started
+                self._cond.notify_all()
+
+    def _write(self, batch):
+        values = {key: value for key, value in batch.items()
+                  if value is not DELETED}
+        deletes = [key for key, value in batch.items() if value is DELETED]
+        for attempt in range(self.retries):
+            try:
+                if values:
+                    self.backend.set_multi(values)
+                    values = {}
+                if deletes:
+                    self.backend.delete_multi(deletes)
+                return True
+            except Exception as e:
+                if attempt + 1 < self.retries:
+                    time.sleep(0.1 * 2 ** attempt)
+                    continue
+                try:
+                    self.on_error(e, values, deletes)
+                except Exception:
+                    logger.exception('write behind error callback failed')
+        return False
+
+    def _queued(self, key):
+        # called holding the lock. pending writes are newer than inflight
+        for queue in (self._pending, self._inflight):
+            if key in queue:
+                return True, queue[key]
+        return False, None
+
+    def flush_pending(self, timeout=None):
+        """
+        block until every write queued before the call has reached the
+        backend.
+        :param timeout: seconds to wait, None to wait forever
+        :return: True if the writes landed, False on timeout
+        :raises FloeWriteException: if any write since the last call that
+            raised could not be written, including ones that failed before
+            this call was made
+        """
+        with self._cond:
+            target = self._started + 1 if self._pending else self._started
+            if not self._cond.wait_for(lambda: self._completed >= target,
+                                       timeout):
+                return False
+            if self._failed > self._reported:
+                self._reported = self._failed
+                raise FloeWriteException('write behind failed to write')
+            return True
+
+    def close(self, timeout=None):
+        """
+        write everything queued and stop the background thread.
+        :return:
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def pending(self):
+        """
+        number of keys waiting to be written
+        :return:
+        """
+        with self._cond:
+            return len(self._pending) + len(self._inflight)
+
+    def get(self, key):
+        key = sanitize_key(key)
+        with self._cond:
+            queued, value = self._queued(key)
+        if queued:
+            return None if value is DELETED else value
+        return self.backend.get(key)
+
+    def get_multi(self, keys):
+        keys = [sanitize_key(key) for key in keys]
+        result, missing = {}, []
+        with self._cond:
+            for key in keys:
+                queued, value = self._queued(key)
+                if not queued:
+                    missing.append(key)
+                elif value is not DELETED:
+                    result[key] = value
+        if missing:
+            result.update(self.backend.get_multi(missing))
+        return result
+
+    def set(self, key, bin_data):
+        self._enqueue({sanitize_key(key): bin_data})
+
+    def set_multi(self, mapping):
+        self._enqueue({sanitize_key(key): value
+                       for key, value in mapping.items()})
+
+    def delete(self, key):
+        self._enqueue({sanitize_key(key): DELETED})
+
+    def delete_multi(self, keys):
+        self._enqueue({sanitize_key(key): DELETED for key in keys})
+
+    def ids(self, *args, **kwargs):
+        """
+        ids come from the backend once the queued writes have landed.
+        """
+        self.flush_pending()
+        return self.backend.ids(*args, **kwargs)
+
+    def flush(self):
+        """
+        drop the queued writes and flush the backend. the backend is
+        flushed even if writes already in flight fail.
+        :return:
+        """
+        with self._cond:
+            self._pending.clear()
+            self._cond.notify_all()
+        try:
+            self.flush_pending()
+        finally:
+            self.backend.flush()
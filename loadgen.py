@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+"""
+open loop http load generator for a floe server.
+
+requests are sent on a fixed schedule at the target rate whether or not
+earlier ones have been answered, so a slow server builds a queue instead of
+quietly slowing the generator down. latency is measured from when each
+request was due to be sent, which corrects for coordinated omission, and
+the service time from when it was actually sent is reported alongside.
+
+    ./run.py -p 3049 &
+    ./loadgen.py http://127.0.0.1:3049/test --rate 200,400,800 --duration 30 \\
+        --mix get=80,put=15,delete=4,ids=1 --distribution zipf --processes 4
+
+each comma separated rate is run in turn, to find where latency breaks
+down.
+"""
+
+import argparse
+import bisect
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+
+import requests
+
+OPS = ['get', 'put', 'delete', 'ids']
+
+# histogram buckets are this much wider than the last, so percentiles are
+# within 1% of the true value
+BUCKET_GROWTH = 1.01
+LOG_GROWTH = math.log(BUCKET_GROWTH)
+
+
+class Histogram(object):
+    """
+    a log bucketed latency histogram in microseconds that can be merged
+    across processes.
+    """
+
+    def __init__(self, counts=None, max_micros=0):
+        self.counts = {int(b): c for b, c in (counts or {}).items()}
+        self.total = sum(self.counts.values())
+        self.max = max_micros
+
+    @staticmethod
+    def value(bucket):
+        return BUCKET_GROWTH ** bucket
+
+    def record(self, seconds):
+        micros = max(seconds * 1e6, 1.0)
+        bucket = int(math.log(micros) / LOG_GROWTH)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.max = max(self.max, micros)
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """
+        the latency in milliseconds that p percent of requests were under
+        """
+        if not self.total:
+            return None
+        target = self.total * p / 100.0
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= target:
+                return min(self.value(bucket + 1), self.max) / 1000.0
+        return self.max / 1000.0
+
+    def summary(self):
+        summary = {'count': self.total}
+        for p in (50, 90, 99, 99.9, 99.99):
+            summary['p%s' % p] = self.percentile(p)
+        summary['max'] = self.max / 1000.0 if self.total else None
+        return summary
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        op, weight = part.split('=')
+        if op not in OPS:
+            raise argparse.ArgumentTypeError('unknown op %s' % op)
+        mix[op] = float(weight)
+    return mix
+
+
+def parse_sizes(value):
+    """
+    a fixed size like 1024, or a range like 100-4096 picked log uniformly
+    so small and large values are both well represented.
+    """
+    low, _, high = value.partition('-')
+    return int(low), int(high or low)
+
+
+class KeyChooser(object):
+    """
+    picks key indexes uniformly or from a zipf distribution, where the key
+    of rank i is chosen in proportion to 1 / i ** s.
+    """
+
+    def __init__(self, keys, distribution='uniform', s=1.0, seed=None):
+        self.keys = keys
+        self.random = random.Random(seed)
+        self.cdf = None
+        if distribution == 'zipf':
+            total, cdf = 0.0, []
+            for rank in range(1, keys + 1):
+                total += 1.0 / rank ** s
+                cdf.append(total)
+            self.cdf = [c / total for c in cdf]
+
+    def __call__(self):
+        if self.cdf is None:
+            return self.random.randrange(self.keys)
+        return min(bisect.bisect(self.cdf, self.random.random()),
+                   self.keys - 1)
+
+
+def key_name(index):
+    return 'k%010d' % index
+
+
+def worker(args, rate, queue):
+    """
+    one load generating process. its threads share one schedule at this
+    process's share of the rate, each taking the next send time in turn.
+    """
+    seed = os.getpid() ^ int(time.time())
+    choose_key = KeyChooser(args.keys, args.distribution, args.zipf_s, seed)
+    ops, weights = zip(*args.mix.items())
+    low, high = args.value_size
+    rng = random.Random(seed)
+    value = os.urandom(high)
+    interval = args.processes / rate
+    lock = threading.Lock()
+    schedule = {'next': 0, 'sends': 0, 'last_sent': 0.0}
+    start = time.monotonic() + 0.1
+    end = start + args.duration
+    results = {op: {'corrected': Histogram(), 'service': Histogram(),
+                    'errors': {}} for op in OPS}
+
+    def run():
+        session = requests.Session()
+        local = {op: (Histogram(), Histogram(), {}) for op in OPS}
+        sends, last_sent = 0, start
+        while True:
+            with lock:
+                i = schedule['next']
+                schedule['next'] += 1
+                op = rng.choices(ops, weights)[0]
+                key = key_name(choose_key())
+                size = low if low == high else int(math.exp(rng.uniform(
+                    math.log(max(low, 1)), math.log(high))))
+            due = start + i * interval
+            if due >= end:
+                break
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            sent = time.monotonic()
+            sends, last_sent = sends + 1, sent
+            error = None
+            try:
+                if op == 'get':
+                    resp = session.get('%s/%s' % (args.url, key),
+                                       timeout=args.timeout)
+                elif op == 'put':
+                    resp = session.put('%s/%s' % (args.url, key),
+                                       data=value[:size],
+                                       timeout=args.timeout)
+                elif op == 'delete':
+                    resp = session.delete('%s/%s' % (args.url, key),
+                                          timeout=args.timeout)
+                else:
+                    resp = session.get(args.url, timeout=args.timeout,
+                                       stream=True)
+                    for _ in resp.iter_content(65536):
+                        pass
+                if resp.status_code not in (200, 404):
+                    error = str(resp.status_code)
+            except requests.RequestException as e:
+                error = type(e).__name__
+            done = time.monotonic()
+
+            corrected, service, errors = local[op]
+            corrected.record(done - due)
+            service.record(done - sent)
+            if error:
+                errors[error] = errors.get(error, 0) + 1
+
+        with lock:
+            schedule['sends'] += sends
+            schedule['last_sent'] = max(schedule['last_sent'],
+                                        last_sent - start)
+            for op, (corrected, service, errors) in local.items():
+                results[op]['corrected'].merge(corrected)
+                results[op]['service'].merge(service)
+                for error, count in errors.items():
+                    results[op]['errors'][error] = \
+                        results[op]['errors'].get(error, 0) + count
+
+    threads = [threading.Thread(target=run) for _ in range(args.connections)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # every due request is sent in the end, however late, so the rate
+    # achieved is over the time it took to send them all
+    window = schedule['last_sent'] + interval
+    queue.put((schedule['sends'] / window,
+               {op: {'corrected': (r['corrected'].counts,
+                                   r['corrected'].max),
+                     'service': (r['service'].counts, r['service'].max),
+                     'errors': r['errors']}
+                for op, r in results.items()}))
+
+
+def prefill(args):
+    session = requests.Session()
+    value = os.urandom(args.value_size[0])
+    for index in range(args.prefill):
+        session.put('%s/%s' % (args.url, key_name(index)), data=value,
+                    timeout=args.timeout)
+
+
+def run_step(args, rate):
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker,
+                                         args=(args, rate, queue))
+                 for _ in range(args.processes)]
+    started = time.monotonic()
+    for p in processes:
+        p.start()
+    parts = [queue.get() for _ in processes]
+    for p in processes:
+        p.join()
+    elapsed = time.monotonic() - started
+
+    report = {'rate': rate, 'seconds': elapsed, 'ops': {}}
+    sent = errors = 0
+    for op in OPS:
+        corrected, service, op_errors = Histogram(), Histogram(), {}
+        for _, part in parts:
+            corrected.merge(Histogram(*part[op]['corrected']))
+            service.merge(Histogram(*part[op]['service']))
+            for error, count in part[op]['errors'].items():
+                op_errors[error] = op_errors.get(error, 0) + count
+        if not corrected.total:
+            continue
+        count = sum(op_errors.values())
+        report['ops'][op] = {
+            'latency_ms': corrected.summary(),
+            'service_time_ms': service.summary(),
+            'errors': op_errors,
+            'error_rate': count / float(corrected.total),
+        }
+        sent += corrected.total
+        errors += count
+    report['requests'] = sent
+    report['achieved_rate'] = sum(rate for rate, _ in parts)
+    report['error_rate'] = errors / float(sent) if sent else 0.0
+    return report
+
+
+def print_report(report):
+    sys.stderr.write('\nrate %(rate)s/s: sent %(requests)s, achieved '
+                     '%(achieved_rate).1f/s, errors %(error_rate).2f%%\n' %
+                     dict(report, error_rate=report['error_rate'] * 100))
+    if report['achieved_rate'] < report['rate'] * 0.95:
+        # requests waiting for a free connection are sent late, and their
+        # latency counts the wait, but the server saw less than the rate
+        sys.stderr.write('  WARNING: fell behind the target rate, the '
+                         'server is saturated or needs more --connections\n')
+    sys.stderr.write('  %-7s %8s %9s %9s %9s %9s %9s %8s\n' % (
+        'op', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'p99.9 ms', 'max ms',
+        'errors'))
+    for op, stats in report['ops'].items():
+        latency = stats['latency_ms']
+        sys.stderr.write('  %-7s %8d %9.2f %9.2f %9.2f %9.2f %9.2f %7.2f%%\n'
+                         % (op, latency['count'], latency['p50'],
+                            latency['p90'], latency['p99'], latency['p99.9'],
+                            latency['max'], stats['error_rate'] * 100))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='open loop load generator for a floe server')
+    parser.add_argument('url', help='base url of a domain, '
+                        'like http://127.0.0.1:3049/test')
+    parser.add_argument('--rate', default='100',
+                        type=lambda v: [float(r) for r in v.split(',')],
+                        help='requests per second, or a list to step through')
+    parser.add_argument('--duration', default=10.0, type=float,
+                        help='seconds at each rate')
+    parser.add_argument('--processes', default=2, type=int)
+    parser.add_argument('--connections', default=16, type=int,
+                        help='concurrent requests per process')
+    parser.add_argument('--mix', default='get=80,put=15,delete=4,ids=1',
+                        type=parse_mix)
+    parser.add_argument('--keys', default=100000, type=int,
+                        help='number of distinct keys')
+    parser.add_argument('--distribution', default='uniform',
+                        choices=['uniform', 'zipf'])
+    parser.add_argument('--zipf-s', default=1.0, type=float,
+                        help='zipf exponent, higher is more skewed')
+    parser.add_argument('--value-size', default='1024', type=parse_sizes,
+                        help='bytes per put, or a range like 100-4096')
+    parser.add_argument('--prefill', default=0, type=int,
+                        help='put this many keys before starting')
+    parser.add_argument('--timeout', default=30.0, type=float)
+    parser.add_argument('--output', help='write the json report here')
+    args = parser.parse_args(argv)
+    args.url = args.url.rstrip('/')
+
+    if args.prefill:
+        prefill(args)
+
+    reports = []
+    for rate in args.rate:
+        report = run_step(args, rate)
+        print_report(report)
+        reports.append(report)
+
+    output = json.dumps({'url': args.url, 'steps': reports}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
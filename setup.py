@@ -38,6 +38,12 @@ setup(
         'requests',
         'opentelemetry-api',
     ],
+    entry_points={
+        'console_scripts': [
+            'floe-copy=floe.copy:main',
+            'floe-snapshot=floe.snapshot:main',
+        ],
+    },
     include_package_data=True,
     long_description=long_description,
     cmdclass={},
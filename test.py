@@ -8,9 +8,30 @@ import wsgiadapter
 import logging
 import socket
 import floe.restapi
+import floe.fileapi
 import floe.connector
 import time
+import shutil
+import tempfile
 import pymysql
+import sqlite3
+import requests
+import threading
+import floe.mysqlapi
+import floe.helpers
+import floe.codecapi
+import floe.dedupapi
+import floe.cacheapi
+import floe.writebehindapi
+import floe.tieredapi
+import floe.shardapi
+import floe.copy
+import floe.snapshot
+import io
+import subprocess
+import sys
+import floe.otel_instrumentation
+import opentelemetry.trace
 
 wsgiadapter.logger.addHandler(logging.NullHandler())
 
@@ -23,15 +44,87 @@ mysql_auth = "%s:%s" % (mysql_user, mysql_pass) \
 table_prefix_variable = int(time.time())
 
 os.environ['FLOE_URL_TEST_FILE'] = 'file://.test_floe'
+os.environ['FLOE_URL_TEST_FILE_POOL'] = 'file://.test_floe_pool?pool_size=4'
+os.environ['FLOE_URL_TEST_FILE_MMAP'] = \
+    'file://.test_floe_mmap?mmap_threshold=1024'
+os.environ['FLOE_URL_TEST_FILE_HASH'] = \
+    'file://.test_floe_hash?layout=hash&depth=2&width=2'
+os.environ['FLOE_URL_TEST_FILE_MANIFEST'] = \
+    'file://.test_floe_manifest?manifest=true'
+os.environ['FLOE_URL_TEST_FILE_DURABLE'] = \
+    'file://.test_floe_durable?durable=true&pool_size=4'
+os.environ['FLOE_URL_TEST_FILE_CODEC'] = \
+    'file://.test_floe_codec?codec=zlib&min_size=64'
+os.environ['FLOE_URL_TEST_FILE_DEDUP'] = \
+    'file://.test_floe_dedup?dedup=test_file_blobs&dedup_min_size=16'
+os.environ['FLOE_URL_TEST_FILE_BLOBS'] = 'file://.test_floe_blobs'
+os.environ['FLOE_URL_TEST_FILE_CACHE'] = \
+    'file://.test_floe_cache?cache_bytes=4KB&cache_ttl=30'
+os.environ['FLOE_URL_TEST_FILE_WRITE_BEHIND'] = \
+    'file://.test_floe_write_behind?write_behind=100&write_behind_interval=0'
+os.environ['FLOE_URL_TEST_TIERED'] = \
+    'tiered://test_tiered_hot,test_tiered_cold?hot_bytes=2KB&max_idle=3600'
+os.environ['FLOE_URL_TEST_TIERED_HOT'] = 'file://.test_floe_tiered'
+os.environ['FLOE_URL_TEST_TIERED_COLD'] = \
+    'sqlite://.test_floe.db?table=test_tiered_cold'
+os.environ['FLOE_URL_TEST_SHARD'] = \
+    'shard://test_shard_a,test_shard_b,test_shard_c'
+os.environ['FLOE_URL_TEST_SHARD_GROWN'] = \
+    'shard://test_shard_a,test_shard_b,test_shard_c,test_shard_d' \
+    '?previous=test_shard_a,test_shard_b,test_shard_c'
+for shard in 'abcd':
+    os.environ['FLOE_URL_TEST_SHARD_%s' % shard.upper()] = \
+        'sqlite://.test_floe.db?table=test_shard_%s' % shard
+os.environ['FLOE_URL_TEST_COPY_SRC'] = \
+    'sqlite://.test_floe.db?table=test_copy_src&page_size=10'
+os.environ['FLOE_URL_TEST_COPY_DST'] = 'file://.test_floe_copy'
+os.environ['FLOE_URL_TEST_FILELOG'] = \
+    'filelog://.test_floe_log?max_segment_size=4096&compact_threshold=0'
+
+os.environ['FLOE_URL_TEST_SQLITE'] = \
+    'sqlite://.test_floe.db?table=test_sqlite&page_size=7'
 
 os.environ['FLOE_URL_TEST_REST_BOGUS'] = 'http://test-floe/bogus'
 os.environ['FLOE_URL_TEST_REST_FILE'] = 'http://test-floe/test_file'
 os.environ['FLOE_URL_TEST_REST_BROKEN'] = 'http://test-floe/broken'
+os.environ['FLOE_URL_TEST_REST_MULTI'] = \
+    'http://test-floe,test-floe-2/test_file?hedge_min_delay=0.01'
 
 adapter = wsgiadapter.WSGIAdapter(floe.floe_server())
 floe.restapi.RestClientFloe.session.mount('http://test-floe/', adapter)  # noqa
 
 
+class SlowAdapter(wsgiadapter.WSGIAdapter):
+    delay = 0.5
+
+    def send(self, request, *args, **kwargs):
+        time.sleep(self.delay)
+        return super(SlowAdapter, self).send(request, *args, **kwargs)
+
+
+class DownAdapter(wsgiadapter.WSGIAdapter):
+    def send(self, request, *args, **kwargs):
+        raise requests.ConnectionError('connection refused')
+
+
+class ErrorAdapter(wsgiadapter.WSGIAdapter):
+    def send(self, request, *args, **kwargs):
+        resp = requests.Response()
+        resp.status_code = 500
+        resp._content = b'proxy error'
+        resp.request = request
+        return resp
+
+
+floe.restapi.RestClientFloe.session.mount('http://test-floe-2/', adapter)
+floe.restapi.RestClientFloe.session.mount(
+    'http://test-floe-slow/', SlowAdapter(floe.floe_server()))
+floe.restapi.RestClientFloe.session.mount(
+    'http://test-floe-down/', DownAdapter(floe.floe_server()))
+floe.restapi.RestClientFloe.session.mount(
+    'http://test-floe-error/', ErrorAdapter(floe.floe_server()))
+
+
 def drop_table(pool, table_name):
     statement = "DROP table {}".format(table_name)
     try:
@@ -149,6 +242,885 @@ class FileFloeTest(unittest.TestCase):
                           lambda: store.delete('foo/bar'))
 
 
+class FileFloePoolTest(FileFloeTest):
+    def init_floe(self):
+        return floe.connect('test_file_pool')
+
+    def test_multi(self):
+        store = self.floe
+        data = {xid(): os.urandom(100) for _ in range(0, 50)}
+        missing = [xid() for _ in range(0, 5)]
+        store.set_multi(data)
+        self.assertEqual(store.get_multi(list(data) + missing), data)
+        store.delete_multi(list(data)[0:25])
+        self.assertEqual(store.get_multi(list(data)),
+                         {k: data[k] for k in list(data)[25:]})
+
+
+class FileFloeMmapTest(FileFloeTest):
+    def init_floe(self):
+        return floe.connect('test_file_mmap')
+
+    def test_mmap(self):
+        store = self.floe
+        foo = xid()
+        bar = xid()
+        store.set(foo, os.urandom(10))
+        self.assertIsInstance(store.get(foo), bytes)
+
+        data = bytearray(os.urandom(2048))
+        store.set(bar, data)
+        value = store.get(bar)
+        self.assertIsInstance(value, memoryview)
+        self.assertEqual(value, data)
+
+        # overwriting doesn't disturb a reader holding the old mapping
+        store.set(bar, memoryview(os.urandom(4096)))
+        self.assertEqual(value, data)
+
+    def test_get_into(self):
+        store = self.floe
+        foo = xid()
+        data = os.urandom(100)
+        store.set(foo, data)
+
+        buffer = bytearray(200)
+        self.assertEqual(store.get_into(foo, buffer), 100)
+        self.assertEqual(buffer[0:100], data)
+        self.assertIsNone(store.get_into(xid(), buffer))
+        self.assertRaises(floe.FloeReadException,
+                          lambda: store.get_into(foo, bytearray(10)))
+
+
+class FileFloeHashLayoutTest(FileFloeTest):
+    def init_floe(self):
+        return floe.connect('test_file_hash')
+
+    def test_layout(self):
+        store = self.floe
+        foo = 'user_%s' % xid()
+        store.set(foo, b'1')
+        path = store._resolve_path(foo)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(
+            len(os.path.relpath(path, store._root).split(os.sep)), 3)
+
+
+class FileFloeManifestTest(FileFloeTest):
+    def init_floe(self):
+        return floe.connect('test_file_manifest')
+
+    def test_ids_after(self):
+        store = self.floe
+        keys = sorted(xid() for _ in range(0, 20))
+        store.set_multi({key: os.urandom(10) for key in keys})
+        self.assertEqual(list(store.ids()), keys)
+        self.assertEqual(list(store.ids(after=keys[9])), keys[10:])
+
+    def test_rebuild(self):
+        store = self.floe
+        keys = sorted(xid() for _ in range(0, 20))
+        plain = floe.fileapi.FileFloe(store.dir)
+        plain.set_multi({key: os.urandom(10) for key in keys})
+        self.assertRaises(floe.FloeConfigurationException,
+                          lambda: plain.ids(after=keys[0]))
+        self.assertEqual(list(store.ids()), [])
+
+        store.rebuild_manifest()
+        self.assertEqual(list(store.ids()), keys)
+
+
+class FileFloeDurableTest(FileFloeTest):
+    def init_floe(self):
+        return floe.connect('test_file_durable')
+
+    def test_no_temp_files(self):
+        store = self.floe
+        data = {xid(): os.urandom(100) for _ in range(0, 20)}
+        store.set_multi(data)
+        self.assertEqual(store.get_multi(list(data)), data)
+        for root, dirs, files in os.walk(store.dir):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            self.assertEqual([f for f in files if f.endswith('.tmp')], [])
+
+
+class FileFloeFlushTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_flush(self):
+        store = floe.fileapi.FileFloe(self.dir)
+        data = {xid(): os.urandom(10) for _ in range(0, 30)}
+        data['ab'] = b'short key'
+        store.set_multi(data)
+
+        store.flush()
+        self.assertEqual(store.get_multi(list(data)), {})
+        self.assertEqual(list(store.ids()), [])
+        store._reaper.join(5)
+        self.assertEqual(os.listdir(os.path.join(self.dir, '.trash')), [])
+
+    def test_flush_swaps_data_dir(self):
+        store = floe.fileapi.FileFloe(self.dir)
+        store.flush()
+        data = {xid(): os.urandom(10) for _ in range(0, 30)}
+        store.set_multi(data)
+        stale = floe.fileapi.FileFloe(self.dir)
+        self.assertEqual(stale.get_multi(list(data)), data)
+
+        # the whole data dir goes in one rename, so an instance that hasn't
+        # seen the new layout finds every key gone
+        root = store._root
+        store.flush()
+        self.assertNotEqual(store._root, root)
+        self.assertFalse(os.path.exists(root))
+        self.assertEqual(stale.get_multi(list(data)), {})
+        self.assertEqual(list(stale.ids()), [])
+        foo = xid()
+        stale.set(foo, b'foo')
+        self.assertEqual(store.get(foo), b'foo')
+
+    def test_reap_after_restart(self):
+        trash = os.path.join(self.dir, '.trash', '1-abc', 'ab')
+        os.makedirs(trash)
+        with open(os.path.join(trash, 'abcd.bin'), 'wb') as fp:
+            fp.write(b'1')
+
+        store = floe.fileapi.FileFloe(self.dir)
+        store._reaper.join(5)
+        self.assertEqual(os.listdir(os.path.join(self.dir, '.trash')), [])
+
+
+class FileFloeMigrateLayoutTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_migrate(self):
+        store = floe.fileapi.FileFloe(self.dir)
+        data = {'user_%s' % xid(): os.urandom(10) for _ in range(0, 30)}
+        store.set_multi(data)
+        stale = floe.fileapi.FileFloe(self.dir)
+
+        self.assertRaises(floe.FloeConfigurationException,
+                          lambda: floe.fileapi.FileFloe(self.dir,
+                                                        layout='hash'))
+
+        moved = store.migrate_layout('hash', depth=2, width=1, settle=0)
+        self.assertEqual(moved, len(data))
+        self.assertEqual(store.get_multi(list(data)), data)
+        self.assertEqual(set(store.ids()), set(data))
+        self.assertEqual(sorted(os.listdir(self.dir))[0], '.layout')
+        self.assertNotIn('us', os.listdir(self.dir))
+
+        # an instance that still thinks it is on the old layout catches up
+        self.assertEqual(stale.get_multi(list(data)), data)
+        foo = xid()
+        stale.set(foo, b'foo')
+        self.assertEqual(store.get(foo), b'foo')
+
+        reopened = floe.fileapi.FileFloe(self.dir, layout='hash', depth=2,
+                                         width=1)
+        self.assertEqual(reopened.get_multi(list(data)), data)
+
+
+class CodecFloeTest(FileFloeTest):
+    def init_floe(self):
+        return floe.connect('test_file_codec')
+
+    def test_compress(self):
+        store = self.floe
+        self.assertIsInstance(store, floe.codecapi.CodecFloe)
+        foo, bar = xid(), xid()
+        data = json.dumps([{'id': i} for i in range(1000)]).encode('utf-8')
+        store.set_multi({foo: data, bar: b'tiny'})
+        self.assertEqual(store.get(foo), data)
+        self.assertEqual(store.get_multi([foo, bar]),
+                         {foo: data, bar: b'tiny'})
+        stored = store.backend.get(foo)
+        self.assertTrue(stored.startswith(floe.codecapi.MAGIC))
+        self.assertLess(len(stored), len(data))
+        self.assertEqual(store.backend.get(bar), b'tiny')
+
+        stats = store.stats()['zlib']
+        self.assertEqual(stats['compressed'], 1)
+        self.assertEqual(stats['bytes_in'], len(data))
+        self.assertLess(stats['ratio'], 1.0)
+
+    def test_legacy_values(self):
+        store = self.floe
+        foo, bar = xid(), xid()
+        store.backend.set(foo, b'written before the codec')
+        self.assertEqual(store.get(foo), b'written before the codec')
+
+        # a raw value that looks like a header must survive the round trip
+        tricky = floe.codecapi.MAGIC + b'\x01not really zlib'
+        store.set(bar, tricky)
+        self.assertEqual(store.get(bar), tricky)
+
+    def test_codecs(self):
+        data = b'compress me ' * 100
+        for codec in ['zlib', 'lzma', 'bz2']:
+            key = xid()
+            store = floe.codecapi.CodecFloe(self.floe.backend, codec=codec)
+            store.set(key, data)
+            self.assertEqual(store.get(key), data)
+            # any codec reads values written by the others
+            self.assertEqual(self.floe.get(key), data)
+        self.assertRaises(floe.FloeConfigurationException,
+                          lambda: floe.codecapi.CodecFloe(
+                              self.floe.backend, codec='snappy'))
+
+
+class DedupFloeTest(FileFloeTest):
+    def init_floe(self):
+        return floe.connect('test_file_dedup')
+
+    def test_dedup(self):
+        store = self.floe
+        self.assertIsInstance(store, floe.dedupapi.DedupFloe)
+        data = os.urandom(1024)
+        keys = [xid() for _ in range(5)]
+        store.set_multi({key: data for key in keys})
+        store.set(keys[0], data)
+        self.assertEqual(store.get_multi(keys), {key: data for key in keys})
+        self.assertEqual(list(store.blobs.ids()),
+                         [floe.dedupapi.digest(data)])
+        self.assertEqual(store.stats()['blobs_written'], 1)
+        self.assertEqual(store.stats()['bytes_skipped'], 5 * len(data))
+        self.assertLess(len(store.backend.get(keys[0])), 64)
+
+    def test_inline(self):
+        store = self.floe
+        foo, bar = xid(), xid()
+        store.set(foo, b'small')
+        tricky = floe.dedupapi.MAGIC + floe.dedupapi.REF + b'xyz'
+        store.set(bar, tricky)
+        self.assertEqual(store.get_multi([foo, bar]),
+                         {foo: b'small', bar: tricky})
+        self.assertEqual(list(store.blobs.ids()), [])
+
+    def test_collect_garbage(self):
+        store = self.floe
+        foo, bar = xid(), xid()
+        kept, orphan = os.urandom(100), os.urandom(100)
+        store.set_multi({foo: kept, bar: orphan})
+        store.delete(bar)
+
+        # blobs inside the grace period survive even when unreferenced
+        self.assertEqual(store.collect_garbage(), 0)
+
+        store.grace = -1
+        self.assertEqual(store.collect_garbage(), 1)
+        self.assertEqual(set(store.blobs.ids()),
+                         {floe.dedupapi.digest(kept)})
+        self.assertEqual(store.get(foo), kept)
+
+
+class CacheFloeTest(FileFloeTest):
+    def init_floe(self):
+        return floe.connect('test_file_cache')
+
+    def test_read_through(self):
+        store = self.floe
+        self.assertIsInstance(store, floe.cacheapi.CacheFloe)
+        foo, bar = xid(), xid()
+        store.set(foo, b'one')
+        self.assertEqual(store.get(foo), b'one')
+        self.assertIsNone(store.get(bar))
+
+        # changes behind the cache's back are not seen until invalidated
+        store.backend.set(foo, b'two')
+        store.backend.set(bar, b'two')
+        self.assertEqual(store.get_multi([foo, bar]), {foo: b'one'})
+        stats = store.stats()
+        self.assertEqual((stats['hits'], stats['negative_hits'],
+                          stats['misses']), (1, 1, 2))
+
+        store.invalidate([foo, bar])
+        self.assertEqual(store.get_multi([foo, bar]),
+                         {foo: b'two', bar: b'two'})
+        store.set(foo, b'three')
+        store.delete(bar)
+        self.assertEqual(store.get_multi([foo, bar]), {foo: b'three'})
+
+    def test_eviction(self):
+        store = self.floe
+        keys = [xid() for _ in range(10)]
+        store.set_multi({key: os.urandom(1000) for key in keys})
+        store.get_multi(keys)
+        stats = store.stats()
+        self.assertLessEqual(stats['bytes'], 4096)
+        self.assertEqual(stats['entries'], 3)
+        self.assertEqual(stats['evictions'], 7)
+
+    def test_ttl(self):
+        store = floe.cacheapi.CacheFloe(self.floe.backend, max_bytes='1MB',
+                                        ttl=0.01, negative_ttl=0)
+        foo = xid()
+        store.set(foo, b'one')
+        store.get(foo)
+        store.backend.set(foo, b'two')
+        time.sleep(0.02)
+        self.assertEqual(store.get(foo), b'two')
+        self.assertEqual(store.stats()['expirations'], 1)
+
+    def test_fill_during_write(self):
+        backend = self.floe.backend
+        foo, bar = xid(), xid()
+        while cache_stripe(foo) == cache_stripe(bar):
+            bar = xid()
+        backend.set_multi({foo: b'one', bar: b'one'})
+
+        def write():
+            backend.set(bar, b'two')
+            store.invalidate([bar])
+
+        store = floe.cacheapi.CacheFloe(HookFloe(backend, write))
+        self.assertEqual(store.get_multi([foo, bar]),
+                         {foo: b'one', bar: b'one'})
+        # only the key written while the read was at the backend is left
+        # out of the cache
+        self.assertEqual(store.get_multi([foo, bar]),
+                         {foo: b'one', bar: b'two'})
+        self.assertEqual(store.stats()['hits'], 1)
+
+
+def cache_stripe(key):
+    return hash(key) % floe.cacheapi.VERSION_STRIPES
+
+
+class HookFloe(object):
+    """
+    reads through to a floe, calling hook once between reading the values
+    and returning them.
+    """
+
+    def __init__(self, backend, hook):
+        self.backend = backend
+        self.hook = hook
+
+    def get_multi(self, keys):
+        values = self.backend.get_multi(keys)
+        hook, self.hook = self.hook, lambda: None
+        hook()
+        return values
+
+    def get(self, key):
+        return self.get_multi([key]).get(key)
+
+
+class RecordingFloe(object):
+    """
+    an in memory floe that records the batches written to it and can be
+    told to hold writes until released or to fail them.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.writes = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.fail = False
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def get_multi(self, keys):
+        return {key: self.data[key] for key in keys if key in self.data}
+
+    def set_multi(self, mapping):
+        self.entered.set()
+        self.release.wait()
+        if self.fail:
+            raise floe.FloeWriteException('failed to write')
+        self.writes.append(dict(mapping))
+        self.data.update(mapping)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def ids(self):
+        return iter(sorted(self.data))
+
+    def flush(self):
+        self.data.clear()
+
+
+class WriteBehindFloeTest(FileFloeTest):
+    def init_floe(self):
+        return floe.connect('test_file_write_behind')
+
+    def test_queued_reads(self):
+        backend = RecordingFloe()
+        backend.release.clear()
+        store = floe.writebehindapi.WriteBehindFloe(backend, interval=0)
+        store.set('foo', b'1')
+        store.set_multi({'foo': b'2', 'bar': b'3'})
+        store.delete('bar')
+        self.assertEqual(store.get('foo'), b'2')
+        self.assertEqual(store.get_multi(['foo', 'bar']), {'foo': b'2'})
+        self.assertEqual(backend.data, {})
+
+        backend.release.set()
+        self.assertTrue(store.flush_pending(timeout=5))
+        self.assertEqual(backend.data, {'foo': b'2'})
+        self.assertEqual(list(store.ids()), ['foo'])
+        store.close()
+
+    def test_coalesce(self):
+        backend = RecordingFloe()
+        store = floe.writebehindapi.WriteBehindFloe(backend, interval=0.05)
+        for i in range(100):
+            store.set('foo', b'%d' % i)
+        store.flush_pending()
+        self.assertEqual(backend.data, {'foo': b'99'})
+        self.assertLess(len(backend.writes), 100)
+        store.close()
+
+    def test_interval(self):
+        backend = RecordingFloe()
+        store = floe.writebehindapi.WriteBehindFloe(backend, interval=0.5)
+        for i in range(20):
+            store.set('k%d' % i, b'1')
+            time.sleep(0.005)
+        store.flush_pending()
+        # writes spread over less than the interval go in one round
+        self.assertEqual(len(backend.writes), 1)
+        self.assertEqual(len(backend.data), 20)
+        store.close()
+
+    def test_backpressure(self):
+        backend = RecordingFloe()
+        backend.release.clear()
+        store = floe.writebehindapi.WriteBehindFloe(
+            backend, max_pending=2, interval=0, block_timeout=0.05)
+        store.set('a', b'1')
+        self.assertTrue(backend.entered.wait(5))
+        store.set_multi({'b': b'2', 'c': b'3'})
+        # overwriting a queued key never blocks
+        store.set('b', b'4')
+        self.assertRaises(floe.FloeWriteException,
+                          lambda: store.set('d', b'5'))
+        # a mapping that doesn't fit queues none of its keys
+        self.assertRaises(floe.FloeWriteException,
+                          lambda: store.set_multi({'b': b'6', 'e': b'7'}))
+        self.assertEqual(store.get('b'), b'4')
+        backend.release.set()
+        store.flush_pending()
+        self.assertEqual(backend.data, {'a': b'1', 'b': b'4', 'c': b'3'})
+        store.close()
+
+    def test_errors(self):
+        backend = RecordingFloe()
+        backend.fail = True
+        errors = []
+        store = floe.writebehindapi.WriteBehindFloe(
+            backend, interval=0, retries=1,
+            on_error=lambda e, values, deletes: errors.append(values))
+        store.set('foo', b'1')
+        self.assertRaises(floe.FloeWriteException, store.flush_pending)
+        self.assertEqual(errors, [{'foo': b'1'}])
+        self.assertIsNone(store.get('foo'))
+
+        # the backend is flushed even when a write in flight fails
+        backend.entered.clear()
+        backend.release.clear()
+        store.set('bar', b'1')
+        self.assertTrue(backend.entered.wait(5))
+        backend.data['baz'] = b'2'
+        threading.Timer(0.05, backend.release.set).start()
+        self.assertRaises(floe.FloeWriteException, store.flush)
+        self.assertEqual(backend.data, {})
+
+        backend.fail = False
+        store.set('foo', b'2')
+        self.assertTrue(store.flush_pending())
+        store.close()
+        self.assertRaises(floe.FloeWriteException,
+                          lambda: store.set('foo', b'3'))
+
+
+class TieredFloeTest(FileFloeTest):
+    def init_floe(self):
+        return floe.connect('test_tiered')
+
+    def tearDown(self):
+        self.floe.flush()
+        self.floe.close()
+
+    def test_promote(self):
+        store = self.floe
+        self.assertIsInstance(store, floe.tieredapi.TieredFloe)
+        foo, bar = xid(), xid()
+        store.cold.set_multi({foo: b'cold', bar: b'cold'})
+        store.hot.set(bar, b'hot')
+        self.assertEqual(store.get_multi([foo, bar]),
+                         {foo: b'cold', bar: b'hot'})
+        self.assertEqual(store.hot.get(foo), b'cold')
+        self.assertEqual(sorted(store.ids()), sorted([foo, bar]))
+
+        store.delete(foo)
+        self.assertIsNone(store.get(foo))
+        self.assertIsNone(store.cold.get(foo))
+
+    def test_demote_bytes(self):
+        store = self.floe
+        keys = [xid() for _ in range(4)]
+        for key in keys:
+            store.set(key, os.urandom(1000))
+        store.get(keys[0])
+        self.assertEqual(store.demote(), 2)
+        # the least recently used go first
+        self.assertEqual(set(store.hot.ids()), {keys[0], keys[3]})
+        self.assertEqual(set(store.cold.ids()), {keys[1], keys[2]})
+        self.assertEqual(len(store.get_multi(keys)), 4)
+
+    def test_demote_idle(self):
+        store = self.floe
+        store.max_idle = 0.01
+        foo = xid()
+        store.set(foo, b'1')
+        time.sleep(0.02)
+        self.assertEqual(store.demote(), 1)
+        self.assertEqual(list(store.hot.ids()), [])
+        self.assertEqual(store.get(foo), b'1')
+        self.assertEqual(list(store.hot.ids()), [foo])
+        self.assertEqual(list(store.ids()), [foo])
+
+    def test_failed_write_keeps_tracking(self):
+        store = self.floe
+        foo = xid()
+        store.set(foo, b'1' * 10)
+        hot = store.hot
+        store.hot = RecordingFloe()
+        store.hot.fail = True
+        try:
+            self.assertRaises(floe.FloeWriteException,
+                              lambda: store.set(foo, b'2'))
+        finally:
+            store.hot = hot
+        # the old value is still in the hot tier, and still counted
+        self.assertEqual(store._tracked[foo][0], 10)
+        self.assertEqual(store._tracked_bytes, 10)
+
+
+class ShardFloeTest(FileFloeTest):
+    def init_floe(self):
+        return floe.connect('test_shard')
+
+    def tearDown(self):
+        self.floe.flush()
+        floe.connect('test_shard_d').flush()
+
+    def test_spread(self):
+        store = self.floe
+        self.assertIsInstance(store, floe.shardapi.ShardFloe)
+        data = {xid(): os.urandom(10) for _ in range(300)}
+        store.set_multi(data)
+        self.assertEqual(store.get_multi(list(data)), data)
+        for name, shard in store.shards.items():
+            keys = list(shard.ids())
+            self.assertGreater(len(keys), 50)
+            for key in keys:
+                self.assertEqual(store.shard_for(key), name)
+        self.assertEqual(sorted(store.ids()), sorted(data))
+
+    def test_rebalance(self):
+        data = {xid(): os.urandom(10) for _ in range(300)}
+        self.floe.set_multi(data)
+
+        store = floe.connect('test_shard_grown')
+        new_shard = store.shards['TEST_SHARD_D']
+        # keys are readable from their old shard until they are moved
+        self.assertEqual(store.get_multi(list(data)), data)
+        moved = store.rebalance()
+        self.assertEqual(moved, len(list(new_shard.ids())))
+        self.assertGreater(moved, 30)
+        self.assertLess(moved, 150)
+        for name, shard in store.shards.items():
+            for key in shard.ids():
+                self.assertEqual(store.shard_for(key), name)
+        self.assertEqual(store.get_multi(list(data)), data)
+        self.assertEqual(store.rebalance(), 0)
+
+    def test_write_waits_for_move(self):
+        store = floe.connect('test_shard_grown')
+        foo = xid()
+        store._claim([foo])
+        writer = threading.Thread(target=store.set, args=(foo, b'new'))
+        writer.start()
+        writer.join(0.1)
+        self.assertTrue(writer.is_alive())
+        store._release([foo])
+        writer.join(5)
+        self.assertEqual(store.get(foo), b'new')
+        self.assertEqual(store._busy, {})
+
+    def test_rebalance_alongside_writes(self):
+        data = {xid(): b'old' for _ in range(300)}
+        self.floe.set_multi(data)
+        store = floe.connect('test_shard_grown')
+        # fewer pool threads than shards being rebalanced
+        store.parallelism = 2
+        rebalancer = threading.Thread(target=store.rebalance, args=(10,),
+                                      daemon=True)
+
+        def write():
+            for i in range(5):
+                store.set_multi({key: b'%d' % i for key in data})
+
+        writer = threading.Thread(target=write, daemon=True)
+        rebalancer.start()
+        writer.start()
+        writer.join(10)
+        rebalancer.join(10)
+        self.assertFalse(writer.is_alive())
+        self.assertFalse(rebalancer.is_alive())
+        self.assertEqual(store.get_multi(list(data)),
+                         {key: b'4' for key in data})
+        for name, shard in store.shards.items():
+            for key in shard.ids():
+                self.assertEqual(store.shard_for(key), name)
+
+
+class FailingFloe(object):
+    """
+    passes writes through to a floe until it has taken `limit` batches.
+    """
+
+    def __init__(self, backend, limit):
+        self.backend = backend
+        self.limit = limit
+        self.lock = threading.Lock()
+
+    def set_multi(self, mapping):
+        with self.lock:
+            self.limit -= 1
+            if self.limit < 0:
+                raise floe.FloeWriteException('failed to write')
+        self.backend.set_multi(mapping)
+
+
+class CopyTest(unittest.TestCase):
+    def setUp(self):
+        self.src = floe.connect('test_copy_src')
+        self.dst = floe.connect('test_copy_dst')
+        self.src.flush()
+        self.dst.flush()
+        self.data = {'k%03d' % i: os.urandom(i) for i in range(1, 101)}
+        self.src.set_multi(self.data)
+        self.checkpoint = tempfile.mktemp(suffix='.json')
+
+    def tearDown(self):
+        self.src.flush()
+        self.dst.flush()
+        if os.path.exists(self.checkpoint):
+            os.unlink(self.checkpoint)
+
+    def test_copy(self):
+        result = floe.copy.copy('test_copy_src', 'test_copy_dst',
+                                batch_size=7, workers=3, verify=True)
+        self.assertEqual(result['keys'], 100)
+        self.assertEqual(result['bytes'], sum(range(1, 101)))
+        self.assertEqual(result['verify']['checked'], 100)
+        self.assertEqual(result['verify']['missing'], 0)
+        self.assertEqual(self.dst.get_multi(list(self.data)), self.data)
+
+        self.dst.delete('k050')
+        self.dst.set('k051', b'changed')
+        result = floe.copy.verify_copy(self.src, self.dst)
+        self.assertEqual((result['missing'], result['different']), (1, 1))
+        self.assertEqual(sorted(result['bad_keys']), ['k050', 'k051'])
+
+    def test_resume(self):
+        failing = FailingFloe(self.dst, limit=4)
+        self.assertRaises(floe.FloeWriteException,
+                          lambda: floe.copy.copy(
+                              self.src, failing, batch_size=10, workers=1,
+                              checkpoint=self.checkpoint))
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        self.assertEqual((state['after'], state['copied']), ('k040', 40))
+
+        # the resumed copy only reads the keys after the checkpoint
+        self.dst.flush()
+        result = floe.copy.copy(self.src, self.dst, batch_size=10,
+                                checkpoint=self.checkpoint)
+        self.assertEqual(result['keys'], 100)
+        self.assertEqual(sorted(self.dst.ids()),
+                         ['k%03d' % i for i in range(41, 101)])
+
+    def test_cli(self):
+        self.assertEqual(floe.copy.main(
+            ['test_copy_src', 'test_copy_dst', '--rate', '100000',
+             '--verify']), 0)
+        self.assertEqual(len(list(self.dst.ids())), 100)
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.sqlite = floe.connect('test_copy_src')
+        self.files = floe.connect('test_copy_dst')
+        self.sqlite.flush()
+        self.files.flush()
+        self.data = {'k%03d' % i: os.urandom(i) + b'x' * 100
+                     for i in range(0, 100)}
+
+    def tearDown(self):
+        self.sqlite.flush()
+        self.files.flush()
+
+    def test_round_trip(self):
+        self.sqlite.set_multi(self.data)
+        self.assertEqual(dict(self.sqlite.items()), self.data)
+        self.assertEqual(dict(self.sqlite.items(after='k049')),
+                         {k: v for k, v in self.data.items() if k > 'k049'})
+        for codec in ['none', 'zlib', 'lzma', 'bz2']:
+            self.files.flush()
+            snapshot = io.BytesIO()
+            result = floe.snapshot.export_snapshot(
+                self.sqlite, snapshot, codec=codec, block_size=1000)
+            self.assertEqual(result['keys'], 100)
+            snapshot.seek(0)
+            result = floe.snapshot.import_snapshot(self.files, snapshot,
+                                                   batch_size=7)
+            self.assertEqual(result['keys'], 100)
+            self.assertEqual(self.files.get_multi(list(self.data)),
+                             self.data)
+
+        # file backends have no items() and are scanned with get_multi
+        snapshot = io.BytesIO()
+        floe.snapshot.export_snapshot(self.files, snapshot)
+        snapshot.seek(0)
+        self.assertEqual(dict(floe.snapshot.read_snapshot(snapshot)),
+                         self.data)
+
+    def test_corruption(self):
+        self.sqlite.set_multi(self.data)
+        snapshot = io.BytesIO()
+        floe.snapshot.export_snapshot(self.sqlite, snapshot)
+        data = snapshot.getvalue()
+
+        truncated = io.BytesIO(data[:-20])
+        self.assertRaises(floe.FloeReadException,
+                          lambda: floe.snapshot.import_snapshot(
+                              self.files, truncated))
+
+        corrupt = bytearray(data)
+        corrupt[100] ^= 0xff
+        self.assertRaises(floe.FloeReadException,
+                          lambda: list(floe.snapshot.read_snapshot(
+                              io.BytesIO(bytes(corrupt)))))
+        self.assertRaises(floe.FloeReadException,
+                          lambda: list(floe.snapshot.read_snapshot(
+                              io.BytesIO(b'not a snapshot'))))
+
+    def test_cli(self):
+        self.files.set_multi(self.data)
+        path = tempfile.mktemp(suffix='.snap')
+        try:
+            self.assertEqual(floe.snapshot.main(
+                ['export', 'test_copy_dst', path, '--codec', 'lzma']), 0)
+            self.assertEqual(floe.snapshot.main(
+                ['import', 'test_copy_src', path, '--workers', '2']), 0)
+        finally:
+            os.unlink(path)
+        self.assertEqual(dict(self.sqlite.items()), self.data)
+
+
+class FileLogFloeTest(FileFloeTest):
+    def init_floe(self):
+        return floe.connect('test_filelog')
+
+    def test_reopen(self):
+        store = self.floe
+        data = {xid(): os.urandom(300) for _ in range(0, 40)}
+        store.set_multi(data)
+        deleted = list(data)[0:10]
+        store.delete_multi(deleted)
+        for key in deleted:
+            del data[key]
+        store.close()
+
+        store = self.init_floe()
+        self.assertEqual(store.get_multi(list(data) + deleted), data)
+        self.assertEqual(set(store.ids()), set(data))
+        store.close()
+
+    def test_compact(self):
+        store = self.floe
+        keys = [xid() for _ in range(0, 20)]
+        for _ in range(0, 5):
+            data = {key: os.urandom(200) for key in keys}
+            store.set_multi(data)
+        store.delete(keys[0])
+        del data[keys[0]]
+        segments = len(store._sizes)
+
+        store.compact()
+        self.assertLess(len(store._sizes), segments)
+        self.assertEqual(store.get_multi(keys), data)
+        store.close()
+
+        store = self.init_floe()
+        self.assertEqual(store.get_multi(keys), data)
+        self.assertEqual(set(store.ids()), set(data))
+        store.close()
+
+
+class SQLiteFloeTest(FileFloeTest):
+    def init_floe(self):
+        return floe.connect('test_sqlite')
+
+    def test_ids_after(self):
+        store = self.floe
+        keys = sorted(xid() for _ in range(0, 20))
+        store.set_multi({key: os.urandom(10) for key in keys})
+        self.assertEqual(list(store.ids()), keys)
+        self.assertEqual(list(store.ids(after=keys[9])), keys[10:])
+
+    def test_failed_commit(self):
+        store = self.floe
+        conn = store._connection()
+        store._local.conn = FailingCommit(conn)
+        foo = xid()
+        self.assertRaises(floe.FloeWriteException,
+                          lambda: store.set(foo, b'1'))
+        # the connection is out of the failed transaction and usable again
+        self.assertFalse(conn.in_transaction)
+        self.assertIsNone(store.get(foo))
+        store.set(foo, b'2')
+        self.assertEqual(store.get(foo), b'2')
+
+
+class FailingCommit(object):
+    """
+    a sqlite connection whose first commit fails as if the database was
+    locked.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.failed = False
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def execute(self, statement, *args):
+        if statement == 'COMMIT' and not self.failed:
+            self.failed = True
+            raise sqlite3.OperationalError('database is locked')
+        return self.conn.execute(statement, *args)
+
+
 class MysqlFloe(FileFloeTest):
     def setUp(self):
         self.mysql_tables = [
@@ -249,6 +1221,451 @@ class MysqlFloe(FileFloeTest):
         self.assertEqual(store.get(foo_smaller), foo_smaller_data)
 
 
+class FakeMySQLConnection(object):
+    def __init__(self):
+        self.closed = False
+        self.alive = True
+
+    def ping(self, reconnect=False):
+        if not self.alive:
+            raise pymysql.OperationalError('gone away')
+
+    def close(self):
+        self.closed = True
+
+
+class FakeMySQLPool(floe.mysqlapi.MySQLPool):
+    def _create_connection(self):
+        return FakeMySQLConnection()
+
+
+class MySQLPoolTest(unittest.TestCase):
+
+    def test_bounded(self):
+        pool = FakeMySQLPool(pool_size=2, max_connections=2, timeout=0.05)
+        with pool.connection() as a:
+            with pool.connection() as b:
+                self.assertIsNot(a, b)
+                self.assertEqual(pool.stats()['in_use'], 2)
+
+                def _checkout():
+                    with pool.connection():
+                        pass
+
+                self.assertRaises(floe.FloeOperationalException, _checkout)
+                self.assertEqual(pool.stats()['timeouts'], 1)
+
+        stats = pool.stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['idle'], 2)
+        self.assertEqual(stats['created'], 2)
+
+    def test_blocking_checkout(self):
+        pool = FakeMySQLPool(pool_size=1, timeout=5)
+        release = threading.Event()
+
+        def _hold():
+            with pool.connection():
+                release.wait(5)
+
+        thread = threading.Thread(target=_hold)
+        thread.start()
+        while pool.stats()['in_use'] == 0:
+            time.sleep(0.001)
+        threading.Timer(0.05, release.set).start()
+        with pool.connection():
+            pass
+        thread.join()
+
+        stats = pool.stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['waits'], 1)
+        self.assertGreater(stats['max_wait_time'], 0)
+
+    def test_prewarm(self):
+        pool = FakeMySQLPool(pool_size=3, prewarm=3)
+        stats = pool.stats()
+        self.assertEqual(stats['idle'], 3)
+        self.assertEqual(stats['created'], 3)
+
+    def test_dispose_on_error(self):
+        pool = FakeMySQLPool(pool_size=2)
+
+        def _fail():
+            with pool.connection() as conn:
+                self.conn = conn
+                raise pymysql.OperationalError('boom')
+
+        self.assertRaises(pymysql.OperationalError, _fail)
+        self.assertTrue(self.conn.closed)
+        stats = pool.stats()
+        self.assertEqual(stats['open'], 0)
+        self.assertEqual(stats['errors'], 1)
+
+    def test_ping_and_lifetime(self):
+        pool = FakeMySQLPool(pool_size=2, ping_interval=0)
+        with pool.connection() as conn:
+            pass
+        conn.alive = False
+        with pool.connection() as fresh:
+            self.assertIsNot(fresh, conn)
+        self.assertTrue(conn.closed)
+
+        pool = FakeMySQLPool(pool_size=2, max_lifetime=0.01)
+        with pool.connection() as conn:
+            pass
+        time.sleep(0.02)
+        with pool.connection() as fresh:
+            self.assertIsNot(fresh, conn)
+        self.assertTrue(conn.closed)
+
+
+class Recorder(object):
+    def __init__(self):
+        self.records = []
+
+    def record(self, value, attributes):
+        self.records.append((value, attributes))
+
+
+class HeaderAdapter(wsgiadapter.WSGIAdapter):
+    headers = []
+
+    def send(self, request, *args, **kwargs):
+        self.headers.append(dict(request.headers))
+        return super(HeaderAdapter, self).send(request, *args, **kwargs)
+
+
+class FakeTracer(object):
+    def __init__(self, span):
+        self.span = span
+
+    def start_as_current_span(self, name, **kwargs):
+        return opentelemetry.trace.use_span(self.span)
+
+    def start_span(self, name, **kwargs):
+        return self.span
+
+
+@unittest.skipUnless(floe.otel_instrumentation.OTEL_ENABLED,
+                     'opentelemetry is not installed')
+class OtelInstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = floe.connect('test_file')
+        self.store.flush()
+        self.patched = {}
+        for name in ('_duration', '_keys', '_bytes'):
+            self.patched[name] = getattr(floe.otel_instrumentation, name)
+            setattr(floe.otel_instrumentation, name, Recorder())
+
+    def tearDown(self):
+        for name, value in self.patched.items():
+            setattr(floe.otel_instrumentation, name, value)
+        self.store.flush()
+
+    def recorded(self, name):
+        recorder = getattr(floe.otel_instrumentation, name)
+        return [(value, attributes['floe.operation'])
+                for value, attributes in recorder.records]
+
+    def test_metrics(self):
+        store = floe.fileapi.FileFloe(self.store.dir, pool_size=4)
+        store.domain = 'test_file'
+        keys = [xid() for _ in range(3)]
+        store.set_multi({key: b'x' * 10 for key in keys})
+        store.get_multi(keys + [xid()])
+        store.delete(keys[0])
+        self.assertEqual(len(list(store.ids())), 2)
+
+        # the gets the pool makes for get_multi, and the delete_multi
+        # behind delete, aren't counted again
+        self.assertEqual(self.recorded('_keys'),
+                         [(3, 'set_multi'), (4, 'get_multi'), (1, 'delete'),
+                          (2, 'ids')])
+        self.assertEqual(self.recorded('_bytes'),
+                         [(30, 'set_multi'), (30, 'get_multi')])
+        durations = floe.otel_instrumentation._duration.records
+        self.assertEqual([a['floe.operation'] for _, a in durations],
+                         ['set_multi', 'get_multi', 'delete', 'ids'])
+        self.assertEqual({(a['floe.domain'], a['floe.backend'])
+                          for _, a in durations}, {('test_file', 'file')})
+
+    def test_error(self):
+        store = floe.connect('test_file')
+        self.assertRaises(floe.FloeInvalidKeyException,
+                          lambda: store.get('bad key'))
+        (_, attributes), = floe.otel_instrumentation._duration.records
+        self.assertEqual(attributes['error.type'], 'FloeInvalidKeyException')
+
+    def test_ids_error(self):
+        # the manifest's ids is a generator, so the bad key only raises
+        # once iteration starts
+        store = floe.fileapi.FileFloe(self.store.dir + '_otel',
+                                      manifest=True)
+        keys = store.ids(after='bad key')
+        self.assertRaises(floe.FloeInvalidKeyException, lambda: list(keys))
+        (_, attributes), = floe.otel_instrumentation._duration.records
+        self.assertEqual(attributes['floe.operation'], 'ids')
+        self.assertEqual(attributes['error.type'], 'FloeInvalidKeyException')
+        shutil.rmtree(store.dir, ignore_errors=True)
+
+    def test_traceparent(self):
+        HeaderAdapter.headers = []
+        floe.restapi.RestClientFloe.session.mount(
+            'http://test-floe-trace/', HeaderAdapter(floe.floe_server()))
+        store = floe.restapi.RestClientFloe('http://test-floe-trace/test_file')
+        context = opentelemetry.trace.SpanContext(
+            trace_id=0x0af7651916cd43dd8448eb211c80319c,
+            span_id=0xb7ad6b7169203331, is_remote=False,
+            trace_flags=opentelemetry.trace.TraceFlags(1))
+        tracer = floe.otel_instrumentation._tracer
+        floe.otel_instrumentation._tracer = FakeTracer(
+            opentelemetry.trace.NonRecordingSpan(context))
+        try:
+            store.set_multi({xid(): b'1', xid(): b'2'})
+        finally:
+            floe.otel_instrumentation._tracer = tracer
+        self.assertEqual(
+            [h['traceparent'] for h in HeaderAdapter.headers],
+            ['00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'] * 2)
+
+    def test_off_switch(self):
+        script = 'import floe.fileapi as f; ' \
+                 'print(hasattr(f.FileFloe.get, "__wrapped__"))'
+        env = dict(os.environ, FLOE_OTEL='0')
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         env=env)
+        self.assertEqual(output.strip(), b'False')
+        self.assertTrue(hasattr(floe.fileapi.FileFloe.get, '__wrapped__'))
+
+
+class HelpersTest(unittest.TestCase):
+
+    def test_parse_size(self):
+        parse_size = floe.helpers.parse_size
+        self.assertEqual(parse_size(512), 512)
+        self.assertEqual(parse_size('512'), 512)
+        self.assertEqual(parse_size('64KB'), 64 << 10)
+        self.assertEqual(parse_size('256mb'), 256 << 20)
+        self.assertEqual(parse_size('1.5G'), 3 << 29)
+        self.assertRaises(ValueError, lambda: parse_size('lots'))
+
+    def test_batches(self):
+        batches = floe.helpers.batches
+        self.assertEqual(list(batches(range(0, 7), 3)),
+                         [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(list(batches([], 3)), [])
+        self.assertEqual(list(batches(['aa', 'bbbbb', 'c', 'dd'], 10, 5)),
+                         [['aa'], ['bbbbb'], ['c', 'dd']])
+
+
+class MySQLFloeBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = floe.mysqlapi.MySQLFloe(
+            table='batch', init_disable=True, batch_size=3, batch_bytes=25,
+            parallelism=4)
+        self.calls = []
+
+        def _get_batch(keys):
+            self.calls.append(keys)
+            return {k: k.encode('utf-8') for k in keys if k != 'missing'}
+
+        def _set_batch(rows):
+            self.calls.append(rows)
+
+        self.store._get_batch = _get_batch
+        self.store._set_batch = _set_batch
+        self.store._delete_batch = self.calls.append
+
+    def test_get_multi(self):
+        keys = ['k%s' % i for i in range(0, 8)] + ['missing']
+        result = self.store.get_multi(keys)
+        self.assertEqual(result, {k: k.encode('utf-8') for k in keys[0:8]})
+        self.assertEqual(sorted(len(c) for c in self.calls), [3, 3, 3])
+
+    def test_set_multi(self):
+        mapping = {'k%s' % i: b'x' * 10 for i in range(0, 5)}
+        self.store.set_multi(mapping)
+        self.assertEqual(sorted(len(c) for c in self.calls), [1, 2, 2])
+        self.assertEqual(dict(row for c in self.calls for row in c), mapping)
+
+    def test_delete_multi(self):
+        keys = ['k%s' % i for i in range(0, 4)]
+        self.store.delete_multi(keys)
+        self.assertEqual(sorted(k for c in self.calls for k in c), keys)
+
+
+class MySQLFloeIdsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = floe.mysqlapi.MySQLFloe(
+            table='ids', init_disable=True, page_size=3)
+        self.partitions = {
+            'p0': sorted(xid() for _ in range(0, 7)),
+            'p1': sorted(xid() for _ in range(0, 3)),
+            'p2': [],
+        }
+        self.store._partitions = lambda: sorted(self.partitions)
+
+        def _ids_page(partition, after, limit):
+            if partition is None:
+                keys = sorted(k for v in self.partitions.values() for k in v)
+            else:
+                keys = self.partitions[partition]
+            return [k for k in keys if k > after][0:limit]
+
+        self.store._ids_page = _ids_page
+
+    def test_ids(self):
+        keys = sorted(k for v in self.partitions.values() for k in v)
+        self.assertEqual(list(self.store.ids()), keys)
+        self.assertEqual(list(self.store.ids(after=keys[4])), keys[5:])
+
+    def test_scan_ids(self):
+        keys = {k for v in self.partitions.values() for k in v}
+        scan = self.store.scan_ids(workers=2)
+        self.assertEqual(set(scan), keys)
+        self.assertTrue(scan.done)
+        self.assertEqual(list(self.store.scan_ids(cursor=scan.cursor)), [])
+
+    def test_scan_ids_resume(self):
+        keys = {k for v in self.partitions.values() for k in v}
+        scan = self.store.scan_ids(workers=2)
+        seen = set()
+        for key in scan:
+            seen.add(key)
+            if len(seen) == 4:
+                break
+        self.assertFalse(scan.done)
+
+        resumed = self.store.scan_ids(cursor=scan.cursor)
+        seen.update(resumed)
+        self.assertEqual(seen, keys)
+        self.assertRaises(floe.FloeConfigurationException,
+                          lambda: self.store.scan_ids(cursor='bogus'))
+
+
+class MySQLFloeReplicaTest(unittest.TestCase):
+
+    def init_floe(self, **kwargs):
+        store = floe.mysqlapi.MySQLFloe(
+            table='replica', init_disable=True, replicas='r1:3307,r2',
+            **kwargs)
+        store._set_batch = lambda rows: None
+        return store
+
+    def test_replica_config(self):
+        store = self.init_floe()
+        self.assertEqual(
+            [(p.conn_kwargs['host'], p.conn_kwargs.get('port'))
+             for p in store.replica_pools],
+            [('r1', 3307), ('r2', None)])
+        self.assertRaises(floe.FloeConfigurationException,
+                          lambda: self.init_floe(replica_strategy='bogus'))
+
+    def test_round_robin(self):
+        store = self.init_floe()
+        self.assertEqual([store._choose_replica(['foo']) for _ in range(0, 4)],
+                         [0, 1, 0, 1])
+
+    def test_least_outstanding(self):
+        store = self.init_floe(replica_strategy='least_outstanding')
+        store._outstanding = [3, 1]
+        self.assertEqual(store._choose_replica(['foo']), 1)
+        store._outstanding = [0, 1]
+        self.assertEqual(store._choose_replica(['foo']), 0)
+
+    def test_read_your_writes(self):
+        store = self.init_floe(read_your_writes=0.05)
+        store.set('foo', b'1')
+        self.assertIsNone(store._choose_replica(['foo']))
+        self.assertIsNone(store._choose_replica(['bar', 'foo']))
+        self.assertIsNotNone(store._choose_replica(['bar']))
+        time.sleep(0.06)
+        self.assertIsNotNone(store._choose_replica(['foo']))
+
+    def test_read_your_writes_after_slow_write(self):
+        store = self.init_floe(read_your_writes=0.05)
+        store._set_batch = lambda rows: time.sleep(0.1)
+        store.set('foo', b'1')
+        self.assertIsNone(store._choose_replica(['foo']))
+
+
+class FakeLoadDataConnection(FakeMySQLConnection):
+    """
+    records each file loaded. rows whose key is in existing are skipped by
+    an IGNORE load.
+    """
+
+    def __init__(self, existing=()):
+        super(FakeLoadDataConnection, self).__init__()
+        self.loads = []
+        self.existing = set(existing)
+        self.rowcount = -1
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, statement, args):
+        with open(args[0], 'rb') as fp:
+            data = fp.read()
+        self.loads.append((statement, data))
+        keys = [line.split(b'\t')[0].decode('utf-8')
+                for line in data.splitlines()]
+        if 'IGNORE' in statement:
+            keys = [key for key in keys if key not in self.existing]
+        self.rowcount = len(keys)
+
+
+class MySQLFloeBulkLoadTest(unittest.TestCase):
+
+    def test_bulk_load(self):
+        store = floe.mysqlapi.MySQLFloe(table='bulk', init_disable=True)
+        connection = FakeLoadDataConnection()
+        store._bulk_connection = lambda: connection
+        pairs = [('k%s' % i, b'\t\n\x00' + os.urandom(i))
+                 for i in range(0, 10)]
+
+        result = store.bulk_load(iter(pairs), policy='ignore', chunk_bytes=50)
+        self.assertEqual(result['rows'], 10)
+        self.assertTrue(connection.closed)
+        self.assertGreater(len(connection.loads), 1)
+
+        loaded = []
+        for statement, data in connection.loads:
+            self.assertIn('IGNORE INTO TABLE bulk', statement)
+            for line in data.splitlines():
+                key, value = line.split(b'\t')
+                loaded.append((key.decode('utf-8'), bytes.fromhex(
+                    value.decode('ascii'))))
+        self.assertEqual(loaded, pairs)
+
+        self.assertRaises(floe.FloeConfigurationException,
+                          lambda: store.bulk_load(pairs, policy='bogus'))
+
+    def test_bulk_load_counts(self):
+        store = floe.mysqlapi.MySQLFloe(table='bulk', init_disable=True,
+                                        replicas='r1', read_your_writes=5)
+        connection = FakeLoadDataConnection(existing=['k1', 'k3'])
+        store._bulk_connection = lambda: connection
+        pairs = [('k%s' % i, b'1') for i in range(0, 5)]
+
+        result = store.bulk_load(pairs, policy='ignore', chunk_bytes=10)
+        self.assertEqual((result['rows'], result['skipped']), (3, 2))
+        result = store.bulk_load(pairs, policy='replace')
+        self.assertEqual((result['rows'], result['skipped']), (5, 0))
+        # reads of loaded keys stay on the primary for a while
+        self.assertIsNone(store._choose_replica(['k0']))
+
+
 class RestServerAdditionalRoute(object):
 
     def on_get(self, req, resp):
@@ -319,6 +1736,69 @@ class RestClientFileTest(FileFloeTest):
         return floe.connect('test_rest_file')
 
 
+class RestClientMultiTest(FileFloeTest):
+
+    def init_floe(self):
+        return floe.connect('test_rest_multi')
+
+    def test_spread(self):
+        store = self.floe
+        self.assertEqual([e.url for e in store.endpoints],
+                         ['http://test-floe/test_file',
+                          'http://test-floe-2/test_file'])
+        keys = [xid() for _ in range(10)]
+        store.set_multi({key: b'1' for key in keys})
+        store.get_multi(keys)
+        for stats in store.stats()['servers']:
+            self.assertGreaterEqual(stats['requests'], 5)
+            self.assertEqual(stats['errors'], 0)
+
+    def test_hedge(self):
+        store = floe.restapi.RestClientFloe(
+            'http://test-floe-slow,test-floe/test_file')
+        foo = xid()
+        self.floe.set(foo, b'1')
+        started = time.time()
+        self.assertEqual(store._get(foo, store.endpoints), b'1')
+        self.assertLess(time.time() - started, SlowAdapter.delay)
+        self.assertEqual(store.stats()['hedges'], 1)
+
+        # without hedging the slow server is waited on
+        store.hedge = False
+        started = time.time()
+        self.assertEqual(store._get(foo, store.endpoints), b'1')
+        self.assertGreaterEqual(time.time() - started, SlowAdapter.delay)
+
+    def test_eject(self):
+        store = floe.restapi.RestClientFloe(
+            'http://test-floe-down,test-floe/test_file', eject_after=2)
+        foo = xid()
+        store.set(foo, b'1')
+        for _ in range(4):
+            self.assertEqual(store.get(foo), b'1')
+        down, up = store.stats()['servers']
+        self.assertTrue(down['ejected'])
+        self.assertFalse(up['ejected'])
+        self.assertEqual(down['errors'], 2)
+        self.assertEqual(store._order(), store.endpoints[1:])
+
+    def test_errors(self):
+        foo = xid()
+        store = floe.restapi.RestClientFloe(
+            'http://test-floe-down,test-floe-error/test_file')
+        self.assertRaises(floe.FloeOperationalException,
+                          lambda: store.get(foo))
+
+        # a single server raises what it did before failover existed
+        store = floe.restapi.RestClientFloe('http://test-floe-down/test_file')
+        self.assertRaises(requests.ConnectionError, lambda: store.get(foo))
+        store = floe.restapi.RestClientFloe('http://test-floe-error/test_file')
+        with self.assertRaises(floe.FloeException) as raised:
+            store.get(foo)
+        self.assertEqual(type(raised.exception), floe.FloeException)
+        self.assertEqual(store.stats()['servers'][0]['errors'], 1)
+
+
 class RestClientMysqlTest(FileFloeTest):
     def setUp(self):
         table = '%s_%s' % ('rest_mysql', table_prefix_variable)